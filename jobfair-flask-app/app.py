@@ -1,11 +1,17 @@
 from flask import Flask
 from routes.views import views
+from routes.api import api
 
 app = Flask(__name__)
 app.config["UPLOAD_FOLDER"] = "uploads"
 app.secret_key = "your_secret_key"
+app.config["DEPT_WORKERS"] = 1   # 学科ごとの割当の並列プロセス数（1 = 逐次）
+app.config["PATTERN_A_ENGINE"] = "greedy"   # パターン A の希望割当（greedy = 貪欲法 / flow = 最小費用流）
+app.config["PORTFOLIO_BUDGET"] = None   # 学科ごとのエンジン競争の制限時間（秒）。None = 競争しない
+app.config["LOG_LEVEL"] = None   # 割当ジョブのログレベル（debug / info / warning / error。None = 環境変数 JOBFAIR_LOG_LEVEL）
 
 app.register_blueprint(views)
+app.register_blueprint(api)
 
 if __name__ == "__main__":
     app.run(debug=True)
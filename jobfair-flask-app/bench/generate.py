@@ -0,0 +1,148 @@
+# bench/generate.py
+"""
+ベンチマーク用の合成データ（students.csv / companies.csv）を作る。
+
+  python -m bench.generate --students 3000 --depts 12 --out /tmp/event
+
+実データと同じ列構成（学籍番号,学科名,第一希望,… / company_name,department_id）で出力するので、
+そのまま /admin/upload や run_assignment_pipeline に渡せる。
+
+  students            学生数
+  depts               学科数
+  companies_per_dept  1 学科あたりの企業数
+  pref_depth          希望の数（1〜8。第一希望〜第八希望）
+  num_slots           コマ数（0 なら load_students の既定 = 希望の数。3 未満は 3）
+  skew                人気の偏り（企業の人気 ∝ 1 / 順位^skew。0 なら一様）
+  tightness           需要 / 供給（学生数 / (キャパ × 企業数)）。1 を超える学科はパターン B になる
+  size_spread         学科ごとの学生数のばらつき（対数正規の σ）。大きいほど B の学科が増える
+  shared_rate         複数学科に出展する企業の割合（学科横断の調整が走る）
+  cross_rate          学科外の企業を希望する割合
+"""
+import argparse
+import csv
+import json
+import math
+import os
+from dataclasses import dataclass, asdict
+
+import numpy as np
+
+KANJI_RANKS = "一二三四五六七八"
+
+
+@dataclass
+class EventSpec:
+    students: int = 1000
+    depts: int = 10
+    companies_per_dept: int = 12
+    pref_depth: int = 3
+    num_slots: int = 0
+    skew: float = 1.0
+    tightness: float = 0.8
+    size_spread: float = 0.4
+    shared_rate: float = 0.2
+    cross_rate: float = 0.02
+    seed: int = 0
+
+    @property
+    def cap(self):
+        """tightness から逆算した企業ごとのキャパ（全学科共通）"""
+        per_dept = self.students / self.depts
+        return max(1, math.ceil(per_dept / (self.companies_per_dept * self.tightness)))
+
+
+# 規模のプリセット（bench.run の --sizes で使う）
+PRESETS = {
+    "small":  EventSpec(students=300,  depts=6,  companies_per_dept=8),
+    "medium": EventSpec(students=1000, depts=10, companies_per_dept=12),
+    "large":  EventSpec(students=5000, depts=20, companies_per_dept=20),
+    "tight":  EventSpec(students=1000, depts=10, companies_per_dept=12, tightness=1.3),
+    # 大規模イベント（8 コマ・第八希望まで）
+    "wide":   EventSpec(students=2000, depts=10, companies_per_dept=16, pref_depth=8, num_slots=8),
+}
+
+
+def _dept_sizes(spec, rng):
+    weights = rng.lognormal(0.0, spec.size_spread, spec.depts) if spec.size_spread else np.ones(spec.depts)
+    sizes = np.floor(weights / weights.sum() * spec.students).astype(int)
+    sizes[: spec.students - sizes.sum()] += 1            # 端数を先頭の学科に配る
+    return sizes
+
+
+def _dept_companies(spec, rng):
+    """学科 → 企業名リスト。shared_rate の割合は共通の企業プールから選ぶ"""
+    n_shared = round(spec.companies_per_dept * spec.shared_rate)
+    pool = [f"共通企業{i:04d}" for i in range(max(n_shared * 2, 1))]
+    companies, serial = {}, 0
+    for d in range(spec.depts):
+        names = list(rng.choice(pool, size=n_shared, replace=False)) if n_shared else []
+        for _ in range(spec.companies_per_dept - n_shared):
+            names.append(f"企業{serial:05d}")
+            serial += 1
+        rng.shuffle(names)
+        companies[f"学科{d:02d}"] = [str(n) for n in names]
+    return companies
+
+
+def _pick(rng, names, k, skew):
+    """人気の偏り（Zipf 型）をつけて重複なしに k 社選ぶ"""
+    k = min(k, len(names))
+    weights = 1.0 / np.arange(1, len(names) + 1) ** skew
+    return list(rng.choice(names, size=k, replace=False, p=weights / weights.sum()))
+
+
+def generate(spec, out_dir):
+    """out_dir に students.csv / companies.csv / spec.json を書いて、各パスを返す"""
+    if not 1 <= spec.pref_depth <= len(KANJI_RANKS):
+        raise ValueError(f"pref_depth は 1〜{len(KANJI_RANKS)} で指定してください")
+    rng = np.random.default_rng(spec.seed)
+    os.makedirs(out_dir, exist_ok=True)
+
+    companies = _dept_companies(spec, rng)
+    depts = list(companies)
+    path_companies = os.path.join(out_dir, "companies.csv")
+    with open(path_companies, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["company_name", "department_id"])
+        for dept, names in companies.items():
+            writer.writerows([name, dept] for name in names)
+
+    path_students = os.path.join(out_dir, "students.csv")
+    with open(path_students, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["学籍番号", "学科名"] + [f"第{k}希望" for k in KANJI_RANKS[:spec.pref_depth]])
+        sid = 0
+        for dept, size in zip(depts, _dept_sizes(spec, rng)):
+            others = [c for d in depts if d != dept for c in companies[d]]
+            for _ in range(size):
+                sid += 1
+                prefs = _pick(rng, companies[dept], spec.pref_depth, spec.skew)
+                for i in range(len(prefs)):
+                    if others and rng.random() < spec.cross_rate:
+                        prefs[i] = str(rng.choice(others))
+                prefs = list(dict.fromkeys(prefs))        # 学科外と重なったら詰める
+                prefs += [""] * (spec.pref_depth - len(prefs))
+                writer.writerow([f"S{sid:06d}", dept] + prefs)
+
+    with open(os.path.join(out_dir, "spec.json"), "w", encoding="utf-8") as f:
+        json.dump({**asdict(spec), "cap": spec.cap}, f, ensure_ascii=False, indent=2)
+    return path_students, path_companies
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ベンチマーク用の学生・企業 CSV を生成")
+    parser.add_argument("--preset", choices=sorted(PRESETS), help="規模のプリセット（個別の指定で上書き）")
+    parser.add_argument("--out", required=True, help="出力ディレクトリ")
+    for field, default in asdict(EventSpec()).items():
+        parser.add_argument(f"--{field.replace('_', '-')}", type=type(default), default=None)
+    args = parser.parse_args(argv)
+
+    base = asdict(PRESETS[args.preset]) if args.preset else asdict(EventSpec())
+    spec = EventSpec(**{k: getattr(args, k) if getattr(args, k) is not None else v
+                        for k, v in base.items()})
+    path_students, path_companies = generate(spec, args.out)
+    print(f"{path_students} / {path_companies} を作成しました（cap={spec.cap}）")
+
+
+if __name__ == "__main__":
+    main()
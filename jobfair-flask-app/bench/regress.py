@@ -0,0 +1,207 @@
+# bench/regress.py
+"""
+ソルバーの品質・速度の回帰チェック。
+
+  python -m bench.regress                      # bench/baseline.json と比較（悪化があれば終了コード 1）
+  python -m bench.regress --update-baseline    # 現在の結果で基準を作り直す
+
+固定シードの合成データ（DATASETS）で
+  pattern_a       run_pattern_a                  … パターン A の学科
+  pattern_a_flow  run_pattern_a(engine="flow")   … パターン A の学科
+  strict          run_strict_scheduler           … パターン B の学科
+  cp_sat          run_strict_scheduler_cp        … パターン B の学科
+を学科ごとに実行し、utils.metrics の品質指標（希望スコア合計・第1希望率・0人ブース・
+0訪問学生・飛びコマ学生など）と所要時間の中央値を基準と比べる。
+
+  品質: 基準より悪い指標が 1 つでもあれば NG（--quality-tolerance で比率の許容幅）
+  速度: 基準 × (1 + --time-tolerance) + --time-slack 秒 を超えたら NG
+
+所要時間はマシンに依存するので、基準は同じマシンで作ったものと比べること。
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+from dataclasses import asdict
+
+from bench.generate import EventSpec
+from bench.run import Event, _max_slots, _git_commit
+from utils import telemetry
+from utils.assigner import run_pattern_a
+from utils.metrics import schedule_metrics, compare_metrics
+from utils.pipeline import CP_SAT_WORKERS, CP_SAT_SPARSE
+from utils.strict_assigner import run_strict_scheduler
+from utils.strict_assigner_cp import run_strict_scheduler_cp
+
+BASELINE_PATH = os.path.join(os.path.dirname(__file__), "baseline.json")
+
+# CP-SAT が数秒で最適解まで解ける規模にしてある（基準の品質がぶれないように）
+DATASETS = {
+    "a_basic": EventSpec(students=240, depts=3, companies_per_dept=8, tightness=0.7,
+                         size_spread=0.0, seed=1),
+    "b_basic": EventSpec(students=60, depts=2, companies_per_dept=5, tightness=1.2,
+                         size_spread=0.0, seed=2),
+    # 大規模イベントの形（8 コマ・第八希望まで）
+    "a_wide": EventSpec(students=240, depts=3, companies_per_dept=10, pref_depth=8,
+                        num_slots=8, tightness=0.7, size_spread=0.0, seed=3),
+    "b_wide": EventSpec(students=80, depts=2, companies_per_dept=8, pref_depth=8,
+                        num_slots=8, tightness=1.2, size_spread=0.0, seed=4),
+}
+
+
+def _pattern_a(event, dept, sids, df_dept_pref, df_company, engine="greedy"):
+    schedule = run_pattern_a(df_dept_pref, df_company, sids, dept, event.dept_map,
+                             event.cap, event.num_slots, pref_index=event.pref_index,
+                             rng=random.Random(0), engine=engine)[0]
+    return schedule, event.num_slots
+
+
+def _pattern_a_flow(event, dept, sids, df_dept_pref, df_company):
+    return _pattern_a(event, dept, sids, df_dept_pref, df_company, engine="flow")
+
+
+def _strict(event, dept, sids, df_dept_pref, df_company):
+    schedule = run_strict_scheduler(df_dept_pref, df_company, sids, dept, event.cap,
+                                    event.num_slots, pref_index=event.pref_index)[0]
+    return schedule, min(event.num_slots, _max_slots(event, sids, dept))
+
+
+def _cp_sat(event, dept, sids, df_dept_pref, df_company):
+    max_slots = _max_slots(event, sids, dept)
+    schedule = run_strict_scheduler_cp(
+        df_dept_pref, df_company, sids, dept, event.cap, event.num_slots,
+        max_slots=max_slots, pref_index=event.pref_index,
+        num_workers=CP_SAT_WORKERS, sparse=CP_SAT_SPARSE, random_seed=0)[0]
+    return schedule, min(event.num_slots, max_slots)
+
+
+# solver 名 → (対象の学科のパターン, 実行関数)
+SOLVERS = {
+    "pattern_a": ("A", _pattern_a),
+    "pattern_a_flow": ("A", _pattern_a_flow),
+    "strict": ("B", _strict),
+    "cp_sat": ("B", _cp_sat),
+}
+
+
+def collect(repeat=3):
+    """全データセット × ソルバー × 学科 を実行 → {key: {"metrics", "median_sec", "times"}}"""
+    telemetry.set_echo(False)
+    results = {}
+    for name, spec in DATASETS.items():
+        with tempfile.TemporaryDirectory(prefix=f"regress-{name}-") as workdir:
+            event = Event(spec, workdir)
+            for solver, (pattern, fn) in SOLVERS.items():
+                for dept, sids in event.depts[pattern]:
+                    sid_set = set(sids)
+                    valid = event.pref_index.companies_for_dept(dept)
+                    df_pref = event.df_pref[event.df_pref["student_id"].isin(sid_set)]
+                    df_dept_pref = df_pref[df_pref["company_name"].isin(set(valid))]
+                    df_company = event.df_company[event.df_company["department_id"] == dept]
+
+                    times = []
+                    for _ in range(repeat):
+                        start = time.perf_counter()
+                        schedule, max_slots = fn(event, dept, sids, df_dept_pref, df_company)
+                        times.append(time.perf_counter() - start)
+                    metrics = schedule_metrics(schedule, event.pref_index, valid,
+                                               event.num_slots, max_slots)
+                    results[f"{name}/{solver}/{dept}"] = {
+                        "metrics": metrics,
+                        "median_sec": round(statistics.median(times), 6),
+                        "times": [round(t, 6) for t in times],
+                    }
+    return results
+
+
+def compare(results, baseline, quality_tolerance=0.0, time_tolerance=0.5, time_slack=0.05):
+    """基準との比較 → [(key, [問題, ...]), ...]。基準に無い key は問題にしない"""
+    report = []
+    for key, cur in results.items():
+        base = baseline.get(key)
+        if base is None:
+            report.append((key, None))
+            continue
+        problems = [f"{m}: {b} → {c}"
+                    for m, b, c in compare_metrics(cur["metrics"], base["metrics"], quality_tolerance)]
+        limit = base["median_sec"] * (1 + time_tolerance) + time_slack
+        if cur["median_sec"] > limit:
+            problems.append(f"time: {base['median_sec']:.3f}s → {cur['median_sec']:.3f}s"
+                            f"（上限 {limit:.3f}s）")
+        report.append((key, problems))
+    for key in baseline:
+        if key not in results:
+            report.append((key, ["基準にあるケースが実行されませんでした"]))
+    return report
+
+
+def _load_baseline(path):
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def _save_baseline(path, results):
+    data = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": _git_commit(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "cpu_count": os.cpu_count(),
+        "datasets": {name: asdict(spec) for name, spec in DATASETS.items()},
+        "results": results,
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=2)
+        f.write("\n")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="ソルバーの品質・速度の回帰チェック")
+    parser.add_argument("--baseline", default=BASELINE_PATH)
+    parser.add_argument("--update-baseline", action="store_true", help="現在の結果で基準を書き換える")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--quality-tolerance", type=float, default=0.0,
+                        help="品質指標の悪化の許容幅（比率。0.01 = 1%%）")
+    parser.add_argument("--time-tolerance", type=float, default=0.5,
+                        help="所要時間の増加の許容幅（比率。0.5 = +50%%）")
+    parser.add_argument("--time-slack", type=float, default=0.05,
+                        help="所要時間の許容幅に足す秒数（短いケースの揺らぎ対策）")
+    args = parser.parse_args(argv)
+
+    results = collect(args.repeat)
+    if args.update_baseline:
+        _save_baseline(args.baseline, results)
+        print(f"{len(results)} ケースの基準を {args.baseline} に保存しました")
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f"基準 {args.baseline} がありません。--update-baseline で作成してください")
+        return 2
+
+    baseline = _load_baseline(args.baseline)
+    report = compare(results, baseline["results"], args.quality_tolerance,
+                     args.time_tolerance, args.time_slack)
+    failed = 0
+    for key, problems in report:
+        cur = results.get(key)
+        summary = (f"{cur['median_sec']:.3f}s score={cur['metrics']['preference_score']} "
+                   f"first={cur['metrics']['first_choice_rate']}") if cur else ""
+        if problems is None:
+            print(f"NEW {key:<28} {summary}")
+        elif problems:
+            failed += 1
+            print(f"NG  {key:<28} {summary}")
+            for p in problems:
+                print(f"      {p}")
+        else:
+            print(f"OK  {key:<28} {summary}")
+    print(f"\n{len(report) - failed} / {len(report)} ケース OK（基準: {baseline.get('commit') or '?'}）")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
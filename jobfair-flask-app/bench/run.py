@@ -0,0 +1,375 @@
+# bench/run.py
+"""
+割当パイプラインのベンチマーク。
+
+  python -m bench.run                                # small を全ケース
+  python -m bench.run --sizes large --cases end_to_end pattern_b_cp_sat --repeat 5
+
+規模ごとに合成データ（bench.generate）を作り、各ケースを repeat 回実行して
+所要時間（秒）、Python ヒープのピーク（MB。tracemalloc で別に 1 回測る）、
+品質指標を --out（JSON Lines）に追記する。
+前回の同じ規模・ケースの記録があれば中央値の増減も表示する。
+
+ケース
+  pattern_a          最大のパターン A 学科で run_pattern_a
+  pattern_a_flow     同じ学科で run_pattern_a(engine="flow")（最小費用流）
+  zero_slot_repair   ↑ の結果に 0人ブース補完（assign_zero_slots_by_score_with_replace_safe_loop）
+  pattern_b_hint     最大のパターン B 学科で貪欲法（CP-SAT の warm start 用）
+  pattern_b_cp_sat   同じ学科で run_strict_scheduler_cp
+  diagnosis          イベント全体の割当結果に build_diagnosis
+  end_to_end         run_assignment_pipeline（作業ディレクトリは一時ディレクトリ）
+
+※ tracemalloc は Python のメモリ確保だけを数えるので、CP-SAT（C++）内部のメモリは含まない。
+   max_rss_mb（プロセス全体の最大 RSS）も併せて記録する。
+"""
+import argparse
+import copy
+import json
+import os
+import platform
+import random
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+from dataclasses import asdict, replace
+
+import pandas as pd
+
+from bench.generate import PRESETS, generate
+from utils import telemetry
+from utils.data_loader import load_students, load_companies, build_preference_index
+from utils.assigner import run_pattern_a, assign_zero_slots_by_score_with_replace_safe_loop
+from utils.strict_assigner import run_strict_scheduler
+from utils.strict_assigner_cp import run_strict_scheduler_cp
+from utils.diagnoser import build_diagnosis
+from utils.metrics import schedule_metrics
+from utils.pipeline import run_assignment_pipeline, CP_SAT_WORKERS, CP_SAT_SPARSE
+
+CASES = ["pattern_a", "pattern_a_flow", "zero_slot_repair", "pattern_b_hint", "pattern_b_cp_sat",
+         "diagnosis", "end_to_end"]
+DEFAULT_OUT = os.path.join(os.path.dirname(__file__), "results.jsonl")
+
+
+# ---------------- 計測 ----------------
+def measure(fn, setup=None, repeat=3, memory=True):
+    """
+    setup() の戻り値を引数に fn を repeat 回実行（setup は時間に含めない）。
+    戻り値: (最後の fn の戻り値, [秒, ...], ピーク MB or None)
+    """
+    times, out = [], None
+    for _ in range(repeat):
+        args = setup() if setup else ()
+        start = time.perf_counter()
+        out = fn(*args)
+        times.append(time.perf_counter() - start)
+
+    peak_mb = None
+    if memory:
+        args = setup() if setup else ()
+        tracemalloc.start()
+        try:
+            fn(*args)
+            peak_mb = tracemalloc.get_traced_memory()[1] / 2**20
+        finally:
+            tracemalloc.stop()
+    return out, times, peak_mb
+
+
+def _max_rss_mb():
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10   # macOS は byte、Linux は KB
+
+
+@contextmanager
+def _chdir(path):
+    prev = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(prev)
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True, cwd=os.path.dirname(__file__)).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# ---------------- 割当結果の読込 ----------------
+def _schedule_from_csv(path):
+    df = pd.read_csv(path)
+    slot_cols = [c for c in df.columns if c.startswith("slot_")]
+    schedule = {
+        str(sid): [None if pd.isna(v) else v for v in row]
+        for sid, row in zip(df["student_id"], df[slot_cols].itertuples(index=False))
+    }
+    return schedule, len(slot_cols)
+
+
+# ---------------- 入力の準備 ----------------
+class Event:
+    """生成した 1 イベント分の入力と、ケースごとの対象学科"""
+
+    def __init__(self, spec, workdir):
+        self.spec = spec
+        self.workdir = workdir
+        self.path_students, self.path_companies = generate(spec, workdir)
+        self.df_pref, mode, self.dept_map = load_students(self.path_students)
+        self.num_slots = spec.num_slots or mode
+        self.df_company = load_companies(self.path_companies)
+        self.pref_index = build_preference_index(self.df_pref, self.df_company)
+        self.cap = spec.cap
+
+        by_dept = {}
+        for sid in self.df_pref["student_id"].unique():
+            by_dept.setdefault(self.dept_map[sid], []).append(sid)
+        self.depts = {"A": [], "B": []}
+        for dept, sids in by_dept.items():
+            n_companies = self.df_company.loc[
+                self.df_company["department_id"] == dept, "company_name"].nunique()
+            # solve_department と同じ判定
+            self.depts["A" if self.cap * n_companies > len(sids) else "B"].append((dept, sids))
+        for pattern in self.depts:
+            self.depts[pattern].sort(key=lambda d: -len(d[1]))
+
+    def largest(self, pattern):
+        """
+        その判定の学科のうち学生数が最大の学科（無ければ None）
+        → (学科, 学生ID, 希望 DF, 学科対応企業の希望 DF, 企業 DF)
+        """
+        if not self.depts[pattern]:
+            return None
+        dept, sids = self.depts[pattern][0]
+        sid_set = set(sids)
+        valid = set(self.pref_index.companies_for_dept(dept))
+        df_pref = self.df_pref[self.df_pref["student_id"].isin(sid_set)]
+        # solve_department と同じく、学科対応企業の希望だけに絞った DF も返す
+        return (dept, sids, df_pref, df_pref[df_pref["company_name"].isin(valid)],
+                self.df_company[self.df_company["department_id"] == dept])
+
+
+# ---------------- ケース ----------------
+def case_pattern_a(event, repeat, memory, engine="greedy"):
+    target = event.largest("A")
+    if target is None:
+        return None
+    dept, sids, _, df_dept_pref, df_company = target
+    valid = set(event.pref_index.companies_for_dept(dept))
+    out, times, peak = measure(
+        lambda: run_pattern_a(df_dept_pref, df_company, sids, dept, event.dept_map,
+                              event.cap, event.num_slots, pref_index=event.pref_index,
+                              rng=random.Random(0), engine=engine),
+        repeat=repeat, memory=memory)
+    quality = schedule_metrics(out[0], event.pref_index, valid, event.num_slots)
+    return {"dept": dept, "times": times, "peak_mb": peak, "quality": quality}
+
+
+def case_pattern_a_flow(event, repeat, memory):
+    return case_pattern_a(event, repeat, memory, engine="flow")
+
+
+def case_zero_slot_repair(event, repeat, memory):
+    target = event.largest("A")
+    if target is None:
+        return None
+    dept, sids, df_pref, df_dept_pref, df_company = target
+    valid = event.pref_index.companies_for_dept(dept)
+    base = run_pattern_a(df_dept_pref, df_company, sids, dept, event.dept_map,
+                         event.cap, event.num_slots, pref_index=event.pref_index,
+                         rng=random.Random(0))
+    schedule, score, capacity = base[0], base[1], base[3]
+
+    def setup():
+        return copy.deepcopy(schedule), dict(score), copy.deepcopy(capacity)
+
+    def run(sched, sc, cap):
+        assign_zero_slots_by_score_with_replace_safe_loop(
+            sched, sc, df_pref, cap, valid, event.num_slots, pref_index=event.pref_index)
+        return sched
+
+    sched, times, peak = measure(run, setup, repeat=repeat, memory=memory)
+    return {"dept": dept, "times": times, "peak_mb": peak,
+            "quality": schedule_metrics(sched, event.pref_index, valid, event.num_slots)}
+
+
+def _max_slots(event, sids, dept):
+    n_companies = len(set(event.pref_index.companies_for_dept(dept)))
+    return event.cap * n_companies * event.num_slots // len(sids)
+
+
+def case_pattern_b_hint(event, repeat, memory):
+    target = event.largest("B")
+    if target is None:
+        return None
+    dept, sids, _, df_dept_pref, df_company = target
+    out, times, peak = measure(
+        lambda: run_strict_scheduler(df_dept_pref, df_company, sids, dept, event.cap,
+                                     event.num_slots, pref_index=event.pref_index),
+        repeat=repeat, memory=memory)
+    quality = schedule_metrics(out[0], event.pref_index, event.pref_index.companies_for_dept(dept),
+                               event.num_slots, _max_slots(event, sids, dept))
+    return {"dept": dept, "times": times, "peak_mb": peak, "quality": quality}
+
+
+def case_pattern_b_cp_sat(event, repeat, memory):
+    target = event.largest("B")
+    if target is None:
+        return None
+    dept, sids, _, df_dept_pref, df_company = target
+    max_slots = _max_slots(event, sids, dept)
+    if max_slots < 1:
+        return None
+    stats = {}
+    out, times, peak = measure(
+        lambda: run_strict_scheduler_cp(
+            df_dept_pref, df_company, sids, dept, event.cap, event.num_slots,
+            max_slots=max_slots, pref_index=event.pref_index,
+            num_workers=CP_SAT_WORKERS, sparse=CP_SAT_SPARSE, stats=stats, random_seed=0),
+        repeat=repeat, memory=memory)
+    quality = schedule_metrics(out[0], event.pref_index, event.pref_index.companies_for_dept(dept),
+                               event.num_slots, max_slots)
+    quality.update({
+        "objective": stats.get("phase2", {}).get("objective"),
+        "status": stats.get("phase2", stats.get("phase1", {})).get("status"),
+        "num_vars": stats.get("num_vars"),
+    })
+    return {"dept": dept, "times": times, "peak_mb": peak, "quality": quality}
+
+
+def case_end_to_end(event, repeat, memory):
+    with _chdir(event.workdir):
+        out, times, peak = measure(
+            lambda: run_assignment_pipeline(event.cap, event.path_students, event.path_companies,
+                                            seed=0, num_slots=event.num_slots),
+            repeat=repeat, memory=memory)
+        schedule, num_slots = _schedule_from_csv("schedule.csv")
+    event.final_schedule = schedule
+    quality = schedule_metrics(schedule, event.pref_index, event.df_company["company_name"], num_slots)
+    quality.update({
+        "cross_assign": out["cross_assign"],
+        "pattern_b_depts": sum(p == "B" for p in out["dept_patterns"].values()),
+    })
+    return {"times": times, "peak_mb": peak, "quality": quality,
+            "phases": out.get("timings")}
+
+
+def case_diagnosis(event, repeat, memory):
+    schedule = getattr(event, "final_schedule", None)
+    if schedule is None:
+        case_end_to_end(event, 1, False)
+        schedule = event.final_schedule
+    out, times, peak = measure(
+        lambda: build_diagnosis(event.df_pref, schedule, event.df_company, event.dept_map),
+        repeat=repeat, memory=memory)
+    return {"times": times, "peak_mb": peak,
+            "quality": {"rows": len(out[0]), "cross_pref": len(out[1]), "cross_assign": len(out[2])}}
+
+
+CASE_FUNCS = {
+    "pattern_a": case_pattern_a,
+    "pattern_a_flow": case_pattern_a_flow,
+    "zero_slot_repair": case_zero_slot_repair,
+    "pattern_b_hint": case_pattern_b_hint,
+    "pattern_b_cp_sat": case_pattern_b_cp_sat,
+    "diagnosis": case_diagnosis,
+    "end_to_end": case_end_to_end,
+}
+
+
+# ---------------- 記録 ----------------
+def _load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _previous(history, rec):
+    for old in reversed(history):
+        if (old["size"], old["case"], old["spec"]) == (rec["size"], rec["case"], rec["spec"]):
+            return old
+    return None
+
+
+def run(sizes, cases, repeat=3, memory=True, out=DEFAULT_OUT, overrides=None):
+    telemetry.set_echo(False)            # 計測中はログを標準出力に出さない
+    history = _load_results(out)
+    commit = _git_commit()
+    records = []
+    for size in sizes:
+        spec = replace(PRESETS[size], **(overrides or {}))
+        with tempfile.TemporaryDirectory(prefix=f"bench-{size}-") as workdir:
+            event = Event(spec, workdir)
+            # diagnosis は end_to_end の割当結果を使うので後ろに回す
+            for case in sorted(cases, key=lambda c: c == "diagnosis"):
+                result = CASE_FUNCS[case](event, repeat, memory)
+                if result is None:
+                    print(f"{size:>8} {case:<18} 対象の学科がないためスキップ")
+                    continue
+                times = result.pop("times")
+                rec = {
+                    "ts": time.strftime("%Y-%m-%dT%H:%M:%S"),
+                    "commit": commit,
+                    "python": platform.python_version(),
+                    "size": size,
+                    "spec": {**asdict(spec), "cap": spec.cap},
+                    "case": case,
+                    "repeat": repeat,
+                    "times": [round(t, 6) for t in times],
+                    "median_sec": round(statistics.median(times), 6),
+                    "min_sec": round(min(times), 6),
+                    "max_rss_mb": round(_max_rss_mb(), 1),
+                    **result,
+                }
+                if rec["peak_mb"] is not None:
+                    rec["peak_mb"] = round(rec["peak_mb"], 3)
+                records.append(rec)
+                _print_record(rec, _previous(history, rec))
+
+    if records:
+        with open(out, "a", encoding="utf-8") as f:
+            for rec in records:
+                f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+        print(f"\n{len(records)} 件を {out} に追記しました")
+    return records
+
+
+def _print_record(rec, prev):
+    change = ""
+    if prev:
+        ratio = rec["median_sec"] / prev["median_sec"] if prev["median_sec"] else float("inf")
+        change = f"  前回比 {ratio - 1:+.1%}（{prev['commit'] or '?'}）"
+    peak = f"{rec['peak_mb']:.2f}MB" if rec["peak_mb"] is not None else "-"
+    quality = " ".join(f"{k}={v}" for k, v in rec["quality"].items())
+    print(f"{rec['size']:>8} {rec['case']:<18} median {rec['median_sec']:.4f}s  "
+          f"peak {peak}  {quality}{change}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="割当パイプラインのベンチマーク")
+    parser.add_argument("--sizes", nargs="+", default=["small"], choices=sorted(PRESETS))
+    parser.add_argument("--cases", nargs="+", default=CASES, choices=CASES)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--no-memory", action="store_true", help="tracemalloc によるピーク計測を省く")
+    parser.add_argument("--out", default=DEFAULT_OUT, help="結果の追記先（JSON Lines）")
+    parser.add_argument("--seed", type=int, default=None, help="合成データの乱数シード")
+    parser.add_argument("--pref-depth", type=int, default=None, help="希望の数（1〜8）")
+    parser.add_argument("--num-slots", type=int, default=None, help="コマ数")
+    args = parser.parse_args(argv)
+
+    overrides = {k: v for k, v in (("seed", args.seed), ("pref_depth", args.pref_depth),
+                                   ("num_slots", args.num_slots)) if v is not None} or None
+    run(args.sizes, args.cases, repeat=args.repeat, memory=not args.no_memory,
+        out=args.out, overrides=overrides)
+
+
+if __name__ == "__main__":
+    main()
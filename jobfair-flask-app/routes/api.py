@@ -0,0 +1,70 @@
+# routes/api.py
+"""
+学生スケジュールの JSON API（キオスク・モバイル向け）。
+
+メモリ内の schedule_index から返し、ETag / Last-Modified はスケジュールの版から作る。
+クライアントは If-None-Match / If-Modified-Since を付けてポーリングすれば、
+スケジュールが変わっていない間は 304 だけが返る。
+"""
+from datetime import datetime, timezone
+
+from flask import Blueprint, jsonify, request
+
+from utils.schedule_index import schedule_index
+
+api = Blueprint("api", __name__, url_prefix="/api")
+
+MAX_BULK_IDS = 500      # 一括取得で 1 回に指定できる学籍番号の上限
+
+
+def _conditional(payload, snapshot, status=200):
+    """スケジュールの版で ETag / Last-Modified を付け、未更新なら 304 にする"""
+    resp = jsonify(payload)
+    resp.status_code = status
+    if snapshot.version is not None:
+        resp.set_etag(snapshot.version)
+        resp.last_modified = datetime.fromtimestamp(snapshot.mtime, tz=timezone.utc)
+    resp.cache_control.no_cache = True      # キャッシュしてよいが毎回再検証させる
+    if status == 200:
+        resp.make_conditional(request)
+    return resp
+
+
+@api.route("/schedule/<student_id>")
+def schedule_one(student_id):
+    snapshot = schedule_index.snapshot()
+    if snapshot.version is None:
+        return jsonify(error="まだ割当が実行されていません"), 404
+    row = snapshot.api_rows.get(student_id.strip())
+    if row is None:
+        return _conditional({"error": "該当する学籍番号が見つかりませんでした"}, snapshot, 404)
+    return _conditional({"version": snapshot.version, **row}, snapshot)
+
+
+@api.route("/schedule", methods=["GET", "POST"])
+def schedule_bulk():
+    """
+    一括取得。GET ?ids=S001,S002 または POST {"student_ids": [...]}
+    見つからない学籍番号は null を返す。
+    """
+    if request.method == "POST":
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            return jsonify(error='JSON オブジェクト {"student_ids": [...]} を送ってください'), 400
+        ids = body.get("student_ids") or []
+        if not isinstance(ids, list) or not all(
+                isinstance(s, (str, int)) and not isinstance(s, bool) for s in ids):
+            return jsonify(error="student_ids は学籍番号（文字列か整数）のリストにしてください"), 400
+    else:
+        ids = [s for s in request.args.get("ids", "").split(",") if s.strip()]
+    ids = [str(s).strip() for s in ids]
+    if not ids:
+        return jsonify(error="学籍番号を指定してください（ids / student_ids）"), 400
+    if len(ids) > MAX_BULK_IDS:
+        return jsonify(error=f"一度に指定できるのは {MAX_BULK_IDS} 件までです"), 400
+
+    snapshot = schedule_index.snapshot()
+    if snapshot.version is None:
+        return jsonify(error="まだ割当が実行されていません"), 404
+    schedules = {sid: snapshot.api_rows.get(sid) for sid in ids}
+    return _conditional({"version": snapshot.version, "schedules": schedules}, snapshot)
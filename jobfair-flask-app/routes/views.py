@@ -1,20 +1,17 @@
 # routes/views.py
-from flask import Blueprint, render_template, request, redirect, url_for, flash, session
+from flask import Blueprint, render_template, request, redirect, url_for, flash, session, jsonify, current_app
+from flask import Response, stream_with_context, stream_template, g
 
 import pandas as pd
 import os
 from werkzeug.utils import secure_filename
-from utils.data_loader import load_students, load_companies
-from utils.logger import find_company_zero_slots, find_zero_visit_students, find_underfilled_students
-from utils.assigner import assign_preferences, fill_with_industry_match, fill_zero_slots, run_pattern_a, rescue_zero_visits, assign_zero_slots_by_score_with_replace_safe_loop
-from utils.strict_assigner import run_strict_scheduler, calc_score_from_assignment, redistribute_zero_slots_B, assign_zero_slots_hiScore_B
-from utils.cross_adjuster import adjust_overflow_assignments
-from utils.strict_assigner_cp import run_strict_scheduler_cp
-from utils.redistributor import fill_remaining_gaps
+from utils.data_loader import load_students, load_companies, invalidate_snapshots
+from utils.pipeline import run_assignment_pipeline, PATTERN_A_ENGINE, PORTFOLIO_BUDGET
+from utils.jobs import submit_job, get_job_status, get_job_result
+from utils.schedule_index import schedule_index
+from utils import result_store, telemetry
 from flask import send_file
-from utils.diagnoser import build_diagnosis
 from pathlib import Path
-from pandas.errors import EmptyDataError
 
 
 views = Blueprint("views", __name__)
@@ -26,397 +23,85 @@ ALLOWED_EXTENSIONS = {"csv"}
 STUDENTS_PATH  = Path("uploads/students.csv")
 COMPANIES_PATH = Path("uploads/companies.csv")
 
-NUM_SLOTS =3
+# 画面で選べるコマ数・希望の深さの上限（大規模イベントは 6〜8 コマ・第八希望まで）
+MAX_SLOTS = 8
+MAX_PREF_DEPTH = 8
 
 @views.route("/admin/run", methods=["POST"])
 def run_assignment():
     
     path_students  = STUDENTS_PATH  if STUDENTS_PATH.exists()  else "data/students.csv"
     path_companies = COMPANIES_PATH if COMPANIES_PATH.exists() else "data/companies.csv"
-    
-    df_preference, mode, student_dept_map = load_students(path_students)
-    df_company = load_companies(path_companies)
-    session["mode"] = mode
-    NUM_SLOTS = mode
-    student_ids = df_preference["student_id"].unique()
+
     session["shared_capacity"] = int(request.form.get("shared_capacity", 10))
     cap = session["shared_capacity"]
 
-    # 全体の結果用辞書
-    student_schedule = {}
-    student_score = {}
-    student_assigned_companies = {}
-    all_reason_logs = []
-    filled_step4_total = 0
-    filled_step5_total = 0
-    # 各学科ごとのログ用辞書
-    dept_log_summary = {}  # {dept: {"step4": X, "step5": Y}}
-    cross_total = 0
-    dept_patterns = {}
-
-
-    # 学科ごとにグループ化
-    from collections import defaultdict
-    dept_to_students = defaultdict(list)
-    for sid in student_ids:
-        dept_to_students[ student_dept_map[sid] ].append(sid)
-        
-    
-    # 学科ループに入る前に diagnosis.csv をリセット
-    if os.path.exists("diagnosis.csv"):
-        os.remove("diagnosis.csv")
-
-
-    # 各学科ごとに処理
-    for dept, sids in dept_to_students.items():
-        # ① 学科対応企業だけを抽出
-        df_dept_company = df_company[df_company["department_id"] == dept]
-        company_count   = df_dept_company["company_name"].nunique()   # ← 重複行は1社扱い
-
-        # ② 学科の学生希望を抽出（学科対応企業のみ）
-        valid_companies = df_dept_company["company_name"].tolist()
-        df_dept_pref    = df_preference[
-            (df_preference["student_id"].isin(sids)) &
-            (df_preference["company_name"].isin(valid_companies))
-        ]
-
-        # ③ キャパと需要
-        total_capacity = cap  * company_count
-        max_demand     = len(sids)
-
-        # ④ 判定
-        pattern = "A" if total_capacity > max_demand else "B"
-        dept_patterns[dept] = pattern
-
-        # ⑤ デバッグ出力
-        print(f"[DEBUG] {dept: <15} 企業数={company_count:2d}  学生数={len(sids):3d}  "
-            f"総キャパ={total_capacity}  需要={max_demand}  → パターン{pattern}")
-                # 余裕ゼロ or 足りない
-
-            
-
-        if pattern == "A":
-            print(f"=================================[{dept}] パターン A で割当実行=============================================")
-            schedule, score, assigned, capacity, filled4, filled5, reasons = run_pattern_a(
-                df_dept_pref, df_dept_company, sids, dept, student_dept_map, cap, NUM_SLOTS
-            )
-            filled_step4_total += filled4
-            
-            filled_step5_total += filled5
-
-
-            # マージ
-            student_schedule.update(schedule)
-            student_score.update(score)
-            student_assigned_companies.update(assigned)
-            all_reason_logs.append(reasons)
-            
-            # 0人ブース補完
-            filled_zero_slots, remaining_zero_slots = assign_zero_slots_by_score_with_replace_safe_loop(
-                student_schedule, student_score, df_preference,
-                capacity, valid_companies, NUM_SLOTS
-            )
-            print(f"🎯 STEP5: 0人スロット補完 {filled_zero_slots} コマ → 残り {len(remaining_zero_slots)} 件")
-            if remaining_zero_slots:
-                # 画面やログに警告を出す
-                print("以下の企業・スロットはどうしても0人です：", remaining_zero_slots)
-            
-            gap_filled = fill_remaining_gaps(student_schedule, capacity, NUM_SLOTS)
-            underfilled = find_underfilled_students(student_schedule, NUM_SLOTS)
-            print(f"🎯 GAP補完 {gap_filled} コマ → 未充足 {len(underfilled)} 人")
-
-            
-            matched_cnt = sum(
-                1 for sid in sids
-                if any(
-                    c in df_dept_pref[df_dept_pref.student_id == sid].company_name.values
-                    for c in schedule[sid]
-                )
-            )
-            print(f"[{dept}] 希望一致学生数 = {matched_cnt} / {len(sids)}")
-            # -----------------------------------------------
-            dept_log_summary[dept] = {"step4": filled4, "step5": filled5}
-            
-            
-            df_orig_pref_dept = df_preference[   # ← 学科で絞るだけ
-                df_preference["student_id"].isin(sids)
-            ]
-            
-            df_diag_dept, cross_pref_list, cross_assign_list = build_diagnosis(
-                df_orig_pref_dept,   # ← フィルタしない元の希望 DF
-                schedule,
-                df_dept_company,      # 割当学科の企業 DF
-                student_dept_map
-            )
-
-
-            # ログ出力や集計
-            if cross_pref_list:
-                print(f"⚠️ {dept}: [A]学科外を希望した件数 = {len(cross_pref_list)}")
-            if cross_assign_list:
-                print(f"❌ {dept}: [A]学科外割当 {cross_assign_list[:10]} ...")
-            else:
-                print(f"✅ {dept}: [A]学科外割当なし")
-
-            cross_pref_sids = sorted(set(sid for sid, _ in cross_pref_list))
-            print("cross_pref（学科外希望）の学生学籍番号:", cross_pref_sids)
-
-
-
-            # ---- 集計 ----
-            cross_pref_cnt   = len(cross_pref_list)
-            cross_assign_cnt = len(cross_assign_list)
-
-            dept_log_summary[dept].update({
-                "step4"        : filled4,
-                "step5"        : filled5,
-                "cross_pref"   : cross_pref_cnt,
-                "cross_assign" : cross_assign_cnt,
-            })
-
-            cross_total += cross_assign_cnt
-            df_diag_dept.to_csv(
-                "diagnosis.csv",
-                mode="a",            # 追記
-                index=False,
-                header=not os.path.exists("diagnosis.csv")  # 最初の学科だけヘッダ
-            )
-            
-
-            # --- 会社側 0人スロット ------------------------------
-            zero_slots = find_company_zero_slots(schedule, valid_companies, NUM_SLOTS)
-            if zero_slots:
-                print(f"❗ {dept}: 企業側 0人スロット {len(zero_slots)} 件 → {zero_slots[:10]}")
-            else:
-                print(f"✅ {dept}: 企業側 0人スロットなし")
-            from utils.logger import summarize_company_assignments
-            summary = summarize_company_assignments(schedule, valid_companies, NUM_SLOTS)
-            for cname, counts in summary.items():
-                print(f"[LOG] {cname} assigned={counts}")
-
-            # --- 学生側 0訪問 -------------------------------
-            zero_visit = find_zero_visit_students(schedule)
-            if zero_visit:
-                print(f"❗ {dept}: 0訪問学生 {len(zero_visit)} 人 → {zero_visit[:10]}")
-            else:
-                print(f"✅ {dept}: 0訪問学生なし")
-            
-            print(f"[DEBUG] cross_pref={cross_pref_cnt}, cross_assign={cross_assign_cnt}")
-
-        if pattern == "B":
-            print(f"==== [{dept}] パターン B で CP-SAT 実行 ====")
-            
-            # ③ キャパと需要
-            total_capacity = cap * company_count * NUM_SLOTS    # ← スロット数も掛ける
-            max_demand     = len(sids)
-
-            # ④ 初期 max_slots を計算
-            initial_max_slots = total_capacity // max_demand    # 整数割
-            if initial_max_slots < 1:
-                print(f"⚠️ {dept}: キャパ不足で全員 1 コマも確保できません。CP-SATはスキップ")
-                # schedule を None だけで埋めて終わる
-                schedule = {sid: [None] * NUM_SLOTS for sid in sids}
-                capacity = {c: [cap] * NUM_SLOTS for c in valid_companies}
-                unassigned = list(sids)
-                # あとは従来のログ処理へ
-                ...
-                continue           # 次の学科へ
-
-
-            # ★ CP-SAT 呼び出し               
-            try:
-                schedule, capacity, unassigned = run_strict_scheduler_cp(
-                    df_dept_pref, df_dept_company, sids,
-                dept, cap, NUM_SLOTS,
-                max_slots=initial_max_slots
-                )
-            except Exception as e:
-                print("CP-SATエラー:", e)
-                schedule = {sid: [None] * NUM_SLOTS for sid in sids}
-                capacity = {c: [cap] * NUM_SLOTS for c in valid_companies}
-                unassigned = list(sids)
-
-
-            # ---- 旧ヒューリスティック系は呼ばない ----
-            student_score.update(calc_score_from_assignment(schedule, df_preference))
-            student_schedule.update(schedule)
-            student_assigned_companies.update({
-                sid: {c for c in schedule[sid] if c}   # None を除外
-                for sid in sids
-            })
-
-            print(f"[{dept}] (CP-SAT) 割当完了 ― 未割当 {len(unassigned)} 人")
-
-            # ④ ここで最終スコアを再計算
-            student_score.update(calc_score_from_assignment(schedule, df_preference))
-            
-            # 統一の出力形式に合わせて辞書更新
-            student_schedule.update(schedule)
-            student_assigned_companies.update({
-                sid: set(c for c in schedule[sid] if c not in [None, ""])
-                for sid in sids
-            })
-
-            
-            filled4, filled5, reasons = 0, 0, {}
-            filled_step4_total += filled4
-            filled_step5_total += filled5
-            all_reason_logs.append(reasons)
-
-            print(f"[{dept}] (strictB) 割当完了（未割当 {len(unassigned)}人）")
-
-            matched_cnt = sum(
-                1 for sid in sids
-                if any(
-                    c in df_dept_pref[df_dept_pref.student_id == sid].company_name.values
-                    for c in schedule[sid]
-                )
-            )
-            print(f"[{dept}] (B) 希望一致学生数 = {matched_cnt} / {len(sids)}")
-
-            dept_log_summary[dept] = {"step4": filled4, "step5": filled5}
-
-            df_orig_pref_dept = df_preference[df_preference["student_id"].isin(sids)]
-            df_diag_dept, cross_pref_list, cross_assign_list = build_diagnosis(
-                df_orig_pref_dept,
-                schedule,
-                df_dept_company,
-                student_dept_map
-            )
-
-            cross_pref_cnt   = len(cross_pref_list)
-            cross_assign_cnt = len(cross_assign_list)
-            dept_log_summary[dept].update({
-                "step4"        : filled4,
-                "step5"        : filled5,
-                "cross_pref"   : cross_pref_cnt,
-                "cross_assign" : cross_assign_cnt,
-            })
-
-            cross_total += cross_assign_cnt
-            df_diag_dept.to_csv(
-                "diagnosis.csv",
-                mode="a",
-                index=False,
-                header=not os.path.exists("diagnosis.csv")
-            )
-            
-
-            # --- 会社側 0人スロット ------------------------------
-            zero_slots = find_company_zero_slots(schedule, valid_companies, NUM_SLOTS)
-            if zero_slots:
-                print(f"❗ {dept}: 企業側 0人スロット {len(zero_slots)} 件 → {zero_slots[:10]}")
-            else:
-                print(f"✅ {dept}: 企業側 0人スロットなし")
-            from utils.logger import summarize_company_assignments
-            summary = summarize_company_assignments(schedule, valid_companies, NUM_SLOTS)
-            for cname, counts in summary.items():
-                print(f"[LOG] {cname} assigned={counts}")
-
-            # --- 学生側 0訪問 -------------------------------
-            zero_visit = find_zero_visit_students(schedule)
-            if zero_visit:
-                print(f"❗ {dept}: 0訪問学生 {len(zero_visit)} 人 → {zero_visit[:10]}")
-            else:
-                print(f"✅ {dept}: 0訪問学生なし")
-
-            # --- 学生側 max_slots 未満（パターンBのみ） ----------
-            if pattern == "B":
-                # strict_assigner と同じ式で再計算
-                import math
-                max_slots = min(4, math.floor(len(valid_companies) * cap * NUM_SLOTS / len(sids)))
-                underfill = find_underfilled_students(schedule, max_slots)
-                if underfill:
-                    print(f"⚠️ {dept}: max_slots 未満 {len(underfill)} 人 → {underfill[:10]}")
-                else:
-                    print(f"✅ {dept}: 全員 max_slots（{max_slots} 枠）充足")
-
-            
-            from utils.logger import find_discontinuous_students
-
-            disc = find_discontinuous_students(schedule)
-            if disc:
-                print(f"❌ {dept}: 飛びコマ学生 {len(disc)} 人 → {disc[:10]}")
-            else:
-                print(f"✅ {dept}: 連続枠制約 OK")
+    # 重い割当処理はジョブとしてワーカープロセスに投げ、すぐに job_id を返す
+    # 差分再計算：前回から変わった学科だけ解き直す
+    incremental = request.form.get("incremental") == "on"
+    # 乱数シード（空欄なら毎回新しいシード）。同じシードなら同じ割当になり、
+    # use_cache なら同じ入力・シードの過去の結果をそのまま使う
+    seed = request.form.get("seed", type=int)
+    use_cache = request.form.get("use_cache") == "on"
+    # コマ数・希望の深さ（空欄なら学生CSVの希望列から自動）
+    num_slots = request.form.get("num_slots", type=int)
+    pref_depth = request.form.get("pref_depth", type=int)
+    for value, upper, label in ((num_slots, MAX_SLOTS, "コマ数"),
+                                (pref_depth, MAX_PREF_DEPTH, "希望の深さ")):
+        if value is not None and not 1 <= value <= upper:
+            message = f"{label}は 1〜{upper} で指定してください"
+            if _wants_json():
+                return jsonify(error=message), 400
+            flash(f"⚠️ {message}")
+            return redirect(url_for("views.admin"))
+    session["num_slots"] = num_slots
+    session["pref_depth"] = pref_depth
+    job_id = submit_job(run_assignment_pipeline, cap, str(path_students), str(path_companies),
+                        dept_workers=current_app.config.get("DEPT_WORKERS", 1),
+                        incremental=incremental,
+                        log_level=current_app.config.get("LOG_LEVEL"),
+                        seed=seed, use_cache=use_cache,
+                        num_slots=num_slots, pref_depth=pref_depth,
+                        engine=current_app.config.get("PATTERN_A_ENGINE", PATTERN_A_ENGINE),
+                        portfolio_budget=current_app.config.get("PORTFOLIO_BUDGET", PORTFOLIO_BUDGET))
+    session["last_job_id"] = job_id
+
+    if _wants_json():
+        return jsonify(job_id=job_id,
+                       status_url=url_for("views.job_status", job_id=job_id)), 202
+    flash(f"割当ジョブを受け付けました（ジョブID: {job_id}）。完了するとこの画面に反映されます。")
+    return redirect(url_for("views.admin"))
 
-            # ログ出力や集計 (B版)
-            if cross_pref_list:
-                print(f"⚠️ {dept}: [B]学科外を希望した件数 = {len(cross_pref_list)}")
-            if cross_assign_list:
-                print(f"❌ {dept}: [B]学科外割当 {cross_assign_list[:10]} ...")
-            else:
-                print(f"✅ {dept}: [B]学科外割当なし")
 
+def _wants_json():
+    best = request.accept_mimetypes.best_match(["application/json", "text/html"])
+    return request.is_json or best == "application/json"
 
-            
-        
-    total_cross_assign = sum(dept_log_summary[d].get("cross_assign", 0)
-                          for d in dept_log_summary)
-    
-    print(f"\n=== 全学科 cross_pref 合計: "
-       f"{sum(d.get('cross_pref', 0) for d in dept_log_summary.values())} 件 ===")
-    print(f"=== 全学科 cross_assign 合計: {total_cross_assign} 件 ===")
-
-
-    # --- Post adjust across departments ---
-    adjust_overflow_assignments(
-        student_schedule,
-        student_score,
-        student_dept_map,
-        df_company,
-        cap,
-        NUM_SLOTS,
-        dept_patterns,
-    )
-    student_score.update(calc_score_from_assignment(student_schedule, df_preference))
 
+@views.route("/admin/jobs/<job_id>")
+def job_status(job_id):
+    status = get_job_status(job_id)
+    if status is None:
+        return jsonify(error="ジョブが見つかりません"), 404
+    return jsonify(status)
 
-    # --- CSV出力 ---
-    output_df = pd.DataFrame.from_dict(
-        student_schedule, orient="index",
-        columns=[f"slot_{i}" for i in range(NUM_SLOTS)]
-    )
-    output_df.reset_index(names="student_id", inplace=True)
-    output_df["dept"] = output_df["student_id"].map(student_dept_map)
-    output_df["score"] = output_df["student_id"].map(lambda sid: student_score.get(sid, 0))
-    output_df.to_csv("schedule.csv", index=False)
-    flash("割当を実行し、schedule.csvを更新しました。")
-
-    # --- logs.txt 出力 ---
-    with open("logs.txt", "w", encoding="utf-8") as logf:
-        logf.write(f"STEP 4: 学科マッチ補完数（合計） = {filled_step4_total}\n")
-        logf.write(f"STEP 5: 0人スロット補完数（合計） = {filled_step5_total}\n")
-        logf.write("\n--- 学科別 補完内訳 ---\n")
-        for dept, counts in dept_log_summary.items():
-            logf.write(f"学科 {dept} → STEP4: {counts['step4']}件, STEP5: {counts['step5']}件\n")
-
-        logf.write("\n--- 補完理由一覧 ---\n")
-        for reason_logs in all_reason_logs:
-            for sid, slot_reason in reason_logs.items():
-                for slot, reason in slot_reason.items():
-                    logf.write(f"{sid} の slot_{slot}：{reason}\n")
-
-        logf.write("\n--- 学科外希望／割当件数 ---\n")
-        for dept, counts in dept_log_summary.items():
-            logf.write(
-                f"学科 {dept} → cross_pref = {counts.get('cross_pref',0)} 件, "
-                f"cross_assign = {counts.get('cross_assign',0)} 件\n"
-            )
-        logf.write(f"\n全学科合計 cross_assign = {cross_total} 件\n")
-
-                    
 
-    return redirect(url_for("views.admin"))
+@views.route("/admin/jobs/<job_id>/result")
+def job_result(job_id):
+    status = get_job_status(job_id)
+    if status is None:
+        return jsonify(error="ジョブが見つかりません"), 404
+    if status["status"] == "failed":
+        return jsonify(status), 500
+    if status["status"] != "done":
+        return jsonify(status), 202
+    return jsonify(get_job_result(job_id))
 
 
 
 def allowed_file(filename):
     return "." in filename and filename.rsplit(".", 1)[1].lower() in ALLOWED_EXTENSIONS
 
-def load_schedule():
-    return pd.read_csv("schedule.csv")
-
 @views.route("/admin/download")
 def download_schedule():
     path = "schedule.csv"
@@ -429,8 +114,7 @@ def download_schedule():
 def index():
     if request.method == "POST":
         student_id = request.form["student_id"]
-        df = load_schedule()
-        row = df[df["student_id"] == student_id]
+        row = schedule_index.get(student_id)     # メモリ内索引から O(1) で引く
         return render_template("result.html", row=row)
     return render_template("index.html")
 
@@ -444,28 +128,119 @@ def admin():
     df_company = load_companies(path_companies)   # 空でも DataFrame が返る
     companies = df_company["company_name"].tolist()  # 使わなくても OK
 
+    # 直近の割当ジョブの状態（完了していれば結果をセッションに反映）
+    job = None
+    job_id = session.get("last_job_id")
+    if job_id:
+        job = get_job_status(job_id)
+        if job and job["status"] == "done" and session.get("notified_job_id") != job_id:
+            result = get_job_result(job_id)
+            session["mode"] = result["mode"]
+            session["last_seed"] = result.get("seed")
+            session["notified_job_id"] = job_id
+            if result.get("cached_from"):
+                flash(f"同じ入力・シードの実行 #{result['cached_from']} の結果で"
+                      f"schedule.csvを更新しました（シード {result['seed']}）。")
+            else:
+                flash(f"割当を実行し、schedule.csvを更新しました（シード {result.get('seed')}）。")
+        elif job and job["status"] == "failed" and session.get("notified_job_id") != job_id:
+            session["notified_job_id"] = job_id
+            flash(f"⚠️ 割当ジョブが失敗しました：{job['error']}")
+
     current_mode = session.get("mode", 1)
     shared_capacity = session.get("shared_capacity", 10)
 
     
-    path_schedule = "schedule.csv"
-    if os.path.exists(path_schedule) and os.path.getsize(path_schedule) > 0:
-        try:
-            df = pd.read_csv(path_schedule)
-            table_html = df.to_html(classes="table table-bordered", index=False)
-        except EmptyDataError:
-            table_html = "<p>まだ割当が実行されていません</p>"
-    else:
+    # 割当表は絞り込み条件に合う 1 ページ分だけ HTML にする
+    snapshot = schedule_index.snapshot()
+    filters = _schedule_filters()
+    page = request.args.get("page", 1, type=int)
+    positions = snapshot.query(**filters)
+    if snapshot.df.empty:
         table_html = "<p>まだ割当が実行されていません</p>"
- 
+        pages = 1
+    else:
+        df_page, pages = snapshot.page(positions, page, ADMIN_PAGE_SIZE)
+        table_html = df_page.to_html(classes="table table-bordered", index=False)
+    page = min(max(1, page), pages)
+
     return render_template(
          "admin.html",
          table=table_html,
          current_mode=current_mode,
          shared_capacity=shared_capacity,
+         last_seed=session.get("last_seed"),
+         num_slots=session.get("num_slots"),
+         pref_depth=session.get("pref_depth"),
+         max_slots=MAX_SLOTS,
+         max_pref_depth=MAX_PREF_DEPTH,
+         job=job,
+         depts=snapshot.depts,
+         filters=request.args,
+         query={k: v for k, v in request.args.items() if k != "page" and v},
+         page=page,
+         pages=pages,
+         total=len(positions),
      )
 
 
+ADMIN_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 500
+
+
+def _schedule_filters():
+    """クエリ文字列 → schedule_index の絞り込み条件（学科・スコア範囲・空きコマ有無）"""
+    unfilled = request.args.get("unfilled", "")
+    return {
+        "dept": request.args.get("dept") or None,
+        "score_min": request.args.get("score_min", type=float),
+        "score_max": request.args.get("score_max", type=float),
+        "unfilled": {"1": True, "0": False}.get(unfilled),
+    }
+
+
+@views.route("/admin/schedule/query")
+def schedule_query():
+    """割当表の検索 API（要求されたページの行だけ返す）"""
+    snapshot = schedule_index.snapshot()
+    page = request.args.get("page", 1, type=int)
+    per_page = min(max(1, request.args.get("per_page", ADMIN_PAGE_SIZE, type=int)), MAX_PAGE_SIZE)
+    positions = snapshot.query(**_schedule_filters())
+    df_page, pages = snapshot.page(positions, page, per_page)
+    rows = [
+        {k: (None if pd.isna(v) else (v.item() if hasattr(v, "item") else v)) for k, v in rec.items()}
+        for rec in df_page.to_dict("records")
+    ]
+    return jsonify(
+        version=snapshot.version,
+        total=len(positions),
+        page=min(max(1, page), pages),
+        pages=pages,
+        per_page=per_page,
+        columns=snapshot.columns,
+        rows=rows,
+    )
+
+
+@views.route("/admin/schedule/export.csv")
+def schedule_export():
+    """絞り込み結果を CSV で少しずつ書き出す（全体を文字列にしてから返さない）"""
+    snapshot = schedule_index.snapshot()
+    positions = snapshot.query(**_schedule_filters())
+
+    def generate(chunk=500):
+        yield "\ufeff"        # Excel で文字化けしないよう BOM を付ける
+        yield snapshot.df.iloc[:0].to_csv(index=False)
+        for start in range(0, len(positions), chunk):
+            yield snapshot.df.iloc[positions[start:start + chunk]].to_csv(index=False, header=False)
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/csv",
+        headers={"Content-Disposition": "attachment; filename=schedule_export.csv"},
+    )
+
+
 
 @views.route("/admin/upload", methods=["GET", "POST"])
 def upload_file():
@@ -485,9 +260,11 @@ def upload_file():
             flash("⚠️ 企業CSVファイルが正しく選択されていません")
             return redirect(request.url)
 
-        # ファイル保存
+        # ファイル保存（古い解析スナップショットは捨てる）
         students_file.save(students_path)
         companies_file.save(companies_path)
+        invalidate_snapshots(students_path)
+        invalidate_snapshots(companies_path)
 
         # クレンジング後の件数確認
         try:
@@ -507,7 +284,9 @@ def upload_file():
             else:
                 n_students = "不明（列名が見つかりません）"
 
-            mode_msg = "3枠希望（＋自由訪問）" if mode == 3 else "4枠すべて希望"
+            depth = int(df_students["rank"].max()) if len(df_students) else 0
+            mode_msg = (f"{mode}コマ・第{depth}希望まで（＋自由訪問）" if depth < mode
+                        else f"{mode}コマすべて希望")
             flash(f"✅ 学生データ：{n_students}人 ／ 企業データ：{len(df_companies)}社 をアップロードしました（モード：{mode_msg}）")
 
         except Exception as e:
@@ -553,93 +332,179 @@ def prettify_with_slot_number_all(assigned_pairs, num_slots):
 @views.route("/admin/stats")
 def stats():
     try:
-        # ---------- schedule.csv ----------
-        df_schedule = pd.read_csv("schedule.csv", encoding="utf-8-sig")
-        df_schedule.columns = (
-            df_schedule.columns
-            .str.replace("\ufeff", "", regex=False)  # BOM
-            .str.replace("　", "", regex=False)      # 全角空白
-            .str.strip()
-        )
-        if "student_id" not in df_schedule.columns:
-            # 旧形式 (indexが学籍番号) に対応
-            df_schedule.reset_index(inplace=True)
-            df_schedule.rename(columns={"index": "student_id"}, inplace=True)
-
-        # ---------- students.csv ----------
-        df_pref_raw = pd.read_csv("uploads/students.csv", encoding="utf-8-sig")
-        df_pref_raw.columns = (
-            df_pref_raw.columns
-            .str.replace("\ufeff", "", regex=False)
-            .str.replace("　", "", regex=False)
-            .str.strip()
-        )
-        df_pref_raw.rename(columns={
-            "学籍番号": "student_id",
-            "第一希望": "希望事業所1",
-            "第二希望": "希望事業所2",
-            "第三希望": "希望事業所3",
-        }, inplace=True)
+        # ---------- schedule.csv（メモリ内索引から） ----------
+        snapshot = schedule_index.snapshot()
+        if snapshot.version is None:
+            raise FileNotFoundError("schedule.csv")
+
+        # ---------- students.csv（解析済みスナップショットから） ----------
+        if not STUDENTS_PATH.exists():
+            raise FileNotFoundError(str(STUDENTS_PATH))
+        st = STUDENTS_PATH.stat()
+        # 希望は割当に使った深さ（管理画面の設定、無ければ CSV の希望列すべて）まで数える
+        pref_depth = session.get("pref_depth")
+        cache_key = (snapshot.version, st.st_mtime_ns, st.st_size, pref_depth)
+        if _stats_cache.get("key") != cache_key:
+            df_pref_all, _, _ = load_students(STUDENTS_PATH)
+            _stats_cache.update(key=cache_key,
+                                data=_build_stats_data(snapshot.df, df_pref_all, pref_depth))
 
     except Exception as e:
         flash("必要なCSVファイルの読込に失敗しました：" + str(e))
         return redirect(url_for("views.admin"))
 
-    # ---------- 希望リスト作成 ----------
-    pref_rows = []
-    for _, row in df_pref_raw.iterrows():
-        for rank in (1, 2, 3):
-            company = row.get(f"希望事業所{rank}")
-            if pd.notna(company) and str(company).strip():
-                pref_rows.append({
-                    "student_id"  : row["student_id"],
-                    "company_name": str(company).strip(),
-                    "rank"        : rank,
-                })
-    df_preference = pd.DataFrame(pref_rows)
-
-    # ---------- 反映率計算 ----------
-    num_slots = sum(col.startswith("slot_") for col in df_schedule.columns)
-    stats_data = []
+    # 行数が多くても最初の行からすぐ送り始める
+    return stream_template("stats.html", stats_data=_stats_cache["data"])
 
-    for _, row in df_schedule.iterrows():
-        sid = row["student_id"]
-        assigned_pairs = [
-                            (i, row[f"slot_{i}"])
-                            for i in range(num_slots)
-                            if f"slot_{i}" in row
-                            and pd.notna(row[f"slot_{i}"])
-                            and row[f"slot_{i}"] != "自由訪問枠"
-                        ]
 
+# 統計ページの計算結果（スケジュールの版・students.csv が同じ間は使い回す）
+_stats_cache = {}
 
-        # 学生が出した希望企業（順番そのまま）
-        preferred_rows = df_preference[df_preference.student_id == sid]
-        original_pref_list = preferred_rows.sort_values("rank")["company_name"].tolist()
 
+def _build_stats_data(df_schedule, df_pref_all, pref_depth=None):
+    """
+    反映率の表を作る（学生ごとの DataFrame 絞り込みはせず、まとめて集計する）。
+    pref_depth: 第何希望まで数えるか（省略時は df_pref_all の希望すべて）
+    """
+    df_schedule = df_schedule.copy()
+    df_schedule.columns = (
+        df_schedule.columns
+        .str.replace("\ufeff", "", regex=False)  # BOM
+        .str.replace("　", "", regex=False)      # 全角空白
+        .str.strip()
+    )
+    if "student_id" not in df_schedule.columns:
+        # 旧形式 (indexが学籍番号) に対応
+        df_schedule.reset_index(inplace=True)
+        df_schedule.rename(columns={"index": "student_id"}, inplace=True)
+
+    # ---------- 希望リスト作成（第1〜第 pref_depth 希望） ----------
+    df_preference = df_pref_all
+    if pref_depth:
+        df_preference = df_preference[df_preference["rank"] <= pref_depth]
+    df_preference = df_preference.sort_values("rank", kind="stable")
+    pref_lists = df_preference.groupby("student_id", sort=False)["company_name"].agg(list)
+
+    # ---------- 割当（縦持ち）----------
+    num_slots = sum(col.startswith("slot_") for col in df_schedule.columns)
+    slot_cols = [f"slot_{i}" for i in range(num_slots) if f"slot_{i}" in df_schedule.columns]
+    df_assigned = df_schedule[["student_id"] + slot_cols].reset_index(names="row").melt(
+        id_vars=["row", "student_id"], var_name="slot", value_name="company_name")
+    df_assigned = df_assigned[df_assigned["company_name"].notna()
+                              & (df_assigned["company_name"] != "自由訪問枠")]
+    df_assigned["slot"] = df_assigned["slot"].str.slice(5).astype(int)
+    df_assigned = df_assigned.sort_values(["row", "slot"])
+    assigned_by_row = df_assigned.groupby("row")[["slot", "company_name"]].apply(
+        lambda g: list(zip(g["slot"].tolist(), g["company_name"].tolist())))
+
+    # ---------- 反映率：希望 × 割当 を (学生, 企業) で突き合わせて数える ----------
+    hits = df_preference.merge(
+        df_assigned[["row", "student_id", "company_name"]].drop_duplicates(),
+        on=["student_id", "company_name"],
+    )
+    matched_cnt = hits.groupby("row").size()
+
+    stats_data = []
+    for row_no, sid in enumerate(df_schedule["student_id"]):
+        original_pref_list = pref_lists.get(sid)
         if not original_pref_list:
             continue
-
-        # （反映率は現状のままでOK）
-        assigned_companies = [company for _, company in assigned_pairs]
-        matched = [c for c in original_pref_list if c in assigned_companies]
-        reflect_rate = 100 * len(matched) // len(original_pref_list)
-
-
+        assigned_pairs = assigned_by_row.get(row_no, [])
+        reflect_rate = 100 * int(matched_cnt.get(row_no, 0)) // len(original_pref_list)
         stats_data.append({
             "student_id": sid,
             "assigned"  : prettify_with_slot_number_all(assigned_pairs, num_slots),
             "matched": prettify_with_number(original_pref_list),
             "reflect_rate": f"{reflect_rate}%",
         })
+    return stats_data
+
 
 
-    return render_template("stats.html", stats_data=stats_data)
+def _result_db():
+    """このリクエストで共有する結果DBの接続（読み出し用。リクエストの終わりに閉じる）"""
+    if "result_db" not in g:
+        g.result_db = result_store.connect()
+    return g.result_db
 
 
+@views.teardown_app_request
+def _close_result_db(exc):
+    conn = g.pop("result_db", None)
+    if conn is not None:
+        conn.close()
+
 
 @views.route("/admin/logs")
 def logs():
+    db = _result_db()
+    run_id = request.args.get("run_id", type=int)
+    run = result_store.get_run(run_id, conn=db) if run_id else result_store.latest_run(conn=db)
+    if run is None:
+        return _logs_from_files()
+
+    # 指定の実行（既定は直近）を結果DBから表示
+    step_logs = result_store.step_log_lines(run["id"], conn=db)
+    try:
+        from utils.logger import check_schedule_violations
+        student_schedule = result_store.load_schedule(run["id"], conn=db)
+        violation_logs = check_schedule_violations(student_schedule)
+    except Exception:
+        violation_logs = ["割当結果の検査に失敗しました"]
+
+    summary = result_store.diagnosis_summary(run["id"], conn=db)
+    if summary.empty:
+        diag_table = "<p>診断データがありません</p>"
+    else:
+        diag_table = summary.to_html(classes="table table-bordered")
+
+    return render_template(
+        "logs.html",
+        step_logs=step_logs,
+        violation_logs=violation_logs,
+        diag_table=diag_table,
+        runs=result_store.list_runs(conn=db),
+        current_run=run,
+        **_telemetry_view(run["id"]),
+    )
+
+
+def _telemetry_view(run_id):
+    """計測ログ（工程ごとの所要時間・カウンタ・CP-SAT 統計・ログ）を表示用に整える"""
+    level = request.args.get("level", "info")
+    if level not in telemetry.LEVELS:
+        level = "info"
+
+    db = _result_db()
+    timings = result_store.phase_timings(run_id, conn=db)
+    timing_table = None
+    if not timings.empty:
+        timings["sec"] = timings["sec"].round(3)
+        timing_table = timings.to_html(classes="table table-bordered", index=False)
+
+    events = result_store.run_events(run_id, kinds=("counters", "cp_sat", "portfolio"), conn=db)
+    counters = [{"dept": e.get("dept") or "", **e["counters"]}
+                for e in events if e["kind"] == "counters"]
+    counter_table = None
+    if counters:
+        counter_table = (pd.DataFrame(counters).set_index("dept").fillna(0).astype(int)
+                         .to_html(classes="table table-bordered"))
+    cp_stats = [e for e in events if e["kind"] == "cp_sat"]
+    portfolio = [e for e in events if e["kind"] == "portfolio"]
+
+    return {
+        "log_level": level,
+        "log_levels": list(telemetry.LEVELS),
+        "timing_table": timing_table,
+        "counter_table": counter_table,
+        "cp_stats": cp_stats,
+        "portfolio": portfolio,
+        "event_logs": result_store.run_events(run_id, kinds=("log",), min_level=level, conn=db),
+    }
+
+
+def _logs_from_files():
+    """結果DBにまだ実行が無いとき（旧バージョンの出力）は logs.txt などから表示"""
     try:
         with open("logs.txt", "r", encoding="utf-8") as f:
             step_logs = f.read().splitlines()
@@ -651,34 +516,29 @@ def logs():
         df_schedule = pd.read_csv("schedule.csv")
         from utils.logger import check_schedule_violations
 
+        slot_cols = [c for c in df_schedule.columns if c.startswith("slot_")]
         student_schedule = {
-            row["student_id"]: [row.get(f"slot_{i}") for i in range(4)]
+            row["student_id"]: [row.get(c) for c in slot_cols]
             for _, row in df_schedule.iterrows()
         }
-
-        df_company = pd.read_csv("data/companies.csv")
-        company_capacity = {
-            row["company_name"]: [int(row.get(f"slot_{i}", 0)) for i in range(4)]
-            for _, row in df_company.iterrows()
-        }
-
-        violation_logs = check_schedule_violations(student_schedule, company_capacity)
+        violation_logs = check_schedule_violations(student_schedule)
 
     except Exception:
         violation_logs = ["schedule.csv の読み込みまたは検査に失敗しました"]
-        
-    # ★★ ここから診断サマリを追加 ★★
+
+    # 診断サマリ（学科 × 判定結果）
     try:
         df_diag = pd.read_csv("diagnosis.csv")
-        summary = df_diag.groupby(["dept", "result"]).size().unstack(fill_value=0)
+        summary = df_diag.groupby(["student_dept", "result"]).size().unstack(fill_value=0)
         diag_table = summary.to_html(classes="table table-bordered")
     except Exception:
         diag_table = "<p>diagnosis.csv が存在しません</p>"
 
-    # render_template に diag_table を渡す
     return render_template(
         "logs.html",
         step_logs=step_logs,
         violation_logs=violation_logs,
-        diag_table=diag_table     # ← 追加
+        diag_table=diag_table,
+        runs=[],
+        current_run=None,
     )
@@ -0,0 +1,44 @@
+# tests/test_api.py
+"""スケジュール JSON API（routes/api.py）の入力チェックのテスト"""
+import pytest
+from flask import Flask
+
+from routes.api import api
+from utils.schedule_index import ScheduleIndex
+
+
+@pytest.fixture
+def client():
+    app = Flask(__name__)
+    app.register_blueprint(api)
+    return app.test_client()
+
+
+@pytest.mark.parametrize("body", [
+    5, "S001", ["S001"], None,
+    {"student_ids": "S001"}, {"student_ids": 5}, {"student_ids": {"S001": 1}},
+    {"student_ids": ["S001", None]}, {"student_ids": [["S001"]]}, {"student_ids": [True]},
+])
+def test_bulk_post_rejects_malformed_body(client, body):
+    resp = client.post("/api/schedule", json=body)
+    assert resp.status_code == 400
+    assert "error" in resp.get_json()
+
+
+def test_bulk_post_rejects_non_json(client):
+    resp = client.post("/api/schedule", data="student_ids=S001")
+    assert resp.status_code == 400
+
+
+def test_bulk_post_accepts_str_and_int_ids(client, tmp_path, monkeypatch):
+    path = tmp_path / "schedule.csv"
+    path.write_text("student_id,slot_0,slot_1,dept,score\n1001,A,,学科A,3\nS002,B,A,学科A,5\n",
+                    encoding="utf-8")
+    monkeypatch.setattr("routes.api.schedule_index", ScheduleIndex(str(path)))
+
+    resp = client.post("/api/schedule", json={"student_ids": [1001, "S002", "S999"]})
+    assert resp.status_code == 200
+    schedules = resp.get_json()["schedules"]
+    assert schedules["1001"]["slots"] == ["A", None]
+    assert schedules["S002"]["slots"] == ["B", "A"]
+    assert schedules["S999"] is None
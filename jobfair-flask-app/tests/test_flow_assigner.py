@@ -0,0 +1,65 @@
+# tests/test_flow_assigner.py
+"""flow エンジンのコマ割り（_color_slots の辺彩色）のランダムテスト"""
+import random
+from collections import Counter
+
+import pytest
+
+from utils.flow_assigner import _color_slots
+
+
+def _random_case(rng, uniform):
+    """
+    ランダムな企業キャパと、最小費用流の出力と同じ条件を満たす訪問リスト
+    （学生は num_slots 社以下・同じ企業は 1 回だけ、企業はキャパ合計以下）を作る
+    """
+    num_slots = rng.randint(2, 6)
+    company_caps = {}
+    for i in range(rng.randint(2, 8)):
+        if uniform:
+            company_caps[f"C{i}"] = [rng.randint(1, 4)] * num_slots
+        else:
+            # コマごとに違うキャパ（キャパ 0 = そのコマは出展なし）
+            company_caps[f"C{i}"] = [rng.choice([0, 1, 1, 2, 3]) for _ in range(num_slots)]
+    room = {c: sum(caps) for c, caps in company_caps.items()}
+    visits = []
+    for s in range(rng.randint(1, 40)):
+        open_companies = [c for c in company_caps if room[c] > 0]
+        for rank, c in enumerate(rng.sample(open_companies,
+                                            min(len(open_companies), rng.randint(1, num_slots))),
+                                 start=1):
+            visits.append((f"S{s}", c, rank))
+            room[c] -= 1
+    visits.sort(key=lambda v: v[2])
+    return visits, company_caps, num_slots
+
+
+def _check(cells, visits, company_caps, num_slots):
+    # 塗った訪問は入力の訪問のどれか
+    assert {(sid, c) for sid, c, _ in cells} <= {(sid, c) for sid, c, _ in visits}
+    # 学生は 1 コマ 1 社
+    assert len({(sid, t) for sid, _, t in cells}) == len(cells)
+    # 同じ企業を 2 回訪問しない
+    assert len({(sid, c) for sid, c, _ in cells}) == len(cells)
+    # 企業はコマごとのキャパ以下
+    for (c, t), n in Counter((c, t) for _, c, t in cells).items():
+        assert 0 <= t < num_slots
+        assert n <= company_caps[c][t]
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_color_slots_per_slot_capacity(seed):
+    rng = random.Random(seed)
+    visits, company_caps, num_slots = _random_case(rng, uniform=False)
+    cells = _color_slots(visits, company_caps, num_slots)
+    _check(cells, visits, company_caps, num_slots)
+
+
+@pytest.mark.parametrize("seed", range(300))
+def test_color_slots_uniform_capacity_colors_every_visit(seed):
+    rng = random.Random(seed)
+    visits, company_caps, num_slots = _random_case(rng, uniform=True)
+    cells = _color_slots(visits, company_caps, num_slots)
+    _check(cells, visits, company_caps, num_slots)
+    # キャパが全コマ同じなら Kempe chain で必ず塗り分けられる
+    assert len(cells) == len(visits)
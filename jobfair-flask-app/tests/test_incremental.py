@@ -0,0 +1,82 @@
+# tests/test_incremental.py
+"""差分再計算（run_assignment_pipeline(incremental=True)）の回帰テスト"""
+import csv
+import random
+
+import pandas as pd
+import pytest
+
+from utils.pipeline import plan_incremental, run_assignment_pipeline
+
+CAP = 6
+DEPTS = {f"学科{d}": [f"企業{d}{i}" for i in range(6)] for d in range(3)}
+STUDENTS_PER_DEPT = 30
+
+
+def _write_event(tmp_path):
+    rng = random.Random(7)
+    path_companies = tmp_path / "companies.csv"
+    with open(path_companies, "w", encoding="utf-8", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["company_name", "department_id"])
+        for dept, companies in DEPTS.items():
+            writer.writerows([c, dept] for c in companies)
+    path_students = tmp_path / "students.csv"
+    with open(path_students, "w", encoding="utf-8-sig", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(["学籍番号", "学科名", "第一希望", "第二希望", "第三希望"])
+        sid = 0
+        for dept, companies in DEPTS.items():
+            for _ in range(STUDENTS_PER_DEPT):
+                sid += 1
+                writer.writerow([f"S{sid:04d}", dept] + rng.sample(companies, 3))
+    return str(path_students), str(path_companies)
+
+
+@pytest.fixture
+def event(tmp_path, monkeypatch):
+    # schedule.csv / last_run.pkl などはカレントディレクトリに書かれる
+    monkeypatch.chdir(tmp_path)
+    paths = _write_event(tmp_path)
+    run_assignment_pipeline(CAP, *paths, dept_workers=1)
+    return paths
+
+
+def _schedule():
+    return pd.read_csv("schedule.csv", dtype=str).set_index("student_id")
+
+
+def test_rerun_without_changes_reuses_schedule(event):
+    before = _schedule()
+    run_assignment_pipeline(CAP, *event, dept_workers=1, incremental=True)
+    pd.testing.assert_frame_equal(_schedule(), before)
+
+
+def test_rerun_after_removing_student(event):
+    path_students, path_companies = event
+    before = _schedule()
+    with open(path_students, encoding="utf-8-sig") as f:
+        lines = f.readlines()
+    removed = lines[1].split(",")[0]
+    with open(path_students, "w", encoding="utf-8-sig") as f:
+        f.writelines(lines[:1] + lines[2:])
+
+    # 残りの学生は全員固定になる（固定されていない学生が 0 人の学科）
+    run_assignment_pipeline(CAP, path_students, path_companies,
+                            dept_workers=1, incremental=True)
+    after = _schedule()
+    assert len(after) == len(before) - 1
+    assert removed not in after.index
+    pd.testing.assert_frame_equal(after, before.drop(removed).loc[after.index])
+
+
+@pytest.mark.parametrize("changed", [
+    {}, {"engine": "flow"}, {"portfolio_budget": 5}, {"pref_depth": 2},
+])
+def test_plan_incremental_resolves_all_when_params_change(changed):
+    fp = {"学科0": {"students": {"S0001": ("企業00",)}, "companies": ("企業00",), "capacity": ((6, 6),)}}
+    params = {"engine": "greedy", "portfolio_budget": None, "pref_depth": 3}
+    last_run = {"cap": CAP, "num_slots": 2, "seed": 1, **params, "fingerprint": fp,
+                "results": {"学科0": {"skipped": False, "schedule": {"S0001": ["企業00", None]}}}}
+    plan = plan_incremental(fp, last_run, CAP, 2, 1, **{**params, **changed})
+    assert plan == {"学科0": ("full", None) if changed else ("reuse", None)}
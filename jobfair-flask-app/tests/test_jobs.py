@@ -0,0 +1,45 @@
+# tests/test_jobs.py
+"""ジョブ表（utils.jobs）から終わったジョブを JOB_TTL 後に消すテスト"""
+import time
+from concurrent.futures import Future
+
+import pytest
+
+from utils import jobs
+
+
+@pytest.fixture(autouse=True)
+def job_table(monkeypatch):
+    monkeypatch.setattr(jobs, "_jobs", {})
+
+
+def _add_job(job_id, done, finished_ago=None):
+    future = Future()
+    if done:
+        future.set_result({"ok": True})
+    now = time.time()
+    jobs._jobs[job_id] = {
+        "future": future,
+        "progress": {"_state": "running", "学科A": "done(A)"},
+        "submitted_at": now - 10,
+        "finished_at": now - finished_ago if done else None,
+    }
+
+
+def test_finished_job_is_evicted_after_ttl():
+    _add_job("old", done=True, finished_ago=jobs.JOB_TTL + 1)
+    _add_job("recent", done=True, finished_ago=1)
+    _add_job("running", done=False)
+
+    assert jobs.get_job_status("old") is None
+    assert jobs.get_job_result("old") is None
+    assert jobs.get_job_status("recent")["status"] == "done"
+    assert jobs.get_job_result("recent") == {"ok": True}
+    assert jobs.get_job_status("running")["status"] == "running"
+    assert set(jobs._jobs) == {"recent", "running"}
+
+
+def test_running_job_is_never_evicted():
+    _add_job("running", done=False)
+    jobs._evict_expired(now=time.time() + 10 * jobs.JOB_TTL)
+    assert "running" in jobs._jobs
@@ -0,0 +1,26 @@
+# tests/test_pipeline.py
+"""結果キャッシュのキー（run_cache_key）のテスト"""
+from utils.pipeline import run_cache_key
+
+
+def _paths(tmp_path):
+    path_students = tmp_path / "students.csv"
+    path_companies = tmp_path / "companies.csv"
+    path_students.write_text("学籍番号,学科名,第一希望\nS0001,学科A,企業A\n", encoding="utf-8")
+    path_companies.write_text("company_name,department_id\n企業A,学科A\n", encoding="utf-8")
+    return str(path_students), str(path_companies)
+
+
+def test_cache_key_depends_on_seed_and_engine(tmp_path):
+    paths = _paths(tmp_path)
+    key = run_cache_key(*paths, 6, seed=1)
+    assert key is not None
+    assert run_cache_key(*paths, 6, seed=1) == key
+    assert run_cache_key(*paths, 6, seed=2) != key
+    assert run_cache_key(*paths, 6, seed=1, engine="flow") != key
+
+
+def test_portfolio_runs_are_not_cached(tmp_path):
+    paths = _paths(tmp_path)
+    assert run_cache_key(*paths, 6, seed=1, portfolio_budget=5) is None
+    assert run_cache_key(*paths, 6, seed=None) is None
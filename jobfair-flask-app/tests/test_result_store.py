@@ -0,0 +1,34 @@
+# tests/test_result_store.py
+"""結果DB（utils.result_store）の接続とスキーマ作成のテスト"""
+import os
+from contextlib import closing
+
+from utils import result_store
+
+
+def test_schema_is_created_once_per_file(tmp_path, monkeypatch):
+    calls = []
+    migrate = result_store._migrate
+    monkeypatch.setattr(result_store, "_migrate", lambda conn: (calls.append(1), migrate(conn)))
+    path = str(tmp_path / "results.db")
+
+    for _ in range(3):
+        with closing(result_store.connect(path)):
+            pass
+    assert len(calls) == 1
+
+    # ファイルを消したら次の接続で作り直す
+    os.remove(path)
+    with closing(result_store.connect(path)) as conn:
+        assert conn.execute("SELECT COUNT(*) FROM runs").fetchone()[0] == 0
+    assert len(calls) == 2
+
+
+def test_readers_share_a_passed_connection(tmp_path):
+    path = str(tmp_path / "results.db")
+    with closing(result_store.connect(path)) as conn:
+        assert result_store.latest_run(conn=conn) is None
+        assert result_store.list_runs(conn=conn) == []
+        assert result_store.phase_timings(1, conn=conn).empty
+        # 渡した接続は閉じられていない
+        assert conn.execute("SELECT 1").fetchone()[0] == 1
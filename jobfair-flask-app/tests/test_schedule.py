@@ -0,0 +1,35 @@
+# tests/test_schedule.py
+"""配列版の割当表（utils.schedule.Schedule）の変換のテスト"""
+import pandas as pd
+
+from utils.schedule import Schedule
+
+
+def test_concat_keeps_rows_and_counts():
+    dept_a = Schedule.from_dict({"S1": ["A", None], "S2": ["B", "A"]}, ["A", "B"], 2)
+    dept_b = Schedule.from_dict({"S3": [None, "C"], "S4": ["A", None]}, ["C", "A"], 2)
+    merged = Schedule.concat([dept_a, dept_b], 2)
+
+    assert merged.to_dict() == {**dept_a.to_dict(), **dept_b.to_dict()}
+    assert merged.count("A", 0) == 2 and merged.count("A", 1) == 1 and merged.count("C", 1) == 1
+    assert merged.filled.tolist() == [1, 2, 1, 1]
+    assert merged.zero_visit_students() == []
+
+
+def test_frame_round_trip():
+    sched = Schedule.from_dict({"S1": ["A", None], "S2": [None, None], "S3": ["B", "A"]})
+    df = sched.to_frame().reset_index()
+    assert df.columns.tolist() == ["student_id", "slot_0", "slot_1"]
+
+    # CSV を読んだときと同じく空きは NaN になる
+    back = Schedule.from_frame(df.astype(object).where(df.notna()), ["slot_0", "slot_1"])
+    assert back.to_dict() == sched.to_dict()
+    assert back.filled.tolist() == sched.filled.tolist()
+    assert back.count("A", 0) == 1 and back.count("A", 1) == 1
+
+
+def test_from_frame_uses_first_row_for_duplicate_students():
+    df = pd.DataFrame({"student_id": [1, 2, 1], "slot_0": ["A", None, "B"]})
+    sched = Schedule.from_frame(df, ["slot_0"])
+    assert sched.row("1") == ["A"]
+    assert sched.filled.tolist() == [1, 0, 1]
@@ -0,0 +1,86 @@
+# tests/test_strict_assigner.py
+"""
+assign_one_student のマッチング版（_can_match / _first_matching）と、
+置き換える前の itertools.permutations 版を突き合わせるランダムテスト
+"""
+import copy
+import itertools
+import random
+
+import pytest
+
+from utils.strict_assigner import _first_matching, assign_one_student
+
+
+class _Prefs:
+    """PreferenceIndex の ranked_companies だけ持つ希望表"""
+    def __init__(self, prefs):
+        self.prefs = prefs
+
+    def ranked_companies(self, sid):
+        return self.prefs[sid]
+
+
+def _old_assign_one_student(prefs, company_capacity, num_slots, initial_max_slots):
+    """置き換え前の実装（希望順の順列を全部試す）"""
+    prefs = [c for c in prefs if c in company_capacity]
+    for max_slots in range(initial_max_slots, 0, -1):
+        ranked_subset = prefs[:max_slots]
+        slot_load = [sum(cap[slot] for cap in company_capacity.values()) for slot in range(num_slots)]
+        starts = sorted(range(num_slots - max_slots + 1),
+                        key=lambda s: sum(slot_load[s:s + max_slots]))
+        for start_slot in starts:
+            slots_to_try = list(range(start_slot, start_slot + max_slots))
+            for companies in itertools.permutations(ranked_subset, max_slots):
+                if len(set(companies)) < len(companies):
+                    continue
+                if all(company_capacity[c][t] > 0 for c, t in zip(companies, slots_to_try)):
+                    for c, t in zip(companies, slots_to_try):
+                        company_capacity[c][t] -= 1
+                    return slots_to_try, companies
+    return None
+
+
+def _random_case(rng):
+    """コマごとのキャパ（0 = 出展なし を含む）と、重複・学科外企業も混ざる希望リスト"""
+    num_slots = rng.randint(1, 6)
+    company_capacity = {
+        f"C{i}": [rng.choice([0, 0, 1, 1, 2]) for _ in range(num_slots)]
+        for i in range(rng.randint(1, 7))
+    }
+    pool = list(company_capacity) + ["学科外"]
+    prefs = [rng.choice(pool) for _ in range(rng.randint(0, num_slots + 2))]
+    return prefs, company_capacity, num_slots, rng.randint(1, num_slots)
+
+
+@pytest.mark.parametrize("seed", range(500))
+def test_assign_one_student_matches_permutation_search(seed):
+    rng = random.Random(seed)
+    prefs, company_capacity, num_slots, max_slots = _random_case(rng)
+    expected_capacity = copy.deepcopy(company_capacity)
+    expected = _old_assign_one_student(prefs, expected_capacity, num_slots, max_slots)
+
+    got = assign_one_student("S1", _Prefs({"S1": prefs}), company_capacity,
+                             list(company_capacity), num_slots, max_slots)
+    # 同じ窓（開始コマ）・同じ希望順の企業を選び、同じだけキャパを減らす
+    assert got == expected
+    assert company_capacity == expected_capacity
+
+
+@pytest.mark.parametrize("seed", range(500))
+def test_first_matching_is_first_permutation(seed):
+    rng = random.Random(seed)
+    num_slots = rng.randint(1, 5)
+    company_capacity = {
+        f"C{i}": [rng.choice([0, 1, 1, 2]) for _ in range(num_slots)]
+        for i in range(rng.randint(1, 6))
+    }
+    companies = rng.sample(list(company_capacity), rng.randint(1, len(company_capacity)))
+    slots = sorted(rng.sample(range(num_slots), rng.randint(1, num_slots)))
+
+    expected = next(
+        (list(perm) for perm in itertools.permutations(companies, len(slots))
+         if all(company_capacity[c][t] > 0 for c, t in zip(perm, slots))),
+        None,
+    )
+    assert _first_matching(slots, companies, company_capacity) == expected
@@ -0,0 +1,24 @@
+# tests/test_telemetry.py
+"""計測（utils.telemetry）のカウンタのテスト"""
+import pytest
+
+from utils import telemetry
+
+
+@pytest.fixture(autouse=True)
+def quiet(monkeypatch):
+    monkeypatch.setattr(telemetry, "ECHO", False)
+    monkeypatch.setattr(telemetry._default, "echo", False)
+
+
+def test_count_outside_collect_does_not_accumulate():
+    for _ in range(1000):
+        telemetry.count("outside")
+    assert "outside" not in telemetry._default.counters
+
+
+def test_count_inside_collect_is_flushed_as_one_record():
+    with telemetry.collect() as rec:
+        telemetry.count("inside")
+        telemetry.count("inside", 2)
+    assert [r["counters"] for r in rec.records if r["kind"] == "counters"] == [{"inside": 3}]
@@ -1,17 +1,23 @@
 import random
 import math
 
-def assign_preferences(df_ranked, point, student_schedule, student_score,
+from utils import telemetry
+
+def assign_preferences(pref_index, rank, point, student_schedule, student_score,
                        student_assigned_companies, company_capacity,valid_companies,
-                       num_slots, mode, phase_label="", enable_fair_draw=True):
+                       num_slots, mode, phase_label="", enable_fair_draw=True, rng=None):
+    rng = rng or random     # 乱数は呼び出し側の random.Random を使う（省略時はモジュールの random）
 
-    for company in df_ranked["company_name"].unique():
+    valid_set = set(valid_companies)
+    for company in pref_index.companies_for_rank(rank):
         
         # ---------- 学科外はスキップ ----------
-        if company not in valid_companies:
+        if company not in valid_set:
             continue
         
-        candidates = df_ranked[df_ranked["company_name"] == company]["student_id"].tolist()
+        # 索引は全学科共通なので、この学科の学生だけに絞る
+        candidates = [sid for sid in pref_index.candidates(rank, company)
+                      if sid in student_schedule]
 
         for slot in range(num_slots):
             if mode == 1 and slot == 3:
@@ -34,7 +40,7 @@ def assign_preferences(df_ranked, point, student_schedule, student_score,
             else:
                 if enable_fair_draw:
                     sorted_candidates = sorted(valid_candidates, key=lambda x: student_score[x])
-                    selected = random.sample(sorted_candidates[:cap * 2], k=cap)
+                    selected = rng.sample(sorted_candidates[:cap * 2], k=cap)
                 else:
                     selected = valid_candidates[:cap]
 
@@ -44,39 +50,67 @@ def assign_preferences(df_ranked, point, student_schedule, student_score,
                 student_score[sid] += point
                 company_capacity[company][slot] -= 1
 
-    print(f"✅ {phase_label} の割当完了")
+    telemetry.debug("希望割当完了", phase=phase_label)
 
 
-def run_pattern_a(df_preference, df_company, student_ids, dept_id, student_dept_map, cap, NUM_SLOTS=3):
+def run_pattern_a(df_preference, df_company, student_ids, dept_id, student_dept_map, cap, NUM_SLOTS=3,
+                  pref_index=None, fixed_schedule=None, rng=None, engine="greedy"):
+    """
+    fixed_schedule（sid -> [slot0, ...]）に入っている学生は前回の割当をそのまま使い、
+    キャパだけ先に差し引いて、残りの学生だけを割り当てる（差分再計算用）。
+    rng（random.Random）を渡すと抽選・補完の乱数をすべてそこから引く（同じシードなら同じ結果）。
+    キャパは df_company のキャパ列（utils.data_loader.company_capacity_table）、無ければ全企業 cap。
+    engine: 希望割当（Step 1～3）の解き方
+      "greedy" … 第1希望から順に企業・コマごとに貪欲に埋める（assign_preferences）
+      "flow"   … 最小費用流 + 辺彩色で全体最適に解く（utils.flow_assigner）
+    """
     from .assigner import assign_preferences, fill_with_industry_match
+    from .data_loader import build_preference_index, draw_points, company_capacity_table
 
-    # --- Step 0: 初期化 ---
-    student_schedule = {sid: [None] * NUM_SLOTS for sid in student_ids}
-    student_score = {sid: 0 for sid in student_ids}
-    student_assigned_companies = {sid: set() for sid in student_ids}
-    company_capacity = {
-        cname: [cap] * NUM_SLOTS for cname in df_company["company_name"]
-    }
+    if pref_index is None:
+        pref_index = build_preference_index(df_preference, df_company)
+    fixed_schedule = fixed_schedule or {}
+    free_ids = [sid for sid in student_ids if sid not in fixed_schedule]
 
-    # --- Step 1～3: 希望順に割当（第1～第4希望）---
+    # --- Step 0: 初期化 ---
+    student_schedule = {sid: [None] * NUM_SLOTS for sid in free_ids}
+    student_score = {sid: 0 for sid in free_ids}
+    student_assigned_companies = {sid: set() for sid in free_ids}
+    # 企業ごと・コマごとのキャパ（キャパ列が無ければ全企業 cap）
+    company_capacity = company_capacity_table(df_company, cap, NUM_SLOTS)
+
+    # 固定済み学生の割当ぶんのキャパを先に差し引く
+    for slots in fixed_schedule.values():
+        for slot, cname in enumerate(slots):
+            if cname in company_capacity:
+                company_capacity[cname][slot] = max(0, company_capacity[cname][slot] - 1)
+
+    # --- Step 1～3: 希望順に割当（第1希望～最後の希望）---
     # --- 学科内企業リストを生成 ---
-    valid_companies = df_company[
-        df_company["department_id"] == dept_id
-    ]["company_name"].tolist()
-        
-    for rank in range(1, 5):
-        df_ranked = df_preference[df_preference["rank"] == rank]
-        assign_preferences(
-            df_ranked, point=(5 - rank),
-            student_schedule=student_schedule,
-            student_score=student_score,
-            student_assigned_companies=student_assigned_companies,
-            company_capacity=company_capacity,
-            num_slots=NUM_SLOTS,
-            mode=2,
-            valid_companies=valid_companies,
-            phase_label=f"第{rank}希望"
+    valid_companies = pref_index.companies_for_dept(dept_id)
+
+    if engine == "flow":
+        from .flow_assigner import assign_preferences_flow
+        assign_preferences_flow(
+            pref_index, student_schedule, student_score, student_assigned_companies,
+            company_capacity, valid_companies, NUM_SLOTS, rng=rng,
         )
+    elif engine == "greedy":
+        for rank in pref_index.ranks():
+            assign_preferences(
+                pref_index, rank, point=draw_points(rank, pref_index.depth),
+                student_schedule=student_schedule,
+                student_score=student_score,
+                student_assigned_companies=student_assigned_companies,
+                company_capacity=company_capacity,
+                num_slots=NUM_SLOTS,
+                mode=2,
+                valid_companies=valid_companies,
+                phase_label=f"第{rank}希望",
+                rng=rng,
+            )
+    else:
+        raise ValueError(f"不明なパターン A のエンジンです: {engine}（greedy / flow）")
 
     # --- Step 4: 学科マッチ補完 ---
     filled_step4 = fill_with_industry_match(
@@ -86,15 +120,28 @@ def run_pattern_a(df_preference, df_company, student_ids, dept_id, student_dept_
         df_company,                      # ← そのまま
         valid_companies,
         NUM_SLOTS,
-        student_dept_map
+        student_dept_map,
+        pref_index=pref_index,
+        rng=rng,
     )
 
 
     filled_step5, reasons = fill_zero_slots(
         student_schedule, student_score, student_assigned_companies,
         company_capacity, df_company, df_preference,
-        valid_companies, NUM_SLOTS
+        valid_companies, NUM_SLOTS, pref_index=pref_index, rng=rng
     )
+
+    if fixed_schedule:
+        # 固定済み学生を元の並び順で戻す
+        for sid, slots in fixed_schedule.items():
+            student_schedule[sid] = list(slots)
+            student_assigned_companies[sid] = {c for c in slots if c}
+            student_score[sid] = sum(
+                draw_points(pref_index.rank_of(sid, c), pref_index.depth)
+                for c in slots if c
+            )
+        student_schedule = {sid: student_schedule[sid] for sid in student_ids}
  
     return (student_schedule, student_score,
             student_assigned_companies, company_capacity,
@@ -103,52 +150,55 @@ def run_pattern_a(df_preference, df_company, student_ids, dept_id, student_dept_
 
 def assign_zero_slots_by_score_with_replace_safe_loop(
     student_schedule, student_score, df_preference, company_capacity,
-    valid_companies, NUM_SLOTS, cap=10
+    valid_companies, NUM_SLOTS, cap=10, pref_index=None, locked=None
 ):
-    from utils.logger import find_company_zero_slots
-    pref_dict = df_preference.groupby("student_id").apply(
-        lambda df: {row["company_name"]: row["rank"] for _, row in df.iterrows()}
-    ).to_dict()
+    """
+    0人ブースをスコアの高い学生で埋める（空きコマへの割当 or 置き換え）。
+    locked に入っている学生は動かさない（差分再計算で固定した学生）。
+
+    企業×コマの人数は Schedule、0人ブースは ZeroBooths、学生のスコア順は
+    ScoreQueue で保持し、1 件動かすたびに差分だけ更新する（毎回の全件走査・再ソートはしない）。
+    """
+    from utils.data_loader import build_preference_index, preference_points, score_points
+    from utils.schedule import Schedule, ScoreQueue, ZeroBooths
+    if pref_index is None:
+        pref_index = build_preference_index(df_preference)
+    pref_dict = pref_index.student_rank
+
+    sched = Schedule.from_dict(student_schedule, valid_companies, NUM_SLOTS)
+    zero_booths = ZeroBooths(sched, valid_companies, company_capacity)
+    queue = ScoreQueue(student_score, exclude=locked or ())
+    valid_set = set(valid_companies)
 
     filled_total = 0
     loop_count = 0
     while True:
-        zero_slots = find_company_zero_slots(student_schedule, valid_companies, NUM_SLOTS)
-        print(f"---- LOOP {loop_count} ---- zero_slots={len(zero_slots)}")
+        zero_slots = zero_booths.ordered()
+        telemetry.count("zero_slot_loops")
+        telemetry.debug("0人ブース補完ループ", loop=loop_count, zero_slots=len(zero_slots))
         if not zero_slots:
-            print("✅ 0人ブースゼロ達成！")
             break
 
         filled = 0
-        sorted_sids = sorted(student_score.items(), key=lambda x: -x[1])
-
         for company, slot in zero_slots:
             assigned = False
-            print(f"  >>> 0人: {company} slot={slot}")
-            for sid, _ in sorted_sids:
+            for sid in queue:
                 slots = student_schedule[sid]
-                # そのスロットが空いてるか
-                if slots[slot] is None:
-                    print(f"    学生 {sid} slot {slot} 空き → 割当")
+                # そのスロットが空いてるか（同一企業の重複は不可）
+                if slots[slot] is None and company not in slots:
+                    telemetry.count("zero_slot_assign")
+                    telemetry.debug("空きコマに割当", student_id=sid, company=company, slot=slot)
                     # まだ枠があれば割り当て
-                    student_schedule[sid][slot] = company
+                    slots[slot] = company
+                    sched.assign(sid, slot, company)
+                    zero_booths.refresh(company, slot)
                     company_capacity[company][slot] -= 1
                     assert company_capacity[company][slot] >= 0, f"キャパが負です: {company} slot={slot}"
 
-
                     # スコア計算
-                    prefs = pref_dict.get(sid, {})
-                    rank = prefs.get(company)
-                    if rank == 1:
-                        student_score[sid] += 5
-                    elif rank == 2:
-                        student_score[sid] += 4
-                    elif rank == 3:
-                        student_score[sid] += 3
-                    elif rank == 4:
-                        student_score[sid] += 2
-                    else:
-                        student_score[sid] += 0
+                    rank = pref_dict.get(sid, {}).get(company)
+                    points = preference_points(rank, pref_index.depth)
+                    queue.update(sid, student_score[sid] + points)
                     filled += 1
                     assigned = True
                     break
@@ -169,76 +219,56 @@ def assign_zero_slots_by_score_with_replace_safe_loop(
                     max_rank = max(current_ranks)
                     idx_replace = current_ranks.index(max_rank)
                     replaced_company = slots[idx_replace]
+                    replaced_slot = idx_replace     # ← 今まさに抜こうとしているスロット
+                    replaced_is_real = replaced_company and replaced_company in valid_set
 
-                    replaced_is_real = replaced_company and replaced_company in valid_companies
-                    # この入替でreplaced_companyが0人ブースになるか確認
-                    will_be_zero = False
-                
-                   
                     # --- 置き換え時、そのスロットが 0 人になるかをチェック ---
-                    will_be_zero = False
-                    if replaced_is_real:
-                        replaced_slot = idx_replace     # ← 今まさに抜こうとしているスロット
-
-                        # ① その企業・その slot に他学生がいるか？
-                        slot_count = sum(
-                            (student_schedule[other_sid][replaced_slot] == replaced_company)
-                            for other_sid in student_schedule if other_sid != sid
-                        )
-                        if slot_count == 0:
-                            will_be_zero = True
-                    if will_be_zero:
+                    # （自分を除いた人数 = カウンタ − 1）
+                    if replaced_is_real and sched.count(replaced_company, replaced_slot) <= 1:
                         continue        # この学生は選ばない
 
-
                     # ★ ここで replaced_company のキャパを戻す処理も忘れずに
                     if replaced_is_real:
                         company_capacity[replaced_company][replaced_slot] += 1
-                    
+
                     # ここから新しい会社で入れ替え！
-                    slots[idx_replace] = None  # 1回だけ
-                    student_schedule[sid][slot] = company  # 1回だけ
-                    company_capacity[company][slot] -= 1  # 1回だけ
+                    # （idx_replace != slot のときは slot にいた企業を上書きする）
+                    overwritten = slots[slot]
+                    slots[idx_replace] = None
+                    slots[slot] = company
+                    sched.clear(sid, idx_replace)
+                    sched.assign(sid, slot, company)
+                    for booth in ((company, slot), (replaced_company, replaced_slot), (overwritten, slot)):
+                        zero_booths.refresh(*booth)
+                    company_capacity[company][slot] -= 1
                     assert company_capacity[company][slot] >= 0, f"キャパが負です: {company} slot={slot}"
 
-                    print(f"    学生 {sid} 入れ替え: {replaced_company} -> {company} at slot {slot}")
+                    telemetry.count("zero_slot_swap")
+                    telemetry.debug("入れ替え", student_id=sid, old=replaced_company,
+                                    company=company, slot=slot)
                     filled += 1
                     assigned = True
-                    
+
                     # この下にスコア再計算
-                    score = 0
-                    for cname in student_schedule[sid]:
-                        r = prefs.get(cname)
-                        if r == 1:
-                            score += 3
-                        elif r == 2:
-                            score += 2
-                        elif r == 3:
-                            score += 1
-                        elif r == 4:
-                            score += 1
-                        else:
-                            score += 0
-                    student_score[sid] = score
+                    score = sum(score_points(prefs.get(cname), pref_index.depth) for cname in slots)
+                    queue.update(sid, score)
                     break
             if assigned:
                 break  # 次の0人ブース
 
         filled_total += filled
-        print(f"  >> このループで埋まった数: {filled}")
+        loop_count += 1
         if filled == 0:
-            print("  !! もう埋まらない（break）")
             # これ以上補完できない場合はbreak
             break
 
-    # 最終的に埋まらなかったブースを警告
-    zero_slots = find_company_zero_slots(student_schedule, valid_companies, NUM_SLOTS)
-    if zero_slots:
-        print(f"⚠️ 最後まで埋まらなかった0人ブース：{len(zero_slots)}")
+    # 最終的に埋まらなかったブースは呼び出し側で警告する
+    zero_slots = zero_booths.ordered()
     return filled_total, zero_slots
 
 
-def rescue_zero_visits(student_schedule, company_capacity, valid_companies, num_slots):
+def rescue_zero_visits(student_schedule, company_capacity, valid_companies, num_slots, rng=None):
+    rng = rng or random
     filled = 0
     for sid, slots in student_schedule.items():
         if all(s is None for s in slots):
@@ -249,31 +279,38 @@ def rescue_zero_visits(student_schedule, company_capacity, valid_companies, num_
                     if company_capacity[cname][slot] > 0
                 ]
                 if candidates:
-                    selected = random.choice(candidates)
+                    selected = rng.choice(candidates)
                     student_schedule[sid][slot] = selected
                     company_capacity[selected][slot] -= 1
                     filled += 1
                     break
-    print(f"✅ 0訪問救済補完 {filled}件")
+    telemetry.debug("0訪問救済補完", filled=filled)
     return filled
 
 # ---------------------共通部品---------------------
 def fill_with_industry_match(student_schedule, student_assigned_companies,
-                              company_capacity, df_company,valid_companies, num_slots, student_dept_map):
+                              company_capacity, df_company,valid_companies, num_slots, student_dept_map,
+                              pref_index=None, rng=None):
+    from utils.data_loader import build_preference_index
+    rng = rng or random
+    if pref_index is None:
+        pref_index = build_preference_index(None, df_company)
+    valid_set = set(valid_companies)
+
     filled = 0
     for sid, slots in student_schedule.items():
         dept = student_dept_map[sid]    # 呼び出し側で辞書を渡す
         if dept is None:
             continue
 
+        matched_companies = pref_index.companies_for_dept(dept)
         for slot_idx, assigned in enumerate(slots):
             if assigned is not None:
                 continue  # すでに割当済みならスキップ
 
-            matched_companies = df_company[df_company["department_id"] == dept]["company_name"].tolist()
             candidates = []
             for company in matched_companies:
-                if company not in valid_companies:      # ★ ここでまず学科外を排除
+                if company not in valid_set:      # ★ ここでまず学科外を排除
                     continue
                 if company in student_schedule[sid]:
                     continue  # 同一企業は重複禁止
@@ -285,21 +322,26 @@ def fill_with_industry_match(student_schedule, student_assigned_companies,
             
          # 学科外はスキップ
 
-            selected_company = random.choice(candidates)
+            selected_company = rng.choice(candidates)
             student_schedule[sid][slot_idx] = selected_company
             student_assigned_companies[sid].add(selected_company)
             company_capacity[selected_company][slot_idx] -= 1
             filled += 1
-    print(f"✅ STEP 4: 補完済みスロット数 = {filled}")
+    telemetry.debug("STEP 4: 学科マッチ補完", filled=filled)
     return filled
     
 def fill_zero_slots(student_schedule, student_score, student_assigned_companies,
                     company_capacity, df_company, df_preference,
                     valid_companies,          # ★ 追加
-                    num_slots=3):
+                    num_slots=3, pref_index=None, rng=None):
     """
     「0人ブース」を学科内企業だけで埋める
     """
+    rng = rng or random
+    from utils.data_loader import build_preference_index
+    if pref_index is None:
+        pref_index = build_preference_index(df_preference)
+    valid_set = set(valid_companies)
     filled, reasons = 0, {}
 
     # --- 対象スロットを列挙（企業×slot で割当数 = 0 のもの） ---
@@ -307,15 +349,18 @@ def fill_zero_slots(student_schedule, student_score, student_assigned_companies,
         (cname, slot)
         for cname, caps in company_capacity.items()
         for slot, cap in enumerate(caps)
-        if cap > 0 and cname in valid_companies               # ★ ここで学科外を除外
+        if cap > 0 and cname in valid_set               # ★ ここで学科外を除外
     ]
 
     if not zero_slots:
-        print("✅ STEP 5: 0人スロットはありませんでした。")
+        telemetry.debug("STEP 5: 0人スロットなし")
         return 0, {}
 
-    # --- 希望辞退者（希望なし）一覧作成 ---
-    preference_by_student = df_preference.groupby("student_id")["company_name"].apply(set).to_dict()
+    # --- 希望辞退者（学科内企業の希望なし）一覧作成 ---
+    preference_by_student = {
+        sid: {c for c in pref_index.ranked_companies(sid) if c in valid_set}
+        for sid in student_schedule
+    }
 
     # スロットを埋めていく
     for cname, slot in zero_slots:
@@ -337,7 +382,7 @@ def fill_zero_slots(student_schedule, student_score, student_assigned_companies,
 
         # --- 希望なし学生から割当 ---
         if candidates:
-            sid = random.choice(candidates)
+            sid = rng.choice(candidates)
             student_schedule[sid][slot] = cname
             student_assigned_companies[sid].add(cname)
             reasons.setdefault(sid, {})[slot] = "希望未入力のため上書き補完"
@@ -357,5 +402,5 @@ def fill_zero_slots(student_schedule, student_score, student_assigned_companies,
             filled += 1
             break
 
-    print(f"✅ STEP 5: 0人スロット補完数 = {filled}")
+    telemetry.debug("STEP 5: 0人スロット補完", filled=filled)
     return filled, reasons
@@ -1,28 +1,21 @@
 import random
-import re
 from typing import Dict, List
 
-
-def _norm_company(name: str) -> str:
-    """Normalize company name for grouping"""
-    if name is None:
-        return ""
-    name = str(name).strip()
-    # remove any department style suffix
-    name = re.sub(r"(科|学科).*", "", name)
-    return name
+from utils.data_loader import company_capacity_table
+from utils.normalizer import group_id as _company_key
+from utils import telemetry
 
 
 def build_company_slot_map(student_schedule: Dict[str, List[str]],
-                           num_slots: int) -> Dict[str, Dict[int, List[str]]]:
-    """Return assignments grouped by company->slot->student list"""
-    comp_map: Dict[str, Dict[int, List[str]]] = {}
+                           num_slots: int) -> Dict[int, Dict[int, List[str]]]:
+    """Return assignments grouped by company id->slot->student list"""
+    comp_map: Dict[int, Dict[int, List[str]]] = {}
     for sid, slots in student_schedule.items():
         for slot, cname in enumerate(slots):
             if not cname or cname == "自由訪問枠":
                 continue
-            cname_norm = _norm_company(cname)
-            comp_map.setdefault(cname_norm, {}).setdefault(slot, []).append(sid)
+            cname_key = _company_key(cname)
+            comp_map.setdefault(cname_key, {}).setdefault(slot, []).append(sid)
     return comp_map
 
 
@@ -32,10 +25,19 @@ def adjust_overflow_assignments(student_schedule: Dict[str, List[str]],
                                 df_company,
                                 cap: int,
                                 num_slots: int,
-                                pattern_by_dept: Dict[str, str]):
-    """Resolve slot overflow across departments."""
-    unique_companies = [_norm_company(c) for c in df_company["company_name"].unique()]
-    capacity_map = {c: [cap] * num_slots for c in unique_companies}
+                                pattern_by_dept: Dict[str, str],
+                                rng: random.Random | None = None):
+    """Resolve slot overflow across departments.
+
+    rng: random.Random used for tie-breaks and candidate order
+    (defaults to the module-level random).
+    Per-company / per-slot capacities come from the capacity columns of
+    df_company (company_capacity_table); cap is the fallback.
+    """
+    rng = rng or random
+    capacity_map = {}
+    for cname, caps in company_capacity_table(df_company, cap, num_slots).items():
+        capacity_map.setdefault(_company_key(cname), caps)
 
     comp_map = build_company_slot_map(student_schedule, num_slots)
 
@@ -57,7 +59,7 @@ def adjust_overflow_assignments(student_schedule: Dict[str, List[str]],
                 pool = prefer if prefer else candidates
                 max_score = max(student_score.get(sid, 0) for sid in pool)
                 top = [sid for sid in pool if student_score.get(sid, 0) == max_score]
-                sid = random.choice(top)
+                sid = rng.choice(top)
                 selected.append(sid)
                 candidates.remove(sid)
                 dept = student_dept_map.get(sid, "")
@@ -81,20 +83,20 @@ def adjust_overflow_assignments(student_schedule: Dict[str, List[str]],
         dept = student_dept_map.get(sid, "")
         pattern = pattern_by_dept.get(dept, "A")
         candidates = companies_by_dept.get(dept, [])
-        random.shuffle(candidates)
+        rng.shuffle(candidates)
         assigned = False
         if pattern == "A":
             for t in range(num_slots):
                 if student_schedule[sid][t] is not None:
                     continue
                 for cname in candidates:
-                    cname_norm = _norm_company(cname)
-                    if len(comp_map.get(cname_norm, {}).get(t, [])) >= capacity_map[cname_norm][t]:
+                    cname_key = _company_key(cname)
+                    if len(comp_map.get(cname_key, {}).get(t, [])) >= capacity_map[cname_key][t]:
                         continue
                     if cname in student_schedule[sid]:
                         continue
                     student_schedule[sid][t] = cname
-                    comp_map.setdefault(cname_norm, {}).setdefault(t, []).append(sid)
+                    comp_map.setdefault(cname_key, {}).setdefault(t, []).append(sid)
                     assigned = True
                     break
                 if assigned:
@@ -108,16 +110,16 @@ def adjust_overflow_assignments(student_schedule: Dict[str, List[str]],
                 if idx and max(idx) - min(idx) + 1 != len(idx):
                     continue
                 for cname in candidates:
-                    cname_norm = _norm_company(cname)
-                    if len(comp_map.get(cname_norm, {}).get(t, [])) >= capacity_map[cname_norm][t]:
+                    cname_key = _company_key(cname)
+                    if len(comp_map.get(cname_key, {}).get(t, [])) >= capacity_map[cname_key][t]:
                         continue
                     if cname in student_schedule[sid]:
                         continue
                     student_schedule[sid][t] = cname
-                    comp_map.setdefault(cname_norm, {}).setdefault(t, []).append(sid)
+                    comp_map.setdefault(cname_key, {}).setdefault(t, []).append(sid)
                     assigned = True
                     break
                 if assigned:
                     break
         if not assigned:
-            print(f"[ADJUST] {sid} remains unassigned after overflow fix")
+            telemetry.warning("overflow 調整後も割当先がありません", student_id=sid)
@@ -1,11 +1,124 @@
 import pandas as pd
 import re
 import os
+import copy
+import hashlib
+import pickle
 from pandas.errors import EmptyDataError
 import pathlib, datetime as dt
 
+from utils.normalizer import clean_name
+from utils import telemetry
+
+# --------------------- 解析済みスナップショット ---------------------
+# CSV を解析した結果を <CSVと同じフォルダ>/.cache/ に pickle で保存し、
+# 次回からは CSV を読まずにそこから返す。キーはファイル内容のハッシュ
+# （mtime・サイズが変わったときだけ計算し直す）なので、アップロードで
+# ファイルが置き換われば自動的に作り直される。
+SNAPSHOT_DIR = ".cache"
+SNAPSHOT_VERSION = 3          # 解析処理を変えたら上げる（古いスナップショットを無効化）
+
+_file_hash_memo = {}          # path -> (mtime_ns, size, sha1)
+_snapshot_memo = {}           # (path, kind) -> (sha1, 解析結果)
+
+
+def _file_hash(path):
+    st = os.stat(path)
+    memo = _file_hash_memo.get(path)
+    if memo and memo[:2] == (st.st_mtime_ns, st.st_size):
+        return memo[2]
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    digest = h.hexdigest()
+    _file_hash_memo[path] = (st.st_mtime_ns, st.st_size, digest)
+    return digest
+
+
+def file_hash(path):
+    """ファイル内容の sha1（結果キャッシュのキーなどに使う）"""
+    return _file_hash(str(path))
+
+
+def _snapshot_path(path, kind, digest):
+    p = pathlib.Path(path)
+    return p.parent / SNAPSHOT_DIR / f"{p.name}.{kind}.v{SNAPSHOT_VERSION}.{digest[:16]}.pkl"
+
+
+def _load_snapshot(path, kind, parse):
+    """
+    解析結果をスナップショット経由で返す（無ければ parse(path) して保存）。
+    呼び出し側で書き換えても共有データが壊れないよう、毎回コピーを返す。
+    """
+    path = str(path)
+    if not os.path.exists(path) or os.path.getsize(path) == 0:
+        return parse(path)
+
+    digest = _file_hash(path)
+    memo = _snapshot_memo.get((path, kind))
+    if memo and memo[0] == digest:
+        return copy.deepcopy(memo[1])
+
+    snap = _snapshot_path(path, kind, digest)
+    data = None
+    if snap.exists():
+        try:
+            with open(snap, "rb") as f:
+                data = pickle.load(f)
+        except Exception as e:
+            telemetry.warning("スナップショットが読めないため作り直します", path=str(snap), error=repr(e))
+    if data is None:
+        data = parse(path)
+        try:
+            snap.parent.mkdir(exist_ok=True)
+            for old in snap.parent.glob(f"{pathlib.Path(path).name}.{kind}.*.pkl"):
+                old.unlink(missing_ok=True)      # 同じ CSV の古いスナップショット
+            tmp = snap.with_name(f"{snap.name}.{os.getpid()}.tmp")
+            with open(tmp, "wb") as f:
+                pickle.dump(data, f, protocol=pickle.HIGHEST_PROTOCOL)
+            os.replace(tmp, snap)
+        except OSError as e:
+            telemetry.warning("スナップショットを保存できませんでした", path=str(snap), error=repr(e))
+
+    _snapshot_memo[(path, kind)] = (digest, data)
+    return copy.deepcopy(data)
+
+
+def invalidate_snapshots(path):
+    """アップロードなどで CSV を置き換えたときに、そのファイルのスナップショットを捨てる"""
+    path = str(path)
+    _file_hash_memo.pop(path, None)
+    for key in [k for k in _snapshot_memo if k[0] == path]:
+        del _snapshot_memo[key]
+    p = pathlib.Path(path)
+    for old in (p.parent / SNAPSHOT_DIR).glob(f"{p.name}.*.pkl"):
+        old.unlink(missing_ok=True)
+
+
 # --------------------- 学生 ---------------------
+# 希望列の列名（第一希望〜第十希望 / 第1希望 / 1希望 など）
+PREF_COLUMN = re.compile(r"第?([一二三四五六七八九十]|[0-9０-９]+)希望")
+KANJI_NUMERALS = "一二三四五六七八九十"
+
+
+def pref_column_rank(col):
+    """希望列の列名 → 何番目の希望か（"第三希望" → 3, "第5希望" → 5）"""
+    num = PREF_COLUMN.match(col).group(1)
+    if num in KANJI_NUMERALS:
+        return KANJI_NUMERALS.index(num) + 1
+    return int(num)     # 全角数字も int() で読める
+
+
 def load_students(path="uploads/students.csv", mode=None):
+    """
+    (df_pref, mode, student_dept_map) を返す（解析結果はスナップショットから）。
+    mode は既定のコマ数（空でない希望列の数。3 未満なら 3）
+    """
+    return _load_snapshot(path, "students", _parse_students)
+
+
+def _parse_students(path):
     # ---- ファイルが無い／空なら「列だけある空 DataFrame」を返す ----
     if not os.path.exists(path) or os.path.getsize(path) == 0:
         return pd.DataFrame(columns=["student_id", "department_name"])
@@ -22,10 +135,8 @@ def load_students(path="uploads/students.csv", mode=None):
             .strip()                 # 前後半角スペース
         )
 
-    print(">>> after read_csv", df.shape)
     df.columns = [_normalize(c) for c in df.columns]
-    print(">>> after normalize", list(df.columns))
-    print(df.head(3))
+    telemetry.debug("学生 CSV 読込", rows=len(df), columns=list(df.columns))
     # ←★ 列名の空白除去
 
     # --- 列名自動検出 ---
@@ -38,11 +149,11 @@ def load_students(path="uploads/students.csv", mode=None):
     dept_col = pick(df.columns, ["学科名", "department_name"], "学科名")
     id_col   = pick(df.columns, ["学籍番号", "student_id"], "学籍番号")
 
-    # --- 希望列を抽出（“第一希望”などを含む列） ---
-    pref_cols = [c for c in df.columns if re.match(r"第?[一二三四]希望", c)]
+    # --- 希望列を抽出（“第一希望”“第5希望”などの列。希望順に並べる） ---
+    pref_cols = [c for c in df.columns if PREF_COLUMN.match(c)]
     if not pref_cols:
-        raise ValueError("『第一希望〜第三(四)希望』列が見つかりません")
-    pref_cols = sorted(pref_cols, key=lambda s: "一二三四".index(re.findall(r"[一二三四]", s)[0]))
+        raise ValueError("『第一希望〜第N希望』列が見つかりません")
+    pref_cols = sorted(pref_cols, key=pref_column_rank)
 
     # --- 整形 ---
     pref_list, student_dept_map = [], {}
@@ -52,15 +163,13 @@ def load_students(path="uploads/students.csv", mode=None):
         student_dept_map[sid] = dept
 
         for rank, col in enumerate(pref_cols, 1):
-            company = str(row[col]).replace("\n", " ").strip()  # 改行→空白
+            company = clean_name(row[col])  # 改行→空白
             if company and company.lower() != "nan":
                 pref_list.append({"student_id": sid,
                                   "company_name": company,
                                   "rank": rank})
 
     df_pref = pd.DataFrame(pref_list)
-    # --- 希望列を抽出（“第一希望”などを含む列） ---
-    pref_cols = [c for c in df.columns if re.match(r"第?[一二三四]希望", c)]
 
     # ✅ 中身が実質 “空” の希望列は除外
     def is_blank_series(s: pd.Series) -> bool:
@@ -69,14 +178,27 @@ def load_students(path="uploads/students.csv", mode=None):
     
     pref_cols = [c for c in pref_cols if not is_blank_series(df[c])]
 
-    # モード判定
-    mode = 4 if len(pref_cols) >= 4 else 3
-    print("pref_cols =", pref_cols)
-    print("mode =", mode)
+    # モード判定（既定のコマ数 = 希望列の数。3 未満は 3 コマ + 自由訪問）
+    mode = max(3, len(pref_cols))
+    telemetry.info("希望列を検出", pref_cols=pref_cols, mode=mode)
     return df_pref, mode, student_dept_map
 
 # --------------------- 企業 ---------------------
+# 企業ごとのキャパ（任意）。全コマ共通の列と、コマごとの列（slot_0, slot_1, … / 1コマ目, 2コマ目, …）。
+# 空欄はより粗い指定（コマ別 → 企業ごと → 画面の共通キャパ）に任せる。0 はそのコマに出展しない
+CAPACITY_COLUMNS = ["キャパ", "定員", "capacity"]
+SLOT_CAPACITY_COLUMN = re.compile(r"slot_(\d+)$|(\d+)コマ目$")
+
+
 def load_companies(path="uploads/companies.csv"):
+    """
+    company_name / department_id の DataFrame を返す（解析結果はスナップショットから）。
+    キャパ列があれば capacity / slot_0, slot_1, … 列も付ける（company_capacity_table で使う）
+    """
+    return _load_snapshot(path, "companies", _parse_companies)
+
+
+def _parse_companies(path):
     # ---- ファイルが無い／空なら「列だけある空 DataFrame」を返す ----
     if not os.path.exists(path) or os.path.getsize(path) == 0:
         return pd.DataFrame(columns=["company_name", "department_id"])
@@ -101,10 +223,147 @@ def load_companies(path="uploads/companies.csv"):
         raise ValueError("企業CSVに『企業名』または『学科名』列がありません")
     company_col, dept_col = company_col[0], dept_col[0]
 
+    # キャパ列（任意）
+    capacity_cols = {}
+    cap_col = [c for c in df.columns if c in CAPACITY_COLUMNS]
+    if cap_col:
+        capacity_cols[cap_col[0]] = "capacity"
+    for c in df.columns:
+        m = SLOT_CAPACITY_COLUMN.match(c)
+        if m:
+            slot = int(m.group(1)) if m.group(1) is not None else int(m.group(2)) - 1
+            capacity_cols[c] = f"slot_{slot}"
+
     # 整形
-    df = df[[company_col, dept_col]].copy()
-    df[company_col] = df[company_col].astype(str).str.strip()
+    df = df[[company_col, dept_col, *capacity_cols]].copy()
+    df[company_col] = df[company_col].astype(str).map(clean_name)   # 学生側と同じ整形
     df = df[df[company_col].ne("")]
     df = df.rename(columns={company_col: "company_name",
-                            dept_col: "department_id"})
-    return df
\ No newline at end of file
+                            dept_col: "department_id", **capacity_cols})
+    for src, col in capacity_cols.items():
+        values = pd.to_numeric(df[col], errors="coerce")
+        filled = df[col].notna() & df[col].astype(str).str.strip().ne("")
+        bad = filled & ~(values.ge(0) & values.mod(1).eq(0))
+        if bad.any():
+            raise ValueError(f"企業CSVの『{src}』列に 0 以上の整数でない値があります："
+                             f"{df.loc[bad, 'company_name'].tolist()[:5]}")
+        # 複数学科に出展する企業は、どこか 1 行に書いてあればその値を使う
+        df[col] = values.groupby(df["company_name"]).transform("first")
+    if capacity_cols:
+        telemetry.info("企業キャパ列を検出", columns=sorted(capacity_cols.values()))
+    return df
+
+
+def company_capacity_table(df_company, cap, num_slots, companies=None):
+    """
+    企業 -> [コマごとのキャパ]。slot_i 列 → capacity 列 → 共通キャパ cap の順で、
+    空欄でない最初の値を使う（キャパ列の無い CSV なら全企業 [cap] * num_slots）。
+    companies を渡すとその企業だけ（df_company に無い企業は共通キャパ）。
+    """
+    names = df_company["company_name"] if df_company is not None else []
+    if companies is None:
+        companies = names
+    slot_cols = [f"slot_{t}" for t in range(num_slots)]
+    cols = [c for c in ["capacity", *slot_cols] if df_company is not None and c in df_company]
+    if not cols:
+        return {c: [cap] * num_slots for c in dict.fromkeys(companies)}
+
+    given = {}
+    for rec in df_company[["company_name", *cols]].drop_duplicates("company_name").to_dict("records"):
+        default = rec["capacity"] if pd.notna(rec.get("capacity")) else cap
+        given[rec["company_name"]] = [
+            int(rec[col]) if pd.notna(rec.get(col)) else int(default) for col in slot_cols
+        ]
+    return {c: list(given.get(c, [cap] * num_slots)) for c in dict.fromkeys(companies)}
+
+# --------------------- 希望順位の点数 ---------------------
+# 配点は「希望の深さ」depth（第何希望まであるか）で決める。depth が 4 以下のときは
+# 従来の表（第1〜第4希望）と同じ点数で、深くなるほど上位の希望の点数が上がる。
+#   preference_points … 割当の目的関数・0人ブース補完（5,4,3,2 点）
+#   draw_points       … 希望割当の抽選用スコア（4,3,2,1 点）
+#   score_points      … 学生スコア（3,2,1,1 点。calc_score_from_assignment）
+# 希望外（rank が None）はどれも 0 点。
+def _depth(depth):
+    return max(depth or 0, 4)
+
+
+def preference_points(rank, depth=4):
+    return _depth(depth) + 2 - rank if rank else 0
+
+
+def draw_points(rank, depth=4):
+    return _depth(depth) + 1 - rank if rank else 0
+
+
+def score_points(rank, depth=4):
+    return max(1, _depth(depth) - rank) if rank else 0
+
+
+# --------------------- 希望インデックス ---------------------
+class PreferenceIndex:
+    """
+    希望データの索引。run_assignment で 1 回だけ構築し、各アサイナに渡す。
+    DataFrame をループ内で毎回フィルタする代わりに dict 参照 (O(1)) で引く。
+
+      student_prefs[sid]          -> [company, ...]          希望順
+      student_rank[sid]           -> {company: rank}
+      rank_companies[rank]        -> [company, ...]          出現順
+      rank_candidates[rank][c]    -> [sid, ...]              出現順
+      dept_companies[dept]        -> [company, ...]          企業CSVの行順
+      depth                       -> 希望の深さ（最大の希望順位）
+    """
+
+    def __init__(self, df_preference, df_company=None):
+        self.student_prefs = {}
+        self.student_rank = {}
+        self.rank_companies = {}
+        self.rank_candidates = {}
+        self.dept_companies = {}
+        self.depth = 0
+
+        if df_preference is not None and len(df_preference):
+            df_sorted = df_preference.sort_values("rank", kind="stable")
+            for sid, cname, rank in zip(df_sorted["student_id"],
+                                        df_sorted["company_name"],
+                                        df_sorted["rank"]):
+                rank = int(rank)
+                self.student_prefs.setdefault(sid, []).append(cname)
+                self.student_rank.setdefault(sid, {})[cname] = rank
+
+                by_company = self.rank_candidates.setdefault(rank, {})
+                if cname not in by_company:
+                    by_company[cname] = []
+                    self.rank_companies.setdefault(rank, []).append(cname)
+                by_company[cname].append(sid)
+            self.depth = max(self.rank_candidates)
+
+        if df_company is not None:
+            for cname, dept in zip(df_company["company_name"], df_company["department_id"]):
+                self.dept_companies.setdefault(dept, []).append(cname)
+
+    def ranked_companies(self, sid):
+        """学生の希望企業（希望順）"""
+        return self.student_prefs.get(sid, [])
+
+    def rank_of(self, sid, company):
+        """学生 sid にとっての company の希望順位（希望外なら None）"""
+        return self.student_rank.get(sid, {}).get(company)
+
+    def ranks(self):
+        """登場する希望順位（昇順）"""
+        return sorted(self.rank_candidates)
+
+    def companies_for_rank(self, rank):
+        return self.rank_companies.get(rank, [])
+
+    def candidates(self, rank, company):
+        """第 rank 希望に company を書いた学生（CSV 出現順）"""
+        return self.rank_candidates.get(rank, {}).get(company, [])
+
+    def companies_for_dept(self, dept):
+        return self.dept_companies.get(dept, [])
+
+
+def build_preference_index(df_preference, df_company=None):
+    """load_students / load_companies の結果から PreferenceIndex を構築"""
+    return PreferenceIndex(df_preference, df_company)
@@ -1,15 +1,12 @@
-import re, unicodedata, pandas as pd
+import pandas as pd
+import numpy as np
 
-def _norm(text: str) -> str:
-    """ 空白・改行など一切合切を取り除き、NFKC 正規化 """
-    if pd.isna(text):
-        return ""
-    # ① Unicode 正規化（全角→半角・合字解除など）
-    text = unicodedata.normalize("NFKC", str(text))
-    # ② 改行・タブ・ゼロ幅スペースなど全ホワイトスペースを1つの空白に
-    text = re.sub(r"\s+", " ", text)
-    # ③ 先頭末尾の空白を削除
-    return text.strip()
+from utils.normalizer import canonical_names, canonical_ids
+
+
+def _pair_keys(company_ids, dept_ids):
+    """(企業ID, 学科ID) を 1 つの int64 にまとめる"""
+    return (np.asarray(company_ids, dtype=np.int64) << 32) | np.asarray(dept_ids, dtype=np.int64)
 
 
 def build_diagnosis(
@@ -19,62 +16,59 @@ def build_diagnosis(
     student_dept_map: dict
 ):
     """cross_pref / cross_assign を検出"""
-    # --- 企業 → 学科（企業名＋学科でユニークに） ---
-    comp2dept = {
-        (_norm(row["company_name"]), _norm(row["department_id"])): _norm(row["department_id"])
-        for _, row in df_company.iterrows()
-    }
-
-    rows            = []
-    cross_pref_list = []   # (sid, company)
-    cross_asgn_list = []   # (sid, company)
-
-    # ---------- ① 希望判定 ----------
-    for _, r in df_pref.iterrows():
-        sid   = r["student_id"]
-        cname = _norm(r["company_name"])
-        rank  = int(r["rank"])
-        sdept = _norm(student_dept_map.get(sid, ""))
+    # --- 企業名＋学科 の組（正規化済み ID）。この組に無ければ学科外 ---
+    comp_keys = np.unique(_pair_keys(
+        canonical_ids(df_company["company_name"]),
+        canonical_ids(df_company["department_id"]),
+    ))
 
-        key      = (cname, sdept)
-        cdept    = comp2dept.get(key)       # None なら学科外
-        is_cross = key not in comp2dept
+    def _judge(sids, companies_raw):
+        depts_raw = pd.Series(sids, dtype=object).map(student_dept_map)
+        ok = np.isin(_pair_keys(canonical_ids(companies_raw), canonical_ids(depts_raw)), comp_keys)
+        sdept = canonical_names(depts_raw)
+        cname = canonical_names(companies_raw)
+        cdept = np.where(ok, sdept, None)
+        return sdept, cname, cdept, ok
 
-        if is_cross:
-            cross_pref_list.append((sid, r["company_name"]))  # 元の表記で保持
+    frames = []
 
-        rows.append({
-            "student_id"   : sid,
+    # ---------- ① 希望判定 ----------
+    pref_sids = df_pref["student_id"].to_numpy(dtype=object)
+    pref_raw  = df_pref["company_name"].to_numpy(dtype=object)
+    sdept, cname, cdept, ok = _judge(pref_sids, pref_raw)
+    cross_pref_list = list(zip(pref_sids[~ok], pref_raw[~ok]))   # 元の表記で保持
+    if len(pref_sids):
+        frames.append(pd.DataFrame({
+            "student_id"   : pref_sids,
             "student_dept" : sdept,
             "company"      : cname,
             "company_dept" : cdept,
-            "rank"         : rank,
+            "rank"         : df_pref["rank"].astype(int).to_numpy(),
             "phase"        : "preference",
-            "result"       : "cross_pref" if is_cross else "OK",
-        })
+            "result"       : np.where(ok, "OK", "cross_pref"),
+        }))
 
     # ---------- ② 割当判定 ----------
-    for sid, slots in student_schedule.items():
-        sdept = _norm(student_dept_map.get(sid, ""))
-        for slot_idx, cname_raw in enumerate(slots):
-            if cname_raw is None:
-                continue
-            cname  = _norm(cname_raw)
-            key      = (cname, sdept)
-            cdept    = comp2dept.get(key)
-            is_cross = key not in comp2dept
-            if is_cross:
-                cross_asgn_list.append((sid, cname_raw))      # 元の表記で保持
-
-            rows.append({
-                "student_id"   : sid,
-                "student_dept" : sdept,
-                "company"      : cname,
-                "company_dept" : cdept,
-                "slot"         : slot_idx,
-                "phase"        : "assignment",
-                "result"       : "cross_assign" if is_cross else "OK",
-            })
+    cells = [
+        (sid, slot_idx, cname_raw)
+        for sid, slots in student_schedule.items()
+        for slot_idx, cname_raw in enumerate(slots)
+        if cname_raw is not None
+    ]
+    asgn_sids = np.array([c[0] for c in cells], dtype=object)
+    asgn_raw  = np.array([c[2] for c in cells], dtype=object)
+    sdept, cname, cdept, ok = _judge(asgn_sids, asgn_raw)
+    cross_asgn_list = list(zip(asgn_sids[~ok], asgn_raw[~ok]))   # 元の表記で保持
+    if cells:
+        frames.append(pd.DataFrame({
+            "student_id"   : asgn_sids,
+            "student_dept" : sdept,
+            "company"      : cname,
+            "company_dept" : cdept,
+            "slot"         : np.array([c[1] for c in cells]),
+            "phase"        : "assignment",
+            "result"       : np.where(ok, "OK", "cross_assign"),
+        }))
 
-    df_diag = pd.DataFrame(rows)
+    df_diag = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame()
     return df_diag, cross_pref_list, cross_asgn_list
@@ -0,0 +1,188 @@
+# utils/flow_assigner.py
+"""
+パターン A の希望割当を最小費用流で解くエンジン（run_pattern_a(engine="flow")）。
+
+assign_preferences は第1希望から順に企業ごと・コマごとに貪欲に埋めるので、
+先に埋まったコマのせいで後の希望が入らないことがある。ここでは
+
+  ① どの学生がどの企業を訪問するか
+       source → 学生（容量 = コマ数）→ 学生×企業（容量 1 = 同じ企業は 1 回だけ）
+       → 企業（容量 = キャパ × コマ数）→ sink
+     の最大流・最小費用（費用 = 希望順位）で、希望の通る件数を最大にしたうえで
+     順位の合計を最小にする（SimpleMinCostFlow。多項式時間）。
+  ② 各訪問をどのコマにするか
+     学生 × 企業の割当を二部グラフの辺彩色（色 = コマ）として塗る。
+     企業をキャパ個に分けると両側の次数がコマ数以下になるので、
+     交互路の色の入れ替え（Kempe chain）でコマ数色で必ず塗り分けられる。
+     コマごとにキャパが違う企業（キャパ 0 のコマがある企業）は、コピーごとに
+     使えないコマがあるので塗れない訪問が出ることがある。その訪問は割り当てず、
+     後段の補完に回す。
+
+の 2 段で、学生は 1 コマ 1 社・企業は 1 コマ キャパ人以下を守ったまま
+希望の割当を全体最適にする。希望外の補完（学科マッチ補完・0人ブース補完）は
+これまでどおり run_pattern_a の Step 4 / 5 が行う。
+"""
+import random
+
+import numpy as np
+from ortools.graph.python import min_cost_flow
+
+from utils import telemetry
+from utils.data_loader import draw_points
+
+
+# 辺彩色で「このコピーはこのコマを使えない」印
+_CLOSED = object()
+
+
+def _visit_flow(students, company_caps, num_slots, pref_index, valid_set, rng):
+    """
+    ① 最小費用流で (学生, 企業, 順位) の訪問リストを求める。
+    company_caps: 企業 -> [コマごとのキャパ]
+    """
+    companies = [c for c, caps in company_caps.items() if sum(caps) > 0]
+    company_node = {c: 1 + len(students) + i for i, c in enumerate(companies)}
+    sink = 1 + len(students) + len(companies)
+
+    tails, heads, caps, costs, pairs = [], [], [], [], []
+    for i, sid in enumerate(students):
+        for company in dict.fromkeys(pref_index.ranked_companies(sid)):
+            if company not in valid_set or company not in company_node:
+                continue
+            tails.append(1 + i)
+            heads.append(company_node[company])
+            caps.append(1)
+            costs.append(pref_index.rank_of(sid, company))
+            pairs.append((sid, company))
+    if not pairs:
+        return []
+    # 同じ費用の解が複数あるときにどの学生が外れるかを固定しないよう、辺の順番を混ぜる
+    order = list(range(len(pairs)))
+    rng.shuffle(order)
+
+    smcf = min_cost_flow.SimpleMinCostFlow()
+    smcf.add_arcs_with_capacity_and_unit_cost(
+        np.array([0] * len(students) + [tails[j] for j in order]
+                 + [company_node[c] for c in companies]),
+        np.array([1 + i for i in range(len(students))] + [heads[j] for j in order]
+                 + [sink] * len(companies)),
+        np.array([num_slots] * len(students) + [caps[j] for j in order]
+                 + [sum(company_caps[c]) for c in companies]),
+        np.array([0] * len(students) + [costs[j] for j in order] + [0] * len(companies)),
+    )
+    # 供給は上限として置くだけ（流せるだけ流して、その中で費用最小）
+    smcf.set_node_supply(0, len(students) * num_slots)
+    smcf.set_node_supply(sink, -len(students) * num_slots)
+    status = smcf.solve_max_flow_with_min_cost()
+    if status != smcf.OPTIMAL:
+        telemetry.warning("最小費用流が解けません", status=str(status))
+        return []
+
+    first = len(students)
+    flows = smcf.flows(np.arange(first, first + len(order)))
+    return [(*pairs[j], costs[j]) for j, f in zip(order, flows) if f]
+
+
+def _color_slots(visits, company_caps, num_slots):
+    """
+    ② 訪問 (学生, 企業) にコマを割り振る（二部グラフの辺彩色）。
+    企業 c は最大キャパ個のコピーに分ける。コピー j が使えるのは キャパ > j のコマで、
+    辺を順番に（使えるコマ数に達したコピーは飛ばして）配る。
+    戻り値: [(学生, 企業, コマ), ...]（塗れなかった訪問は含まない）
+    """
+    left = {}                     # 学生 -> [コマごとの相手（右の頂点）]
+    right = {}                    # 企業のコピー -> [コマごとの相手（学生） / _CLOSED]
+    room = {}                     # 企業 -> [コピーごとの残り次数]
+    turn = {}                     # 企業 -> 次に配るコピー
+    edges = []
+    for sid, company, _ in visits:
+        caps = company_caps[company]
+        if company not in room:
+            room[company] = [sum(k > j for k in caps) for j in range(max(caps))]
+            turn[company] = 0
+        j = turn[company]
+        while room[company][j] == 0:
+            j = (j + 1) % len(room[company])
+        room[company][j] -= 1
+        turn[company] = (j + 1) % len(room[company])
+        v = (company, j)
+        left.setdefault(sid, [None] * num_slots)
+        right.setdefault(v, [None if k > j else _CLOSED for k in caps])
+        edges.append((sid, v))
+
+    dropped = 0
+    for u, v in edges:
+        a = left[u].index(None)
+        if right[v][a] is _CLOSED:
+            # a はこのコピーが使えないコマ → 両方空いている色、無ければ v 側で使用中の色にする
+            free_u = [t for t, w in enumerate(left[u]) if w is None]
+            a = next((t for t in free_u if right[v][t] is None),
+                     next((t for t in free_u if right[v][t] is not _CLOSED), None))
+            if a is None:
+                dropped += 1
+                continue
+        if right[v][a] is not None:
+            if None not in right[v]:
+                dropped += 1
+                continue
+            b = right[v].index(None)
+            # v から a, b 交互の路をたどって色を入れ替え、v の a を空ける
+            path, x, on_right, c = [], v, True, a
+            while True:
+                y = (right if on_right else left)[x][c]
+                if y is None or y is _CLOSED:
+                    break
+                path.append((y, x) if on_right else (x, y))
+                x, on_right, c = y, not on_right, (b if c == a else a)
+            # 入れ替え先の色が使えないコピーが路にあれば、この訪問は塗らない
+            if any(right[w][b if i % 2 == 0 else a] is _CLOSED for i, (_, w) in enumerate(path)):
+                dropped += 1
+                continue
+            for s, w in path:
+                c = left[s].index(w)
+                left[s][c] = None
+                right[w][c] = None
+            for i, (s, w) in enumerate(path):
+                c = b if i % 2 == 0 else a       # 路の辺は a, b, a, ... → b, a, b, ...
+                left[s][c] = w
+                right[w][c] = s
+        left[u][a] = v
+        right[v][a] = u
+
+    if dropped:
+        telemetry.count("flow_uncolored", dropped)
+    return [(sid, v[0], t) for sid, slots in left.items()
+            for t, v in enumerate(slots) if v is not None]
+
+
+def assign_preferences_flow(pref_index, student_schedule, student_score,
+                            student_assigned_companies, company_capacity, valid_companies,
+                            num_slots, rng=None):
+    """
+    assign_preferences（希望順の貪欲割当）の代わりに、希望の割当を
+    最小費用流 + 辺彩色でまとめて解いて student_schedule などを書き換える。
+    空いている学生（全コマ None）だけが対象。company_capacity はコマごとに違ってよい
+    （企業CSVのコマ別キャパ・差分再計算で固定した学生ぶんを引いたキャパ）。
+    コマに塗り分けられなかった訪問は割り当てず、後段の補完に回す。
+    戻り値: 割り当てた希望の件数
+    """
+    rng = rng or random
+    valid_set = set(valid_companies)
+    students = [sid for sid, slots in student_schedule.items()
+                if all(c is None for c in slots)]
+    company_caps = {c: list(company_capacity[c]) for c in dict.fromkeys(valid_companies)
+                    if c in company_capacity}
+
+    visits = _visit_flow(students, company_caps, num_slots, pref_index, valid_set, rng)
+    # 上位の希望から塗ると、貪欲法と同じく第1希望が前のコマに入りやすい
+    visits.sort(key=lambda v: v[2])
+    cells = _color_slots(visits, company_caps, num_slots)
+    for sid, company, slot in cells:
+        student_schedule[sid][slot] = company
+        student_assigned_companies[sid].add(company)
+        student_score[sid] += draw_points(pref_index.rank_of(sid, company), pref_index.depth)
+        company_capacity[company][slot] -= 1
+
+    telemetry.count("flow_assigned", len(cells))
+    telemetry.debug("希望割当完了（最小費用流）", students=len(students), assigned=len(cells))
+    return len(cells)
@@ -0,0 +1,116 @@
+# utils/jobs.py
+"""
+割当ジョブのキュー。
+/admin/run はジョブを投入して job_id を返すだけにし、重い処理は
+ProcessPoolExecutor のワーカープロセスで実行する。
+
+  submit_job(fn, *args)   -> job_id
+  get_job_status(job_id)  -> {"job_id", "status", "progress", "error"} / None
+  get_job_result(job_id)  -> fn の戻り値（完了時のみ）
+
+fn はキーワード引数 progress（学科ごとの進捗を書き込む共有 dict）を受け取ること。
+
+ジョブ表（_jobs）はこのプロセスのメモリにあるので、Web サーバーは 1 プロセスで動かすこと
+（gunicorn などで複数ワーカーにすると、投入したのと別のワーカーに届いた問い合わせは
+get_job_status が None → 404 になる）。終わったジョブは JOB_TTL 秒後にジョブ表から消す。
+"""
+import multiprocessing
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+# schedule.csv などの出力ファイルを共有するので、既定では 1 ジョブずつ順番に処理する
+JOB_WORKERS = 1
+# 終わったジョブの状態・結果を残しておく秒数（過ぎたら次の投入・問い合わせのときに消す）
+JOB_TTL = 3600
+
+_lock = threading.Lock()
+_executor = None
+_manager = None
+_jobs = {}   # job_id -> {"future", "progress", "submitted_at", "finished_at"}
+
+
+def _ensure_started():
+    global _executor, _manager
+    if _executor is None:
+        # Flask のスレッドを抱えたまま fork しないよう spawn で起動
+        ctx = multiprocessing.get_context("spawn")
+        _manager = ctx.Manager()
+        _executor = ProcessPoolExecutor(max_workers=JOB_WORKERS, mp_context=ctx)
+
+
+def _evict_expired(now=None):
+    """終わってから JOB_TTL 秒たったジョブをジョブ表から消す（_lock を持って呼ぶ）"""
+    now = time.time() if now is None else now
+    expired = [job_id for job_id, job in _jobs.items()
+               if job["finished_at"] is not None and now - job["finished_at"] > JOB_TTL]
+    for job_id in expired:
+        del _jobs[job_id]
+
+
+def _get_job(job_id):
+    """ジョブ表から引く。終わったジョブは進捗をただの dict に写して Manager の共有 dict を手放す"""
+    with _lock:
+        _evict_expired()
+        job = _jobs.get(job_id)
+        if job is not None and job["future"].done() and not isinstance(job["progress"], dict):
+            job["progress"] = dict(job["progress"])
+    return job
+
+
+def submit_job(fn, *args, **kwargs):
+    """ジョブを投入して job_id を返す（待たない）"""
+    with _lock:
+        _evict_expired()
+        _ensure_started()
+        job_id = uuid.uuid4().hex[:12]
+        progress = _manager.dict()
+        future = _executor.submit(fn, *args, progress=progress, **kwargs)
+        job = {
+            "future": future,
+            "progress": progress,
+            "submitted_at": time.time(),
+            "finished_at": None,
+        }
+        _jobs[job_id] = job
+    future.add_done_callback(lambda _f: job.update(finished_at=time.time()))
+    return job_id
+
+
+def get_job_status(job_id):
+    job = _get_job(job_id)
+    if job is None:
+        return None
+
+    future = job["future"]
+    progress = dict(job["progress"])
+    error = None
+    if future.done():
+        exc = future.exception()
+        status = "failed" if exc else "done"
+        error = repr(exc) if exc else None
+    elif progress.get("_state") == "running":
+        status = "running"
+    else:
+        status = "queued"
+
+    total = progress.pop("_total", None)
+    progress.pop("_state", None)
+    finished = sum(1 for v in progress.values() if v != "running")
+    return {
+        "job_id": job_id,
+        "status": status,
+        "departments_total": total,
+        "departments_finished": finished,
+        "progress": progress,      # {dept: "running" / "done(A)" / "done(B)" / "skipped"}
+        "error": error,
+        "elapsed_sec": round((job["finished_at"] or time.time()) - job["submitted_at"], 1),
+    }
+
+
+def get_job_result(job_id):
+    job = _get_job(job_id)
+    if job is None or not job["future"].done():
+        return None
+    return job["future"].result()
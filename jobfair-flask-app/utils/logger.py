@@ -1,5 +1,7 @@
 import math
 
+from utils.schedule import Schedule
+
 def is_real_company(val):
     """None / NaN / '自由訪問枠' を除いた企業名のみ対象"""
     return isinstance(val, str) and val != "自由訪問枠"
@@ -14,10 +16,9 @@ def check_schedule_violations(student_schedule, company_capacity=None):
         if duplicates:
             logs.append(f"⚠️ {sid}: 同一企業が複数スロットに割り当てられています → {assigned}")
 
-        # --- 希望枠数の自動判定（3 or 4枠） ---
+        # --- 希望枠数の自動判定（コマ数。最後のコマが自由訪問枠ならそれを除く） ---
         slot_len = len(slots)
-        is_mode3 = (slot_len == 4 and slots[3] == "自由訪問枠") or slot_len == 3
-        required_slots = 3 if is_mode3 else 4
+        required_slots = slot_len - 1 if slot_len and slots[-1] == "自由訪問枠" else slot_len
 
         # --- 希望枠に未割当があるかチェック ---
         has_empty = any(
@@ -30,18 +31,29 @@ def check_schedule_violations(student_schedule, company_capacity=None):
     return logs
 
 # --- 会社側：空きスロット検出 ---------------------------------
-def find_company_zero_slots(student_schedule, valid_companies, num_slots=4):
-    """企業×時間帯で割当ゼロのスロットを返す [(company, slot), ...]"""
-    count = {(c, s): 0 for c in valid_companies for s in range(num_slots)}
+# ※ 以下の検出関数は dict（sid -> [slot0, ...]）と utils.schedule.Schedule の両方を受け付ける。
+#    Schedule を渡すと保持している人数カウンタから配列演算で求める。
+def find_company_zero_slots(student_schedule, valid_companies, num_slots=4, capacity=None):
+    """
+    企業×時間帯で割当ゼロのスロットを返す [(company, slot), ...]
+    capacity（企業 -> コマごとのキャパ）を渡すと、キャパ 0 のコマ（出展しないコマ）は除く
+    （割当ゼロのコマは残キャパ = 元のキャパなので、割当後の残キャパを渡してもよい）
+    """
+    if isinstance(student_schedule, Schedule):
+        return student_schedule.company_zero_slots(valid_companies, capacity)
+    count = {(c, s): 0 for c in valid_companies for s in range(num_slots)
+             if capacity is None or c not in capacity or capacity[c][s] > 0}
     for slots in student_schedule.values():
         for s, c in enumerate(slots):
-            if c and c in valid_companies:
+            if c and (c, s) in count:
                 count[(c, s)] += 1
     return [k for k, v in count.items() if v == 0]
 
 # --- 会社側：割当数サマリ ---------------------------------------
 def summarize_company_assignments(student_schedule, valid_companies, num_slots=4):
     """各企業・各スロットの割当人数を返す dict[c] -> [slot0, slot1, ...]"""
+    if isinstance(student_schedule, Schedule):
+        return student_schedule.summarize(valid_companies)
     summary = {c: [0] * num_slots for c in valid_companies}
     for slots in student_schedule.values():
         for s, c in enumerate(slots):
@@ -52,11 +64,15 @@ def summarize_company_assignments(student_schedule, valid_companies, num_slots=4
 # --- 学生側：0訪問検出 -----------------------------------------
 def find_zero_visit_students(student_schedule):
     """全コマ None の学生IDを返す [sid, ...]"""
+    if isinstance(student_schedule, Schedule):
+        return student_schedule.zero_visit_students()
     return [sid for sid, slots in student_schedule.items() if all(v is None for v in slots)]
 
 # --- 学生側：不足コマ検出（パターンB用） -------------------------
 def find_underfilled_students(student_schedule, max_slots):
     """max_slots 未満しか割り当てられていない学生IDを返す [sid, ...]"""
+    if isinstance(student_schedule, Schedule):
+        return student_schedule.underfilled_students(max_slots)
     return [sid for sid, slots in student_schedule.items()
             if sum(v is not None for v in slots) < max_slots]
 
@@ -66,6 +82,8 @@ def find_discontinuous_students(student_schedule):
     連続していないコマが含まれる学生IDを返す [sid, ...]
     例) max_slots=2 なら 1–3, 1–4, 2–4 などが NG
     """
+    if isinstance(student_schedule, Schedule):
+        return student_schedule.discontinuous_students()
     bad = []
     for sid, slots in student_schedule.items():
         filled_idx = [i for i, v in enumerate(slots) if v is not None]
@@ -0,0 +1,88 @@
+# utils/metrics.py
+"""
+割当結果の品質指標（ソルバーの比較・回帰チェック用）。
+
+  preference_score      希望スコアの合計（calc_score_from_assignment と同じ配点）
+  first_choice_rate     第1希望の企業に割り当てられた学生の割合
+  matched_rate          いずれかの希望企業に割り当てられた学生の割合
+  filled_cells          埋まったコマ数
+  zero_booths           企業×コマで割当 0 人の数（utils.logger.find_company_zero_slots）
+  zero_visit_students   1 コマも割り当てられていない学生数（find_zero_visit_students）
+  underfilled_students  max_slots 未満の学生数（find_underfilled_students）
+  discontinuous_students 飛びコマのある学生数（find_discontinuous_students）
+
+HIGHER_IS_BETTER / LOWER_IS_BETTER で指標ごとの良し悪しの向きを持つ。
+quality_key は複数エンジンの結果から 1 つ選ぶときの共通の比較キー（utils.portfolio）。
+"""
+from utils.logger import (
+    find_company_zero_slots, find_zero_visit_students, find_underfilled_students,
+    find_discontinuous_students,
+)
+from utils.schedule import Schedule
+from utils.strict_assigner import calc_score_from_assignment
+
+HIGHER_IS_BETTER = ("preference_score", "first_choice_rate", "matched_rate", "filled_cells")
+LOWER_IS_BETTER = ("zero_booths", "zero_visit_students", "underfilled_students",
+                   "discontinuous_students")
+# quality_key で比べる順（先の指標ほど優先）
+QUALITY_ORDER = ("zero_visit_students", "underfilled_students", "preference_score",
+                 "zero_booths", "discontinuous_students", "filled_cells")
+
+
+def schedule_metrics(student_schedule, pref_index, companies, num_slots, max_slots=None,
+                     capacity=None):
+    """
+    student_schedule: sid -> [slot0, ...]
+    companies: 0人ブースを数える対象の企業（学科対応企業など）
+    max_slots: 1 人あたりの目標コマ数（省略時は num_slots）
+    capacity: 企業 -> コマごとのキャパ（残キャパでもよい）。キャパ 0 のコマは 0人ブースに数えない
+    """
+    companies = list(dict.fromkeys(companies))
+    sched = Schedule.from_dict(student_schedule, companies, num_slots)
+    scores = calc_score_from_assignment(student_schedule, None, pref_index)
+
+    first_hit = matched = with_prefs = 0
+    for sid, slots in student_schedule.items():
+        ranks = pref_index.student_rank.get(sid)
+        if not ranks:
+            continue
+        with_prefs += 1
+        got = [ranks.get(c) for c in slots if c is not None]
+        first_hit += 1 in got
+        matched += any(r is not None for r in got)
+
+    return {
+        "preference_score": sum(scores.values()),
+        "first_choice_rate": round(first_hit / with_prefs, 4) if with_prefs else 0.0,
+        "matched_rate": round(matched / with_prefs, 4) if with_prefs else 0.0,
+        "filled_cells": int(sched.filled.sum()),
+        "zero_booths": len(find_company_zero_slots(sched, companies, num_slots, capacity)),
+        "zero_visit_students": len(find_zero_visit_students(sched)),
+        "underfilled_students": len(find_underfilled_students(sched, max_slots or num_slots)),
+        "discontinuous_students": len(find_discontinuous_students(sched)),
+    }
+
+
+def compare_metrics(current, baseline, tolerance=0.0):
+    """
+    baseline より悪くなった指標を [(指標, baseline, current), ...] で返す。
+    tolerance は比率の許容幅（0.01 なら 1% までの悪化は許す）。
+    """
+    worse = []
+    for key in HIGHER_IS_BETTER:
+        if key in current and key in baseline:
+            if current[key] < baseline[key] - abs(baseline[key]) * tolerance:
+                worse.append((key, baseline[key], current[key]))
+    for key in LOWER_IS_BETTER:
+        if key in current and key in baseline:
+            if current[key] > baseline[key] + abs(baseline[key]) * tolerance:
+                worse.append((key, baseline[key], current[key]))
+    return worse
+
+
+def quality_key(metrics):
+    """
+    大きいほど良い比較キー（タプル）。0訪問学生 → max_slots 未満の学生 → 希望スコア
+    → 0人ブース → 飛びコマ → 埋まったコマ数 の順に辞書式で比べる。
+    """
+    return tuple(-metrics[k] if k in LOWER_IS_BETTER else metrics[k] for k in QUALITY_ORDER)
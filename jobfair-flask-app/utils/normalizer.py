@@ -0,0 +1,117 @@
+# utils/normalizer.py
+"""
+企業名・学科名の正規化をまとめたモジュール。
+
+各モジュールで別々に書いていた正規化をここに集め、生の表記ごとに結果を
+キャッシュする（同じ表記は 1 プロセスで 1 回しか正規化しない）。
+正規化後の名前には整数 ID を振るので、ループ内では文字列ではなく ID で比較できる。
+
+  clean_name(raw)      CSV 読込時の整形（改行→空白・前後空白除去）        data_loader
+  canonical_name(raw)  NFKC 正規化 + 空白の畳み込み（表記ゆれの吸収）      diagnoser
+  group_name(raw)      「〜科 / 〜学科」以降を落とした企業のまとめ名       cross_adjuster
+  canonical_id / group_id          上の名前に振った整数 ID
+  canonical_names / canonical_ids  列（Series / 配列）版。ユニーク値だけ処理する
+"""
+import re
+import unicodedata
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+
+# 表記の種類は企業数程度なので、通常は全件がキャッシュに収まる
+_CACHE_SIZE = 1 << 16
+
+
+def _is_missing(raw) -> bool:
+    """None / NaN / pd.NA（欠損はキャッシュに入れない）"""
+    return raw is None or (not isinstance(raw, str) and bool(pd.isna(raw)))
+
+
+class _Interner:
+    """名前 → 整数 ID（登録順に 0, 1, 2, ...）"""
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+
+    def __call__(self, name: str) -> int:
+        i = self.ids.get(name)
+        if i is None:
+            i = self.ids[name] = len(self.names)
+            self.names.append(name)
+        return i
+
+
+_CANONICAL = _Interner()
+_GROUP = _Interner()
+
+
+# ---------------- 名前 ----------------
+@lru_cache(maxsize=_CACHE_SIZE, typed=True)
+def clean_name(raw) -> str:
+    """CSV のセル → 企業名（改行は空白に、前後の空白は除去）"""
+    return str(raw).replace("\n", " ").strip()
+
+
+def canonical_name(raw) -> str:
+    """ 空白・改行など一切合切を取り除き、NFKC 正規化 """
+    if _is_missing(raw):
+        return ""
+    return _canonical_name(raw)
+
+
+@lru_cache(maxsize=_CACHE_SIZE, typed=True)
+def _canonical_name(raw) -> str:
+    # ① Unicode 正規化（全角→半角・合字解除など）
+    text = unicodedata.normalize("NFKC", str(raw))
+    # ② 改行・タブ・ゼロ幅スペースなど全ホワイトスペースを1つの空白に
+    text = re.sub(r"\s+", " ", text)
+    # ③ 先頭末尾の空白を削除
+    return text.strip()
+
+
+def group_name(raw) -> str:
+    """Normalize company name for grouping"""
+    if raw is None:
+        return ""
+    return _group_name(raw)
+
+
+@lru_cache(maxsize=_CACHE_SIZE, typed=True)
+def _group_name(raw) -> str:
+    name = str(raw).strip()
+    # remove any department style suffix
+    return re.sub(r"(科|学科).*", "", name)
+
+
+# ---------------- 整数 ID ----------------
+def canonical_id(raw) -> int:
+    return _CANONICAL(canonical_name(raw))
+
+
+def group_id(raw) -> int:
+    return _GROUP(group_name(raw))
+
+
+def name_of(cid: int) -> str:
+    """canonical_id → 正規化後の名前"""
+    return _CANONICAL.names[cid]
+
+
+# ---------------- 列版 ----------------
+def _map_unique(values, func, missing_value):
+    codes, uniques = pd.factorize(pd.Series(values, dtype=object), use_na_sentinel=True)
+    table = [func(v) for v in uniques]
+    table.append(missing_value)          # code = -1（欠損）は末尾を引く
+    return np.asarray(table, dtype=object)[codes]
+
+
+def canonical_names(values) -> np.ndarray:
+    """canonical_name の列版"""
+    return _map_unique(values, canonical_name, "")
+
+
+def canonical_ids(values) -> np.ndarray:
+    """canonical_id の列版（int64 配列）"""
+    return _map_unique(values, canonical_id, canonical_id(None)).astype(np.int64)
@@ -0,0 +1,849 @@
+# utils/pipeline.py
+"""
+割当パイプライン本体（/admin/run から切り出し）。
+Flask の request / session には依存しないので、ジョブ用のワーカープロセスでも
+そのまま実行できる。進捗は progress（dict 互換）に学科単位で書き込む。
+"""
+import hashlib
+import json
+import multiprocessing
+import os
+import pickle
+import random
+import sqlite3
+from collections import defaultdict
+from contextlib import closing
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+from utils.data_loader import (
+    load_students, load_companies, build_preference_index, file_hash, company_capacity_table,
+)
+from utils.logger import (
+    find_company_zero_slots, find_zero_visit_students, find_underfilled_students,
+    summarize_company_assignments, find_discontinuous_students,
+)
+from utils.schedule import Schedule
+from utils.assigner import run_pattern_a, assign_zero_slots_by_score_with_replace_safe_loop
+from utils.strict_assigner import calc_score_from_assignment, run_strict_scheduler
+from utils.cross_adjuster import adjust_overflow_assignments
+from utils.strict_assigner_cp import run_strict_scheduler_cp
+from utils.redistributor import fill_remaining_gaps
+from utils.diagnoser import build_diagnosis
+from utils.portfolio import solve_department_portfolio
+from utils.result_store import (
+    connect, save_run, save_events, find_run, copy_run, get_run,
+    schedule_frame, diagnosis_frame, step_log_lines,
+)
+from utils import telemetry
+
+# 学科並列数（1 なら従来どおり逐次実行）と、CP-SAT 1 回あたりの探索スレッド数
+DEPT_WORKERS = 1
+CP_SAT_WORKERS = 8
+# CP-SAT は希望企業 + 補完候補だけ変数を作る sparse モデルで解く（解なしなら dense で再実行）
+CP_SAT_SPARSE = True
+# 貪欲法の割当を CP-SAT の解ヒントとして渡す（warm start）
+CP_SAT_WARM_START = True
+# パターン A の希望割当の既定の解き方（"greedy" = 希望順の貪欲法 / "flow" = 最小費用流）。
+# 実行ごとには run_assignment_pipeline(engine=...) で指定する
+PATTERN_A_ENGINE = "greedy"
+# 学科ごとの制限時間（秒）の既定値。指定すると複数のエンジンを別プロセスで競争させ、
+# 期限までに終わった中で品質の最もよい結果を使う（utils.portfolio）。None なら 1 エンジンで解く。
+# 実行ごとには run_assignment_pipeline(portfolio_budget=...) で指定する
+PORTFOLIO_BUDGET = None
+# 差分再計算用に前回の入力と学科ごとの結果を保存するファイル
+LAST_RUN_PATH = "last_run.pkl"
+# 結果キャッシュのキーに含める版（割当ロジックを変えて結果が変わるときに上げる）
+CACHE_VERSION = 1
+
+
+def _report(progress, key, value):
+    """progress が渡されていれば進捗を書き込む"""
+    if progress is not None:
+        progress[key] = value
+
+
+def _progress_label(result):
+    return "skipped" if result["skipped"] else f"done({result['pattern']})"
+
+
+def derive_rng(seed, *labels):
+    """
+    実行シードと用途（学科名など）から独立した random.Random を作る。
+    学科ごとに別の乱数列になるので、学科を解く順番や並列数で結果が変わらない。
+    """
+    return random.Random(":".join(str(v) for v in (seed, *labels)))
+
+
+def run_cache_key(path_students, path_companies, cap, seed, num_slots=None, pref_depth=None,
+                  engine=PATTERN_A_ENGINE, portfolio_budget=PORTFOLIO_BUDGET):
+    """
+    入力ファイルの内容・シード・パラメータから結果キャッシュのキーを作る。
+    学科の並列数（dept_workers）は学科ごとの乱数が学科名から決まり結果を変えないので含めない。
+    portfolio_budget を指定した実行は、どのエンジンが期限内に終わるかで結果が変わるので
+    キャッシュしない（None を返す）
+    """
+    if seed is None or not (os.path.exists(path_students) and os.path.exists(path_companies)):
+        return None
+    if portfolio_budget:
+        return None
+    h = hashlib.sha1()
+    for part in (CACHE_VERSION, file_hash(path_students), file_hash(path_companies), seed, cap,
+                 CP_SAT_WORKERS, CP_SAT_SPARSE, CP_SAT_WARM_START,
+                 engine, num_slots, pref_depth):
+        h.update(f"{part}\0".encode())
+    return h.hexdigest()
+
+
+def solve_department(dept, sids, df_orig_pref_dept, df_dept_company, pref_index,
+                     student_dept_map, cap, NUM_SLOTS, cp_workers=CP_SAT_WORKERS,
+                     fixed_schedule=None, log_level=None, seed=None, engine=PATTERN_A_ENGINE,
+                     portfolio_budget=PORTFOLIO_BUDGET):
+    """
+    1 学科分の割当。計測レコードは result["events"] に入れて返す
+    （別プロセスで実行したときもパイプライン側でまとめて保存できるように）。
+    seed（実行シード）を渡すと、学科ごとに derive_rng(seed, dept) の乱数で割り当てる。
+    engine はパターン A の希望割当の解き方（greedy / flow）、portfolio_budget を指定すると
+    学科ごとにその秒数でエンジンを競争させる（utils.portfolio）。
+    """
+    rng = derive_rng(seed, dept) if seed is not None else None
+    cp_seed = derive_rng(seed, dept, "cp").randrange(2**31) if seed is not None else None
+    with telemetry.collect(log_level, dept=dept) as rec:
+        with telemetry.phase("dept_total", students=len(sids)):
+            result = _solve_department(
+                dept, sids, df_orig_pref_dept, df_dept_company, pref_index,
+                student_dept_map, cap, NUM_SLOTS, cp_workers, fixed_schedule,
+                rng, cp_seed, engine, portfolio_budget,
+            )
+    result["events"] = rec.records
+    return result
+
+
+def _solve_department(dept, sids, df_orig_pref_dept, df_dept_company, pref_index,
+                      student_dept_map, cap, NUM_SLOTS, cp_workers=CP_SAT_WORKERS,
+                      fixed_schedule=None, rng=None, cp_seed=None, engine=PATTERN_A_ENGINE,
+                      portfolio_budget=PORTFOLIO_BUDGET):
+    """
+    1 学科分の割当（パターン A / B の判定 → 割当 → 0人ブース補完 → 診断）。
+    学科ごとに学生が重ならないので、学科単位で別プロセスに並列実行できる。
+    df_orig_pref_dept はこの学科の学生の希望（学科外企業の希望も含む）。
+    fixed_schedule（差分再計算時）に入っている学生は前回の割当を動かさない。
+    rng はパターン A の抽選・補完、cp_seed は CP-SAT の乱数シードに使う。
+
+    戻り値: {"dept", "pattern", "skipped", "schedule", "score", "assigned",
+             "filled4", "filled5", "reasons", "log", "diag"}
+      schedule は配列版の割当表（utils.schedule.Schedule）
+    """
+    # ① 学科対応企業（df_dept_company）の社数と、企業ごと・コマごとのキャパ
+    company_count   = df_dept_company["company_name"].nunique()   # ← 重複行は1社扱い
+    dept_capacity   = company_capacity_table(df_dept_company, cap, NUM_SLOTS)
+
+    # ② 学科の学生希望を抽出（学科対応企業のみ）
+    valid_companies = pref_index.companies_for_dept(dept)
+    df_dept_pref    = df_orig_pref_dept[
+        df_orig_pref_dept["company_name"].isin(valid_companies)
+    ]
+
+    # ③ キャパと需要（いちばん席の少ないコマで全員が座れるか）
+    slot_capacity  = [sum(caps[t] for caps in dept_capacity.values()) for t in range(NUM_SLOTS)]
+    total_capacity = min(slot_capacity, default=0)
+    max_demand     = len(sids)
+
+    # ④ 判定
+    pattern = "A" if total_capacity > max_demand else "B"
+    result = {"dept": dept, "pattern": pattern, "skipped": False}
+
+    # ⑤ パターン判定の記録
+    telemetry.info("パターン判定", companies=company_count, students=len(sids),
+                   total_capacity=total_capacity, slot_capacity=slot_capacity,
+                   demand=max_demand, pattern=pattern)
+            # 余裕ゼロ or 足りない
+
+    if pattern == "A":
+        with telemetry.phase("pattern_a"):
+            if portfolio_budget:
+                out = solve_department_portfolio(
+                    "A", portfolio_budget, df_dept_pref, df_dept_company, sids, dept,
+                    student_dept_map, cap, NUM_SLOTS, pref_index,
+                    fixed_schedule=fixed_schedule, rng=rng,
+                )
+            else:
+                out = run_pattern_a(
+                    df_dept_pref, df_dept_company, sids, dept, student_dept_map, cap, NUM_SLOTS,
+                    pref_index=pref_index, fixed_schedule=fixed_schedule, rng=rng,
+                    engine=engine,
+                )
+            schedule, score, assigned, capacity, filled4, filled5, reasons = out
+        locked = set(fixed_schedule or ())
+        # 0人ブース補完（学科内の学生だけで行う → 学科間で独立に並列実行できる）
+        with telemetry.phase("zero_slot_repair"):
+            filled_zero_slots, remaining_zero_slots = assign_zero_slots_by_score_with_replace_safe_loop(
+                schedule, score, df_orig_pref_dept,
+                capacity, valid_companies, NUM_SLOTS, pref_index=pref_index, locked=locked
+            )
+        telemetry.count("zero_slot_filled", filled_zero_slots)
+        telemetry.count("zero_slot_remaining", len(remaining_zero_slots))
+        if remaining_zero_slots:
+            # 画面やログに警告を出す
+            telemetry.warning("どうしても0人の企業・スロットがあります",
+                              booths=remaining_zero_slots)
+
+        with telemetry.phase("gap_fill"):
+            gap_filled = fill_remaining_gaps(
+                {sid: slots for sid, slots in schedule.items() if sid not in locked},
+                capacity, NUM_SLOTS,
+            )
+        underfilled = find_underfilled_students(schedule, NUM_SLOTS)
+        telemetry.count("gap_filled", gap_filled)
+        telemetry.count("underfilled_students", len(underfilled))
+
+
+        valid_set = set(valid_companies)
+        matched_cnt = sum(
+            1 for sid in sids
+            if any(
+                c in valid_set and pref_index.rank_of(sid, c) is not None
+                for c in schedule[sid]
+            )
+        )
+        telemetry.count("matched_students", matched_cnt)
+        # -----------------------------------------------
+        dept_log = {"step4": filled4, "step5": filled5}
+
+        with telemetry.phase("diagnosis"):
+            df_diag_dept, cross_pref_list, cross_assign_list = build_diagnosis(
+                df_orig_pref_dept,   # ← フィルタしない元の希望 DF
+                schedule,
+                df_dept_company,      # 割当学科の企業 DF
+                student_dept_map
+            )
+
+
+        # ログ出力や集計
+        if cross_pref_list:
+            telemetry.info("学科外を希望した学生がいます", count=len(cross_pref_list),
+                           students=sorted(set(sid for sid, _ in cross_pref_list)))
+        if cross_assign_list:
+            telemetry.warning("学科外割当があります", count=len(cross_assign_list),
+                              sample=cross_assign_list[:10])
+
+
+
+        # ---- 集計 ----
+        cross_pref_cnt   = len(cross_pref_list)
+        cross_assign_cnt = len(cross_assign_list)
+
+        dept_log.update({
+            "step4"        : filled4,
+            "step5"        : filled5,
+            "cross_pref"   : cross_pref_cnt,
+            "cross_assign" : cross_assign_cnt,
+        })
+
+
+        # 以降の集計は配列版の割当表から 1 回で求める
+        sched_arr = Schedule.from_dict(schedule, valid_companies, NUM_SLOTS)
+
+        _check_department(sched_arr, valid_companies, NUM_SLOTS, dept_capacity)
+
+    if pattern == "B":
+
+        # ③ キャパと需要
+        total_capacity = sum(sum(caps) for caps in dept_capacity.values())   # ← 全コマの合計
+        max_demand     = len(sids)
+
+        # ④ 初期 max_slots を計算
+        initial_max_slots = total_capacity // max_demand    # 整数割
+        if initial_max_slots < 1:
+            telemetry.warning("キャパ不足で全員 1 コマも確保できません。CP-SATはスキップ")
+            # schedule を None だけで埋めて終わる
+            schedule = {sid: [None] * NUM_SLOTS for sid in sids}
+            capacity = company_capacity_table(df_dept_company, cap, NUM_SLOTS, valid_companies)
+            unassigned = list(sids)
+            # あとは従来のログ処理へ
+            ...
+            result["skipped"] = True
+            return result      # 次の学科へ
+
+
+        cp_stats = {}
+        hint = None
+        if portfolio_budget:
+            # CP-SAT と貪欲法（strict_assigner）を競争させる（CP-SAT の統計は子プロセス側で記録）
+            try:
+                with telemetry.phase("pattern_b_portfolio"):
+                    schedule, capacity, unassigned = solve_department_portfolio(
+                        "B", portfolio_budget, df_dept_pref, df_dept_company, sids, dept,
+                        student_dept_map, cap, NUM_SLOTS, pref_index,
+                        max_slots=initial_max_slots, fixed_schedule=fixed_schedule,
+                        cp_workers=cp_workers, sparse=CP_SAT_SPARSE, cp_seed=cp_seed,
+                    )
+            except Exception as e:
+                telemetry.error("ポートフォリオ実行エラー", error=repr(e))
+                schedule = {sid: [None] * NUM_SLOTS for sid in sids}
+                capacity = company_capacity_table(df_dept_company, cap, NUM_SLOTS, valid_companies)
+                unassigned = list(sids)
+        else:
+            # ★ CP-SAT 呼び出し
+            if CP_SAT_WARM_START:
+                # 貪欲法（strict_assigner）の割当を CP-SAT の初期解ヒントにする
+                with telemetry.phase("pattern_b_hint"):
+                    hint, _, _ = run_strict_scheduler(
+                        df_dept_pref, df_dept_company, sids, dept, cap, NUM_SLOTS,
+                        pref_index=pref_index,
+                    )
+            try:
+                with telemetry.phase("pattern_b_cp_sat"):
+                    schedule, capacity, unassigned = run_strict_scheduler_cp(
+                        df_dept_pref, df_dept_company, sids,
+                    dept, cap, NUM_SLOTS,
+                    max_slots=initial_max_slots,
+                    pref_index=pref_index,
+                    num_workers=cp_workers,
+                    sparse=CP_SAT_SPARSE,
+                    stats=cp_stats,
+                    hint_schedule=hint,
+                    fixed_schedule=fixed_schedule,
+                    random_seed=cp_seed,
+                    )
+                    if fixed_schedule and len(unassigned) == len(sids):
+                        # 固定した割当のままでは解けない → 学科全体を解き直す
+                        telemetry.warning("固定割当では解なし → 学科全体を再計算")
+                        schedule, capacity, unassigned = run_strict_scheduler_cp(
+                            df_dept_pref, df_dept_company, sids,
+                            dept, cap, NUM_SLOTS,
+                            max_slots=initial_max_slots,
+                            pref_index=pref_index,
+                            num_workers=cp_workers,
+                            sparse=CP_SAT_SPARSE,
+                            stats=cp_stats,
+                            hint_schedule=hint,
+                            random_seed=cp_seed,
+                        )
+            except Exception as e:
+                telemetry.error("CP-SATエラー", error=repr(e))
+                schedule = {sid: [None] * NUM_SLOTS for sid in sids}
+                capacity = company_capacity_table(df_dept_company, cap, NUM_SLOTS, valid_companies)
+                unassigned = list(sids)
+            telemetry.record("cp_sat", **cp_stats)
+
+
+        # ---- 旧ヒューリスティック系は呼ばない ----
+        telemetry.count("unassigned_students", len(unassigned))
+
+        # ④ ここで最終スコアを再計算
+        score = calc_score_from_assignment(schedule, df_orig_pref_dept, pref_index)
+
+        # 統一の出力形式に合わせて辞書更新
+        assigned = {
+            sid: set(c for c in schedule[sid] if c not in [None, ""])
+            for sid in sids
+        }
+
+        filled4, filled5, reasons = 0, 0, {}
+        result["cp_stats"] = cp_stats
+
+        valid_set = set(valid_companies)
+        matched_cnt = sum(
+            1 for sid in sids
+            if any(
+                c in valid_set and pref_index.rank_of(sid, c) is not None
+                for c in schedule[sid]
+            )
+        )
+        telemetry.count("matched_students", matched_cnt)
+
+        dept_log = {"step4": filled4, "step5": filled5}
+
+        with telemetry.phase("diagnosis"):
+            df_diag_dept, cross_pref_list, cross_assign_list = build_diagnosis(
+                df_orig_pref_dept,
+                schedule,
+                df_dept_company,
+                student_dept_map
+            )
+
+        cross_pref_cnt   = len(cross_pref_list)
+        cross_assign_cnt = len(cross_assign_list)
+        dept_log.update({
+            "step4"        : filled4,
+            "step5"        : filled5,
+            "cross_pref"   : cross_pref_cnt,
+            "cross_assign" : cross_assign_cnt,
+        })
+
+
+        # 以降の集計は配列版の割当表から 1 回で求める
+        sched_arr = Schedule.from_dict(schedule, valid_companies, NUM_SLOTS)
+
+        _check_department(sched_arr, valid_companies, NUM_SLOTS, dept_capacity)
+
+        # --- 学生側 max_slots 未満（パターンBのみ） ----------
+        if pattern == "B":
+            # strict_assigner と同じ式で再計算
+            import math
+            dept_total = sum(sum(dept_capacity.get(c, [cap] * NUM_SLOTS)) for c in valid_companies)
+            max_slots = min(NUM_SLOTS, math.floor(dept_total / len(sids)))
+            underfill = find_underfilled_students(sched_arr, max_slots)
+            telemetry.count("underfilled_students", len(underfill))
+            if underfill:
+                telemetry.warning("max_slots 未満の学生がいます", max_slots=max_slots,
+                                  count=len(underfill), sample=underfill[:10])
+
+        disc = find_discontinuous_students(sched_arr)
+        telemetry.count("discontinuous_students", len(disc))
+        if disc:
+            telemetry.warning("飛びコマ学生がいます", count=len(disc), sample=disc[:10])
+
+        # ログ出力や集計 (B版)
+        if cross_pref_list:
+            telemetry.info("学科外を希望した学生がいます", count=len(cross_pref_list),
+                           students=sorted(set(sid for sid, _ in cross_pref_list)))
+        if cross_assign_list:
+            telemetry.warning("学科外割当があります", count=len(cross_assign_list),
+                              sample=cross_assign_list[:10])
+
+    telemetry.count("cross_pref", len(cross_pref_list))
+    telemetry.count("cross_assign", len(cross_assign_list))
+    result.update({
+        "schedule": sched_arr,
+        "score": score,
+        "assigned": assigned,
+        "filled4": filled4,
+        "filled5": filled5,
+        "reasons": reasons,
+        "log": dept_log,
+        "diag": df_diag_dept,
+    })
+    return result
+
+
+def _check_department(sched_arr, valid_companies, num_slots, capacity=None):
+    """
+    学科の割当結果の検査（企業側 0人スロット・0訪問学生）をカウンタとログに出す。
+    capacity（企業 -> コマごとのキャパ）でキャパ 0 のコマは 0人スロットに数えない
+    """
+    zero_slots = find_company_zero_slots(sched_arr, valid_companies, num_slots, capacity)
+    telemetry.count("company_zero_slots", len(zero_slots))
+    if zero_slots:
+        telemetry.warning("企業側 0人スロットがあります", count=len(zero_slots),
+                          sample=zero_slots[:10])
+    if telemetry.enabled("debug"):
+        for cname, counts in summarize_company_assignments(
+                sched_arr, valid_companies, num_slots).items():
+            telemetry.debug("企業別割当数", company=cname, assigned=counts)
+
+    zero_visit = find_zero_visit_students(sched_arr)
+    telemetry.count("zero_visit_students", len(zero_visit))
+    if zero_visit:
+        telemetry.warning("0訪問学生がいます", count=len(zero_visit), sample=zero_visit[:10])
+
+
+def _input_fingerprint(dept_to_students, pref_index, capacity=None):
+    """
+    学科ごとの入力（学生ごとの希望・学科の企業一覧とキャパ）。前回実行との差分検出に使う。
+    capacity: 企業 -> コマごとのキャパ（company_capacity_table）
+    """
+    capacity = capacity or {}
+    return {
+        dept: {
+            "students": {sid: tuple(pref_index.ranked_companies(sid)) for sid in sids},
+            "companies": tuple(pref_index.companies_for_dept(dept)),
+            "capacity": tuple(tuple(capacity.get(c, ())) for c in pref_index.companies_for_dept(dept)),
+        }
+        for dept, sids in dept_to_students.items()
+    }
+
+
+def _load_last_run(path=LAST_RUN_PATH):
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "rb") as f:
+            last_run = pickle.load(f)
+    except Exception as e:
+        telemetry.warning("前回の実行結果を読み込めません", error=repr(e))
+        return None
+    # 割当を dict で保存していた版のファイルも読めるようにする
+    for result in last_run.get("results", {}).values():
+        if isinstance(result.get("schedule"), dict):
+            result["schedule"] = Schedule.from_dict(result["schedule"])
+    return last_run
+
+
+def _save_last_run(last_run, path=LAST_RUN_PATH):
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        pickle.dump(last_run, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp, path)
+
+
+def plan_incremental(fingerprint, last_run, cap, num_slots, seed=None, engine=PATTERN_A_ENGINE,
+                     portfolio_budget=PORTFOLIO_BUDGET, pref_depth=None):
+    """
+    前回実行と比べて学科ごとの再計算方針を決める（cap・コマ数・シード・パターン A のエンジン・
+    ポートフォリオの制限時間・希望の深さ（pref_index.depth）のどれかが違えば全学科 full）。
+    戻り値: {dept: ("reuse", None) | ("fixed", fixed_schedule) | ("full", None)}
+      reuse : 入力が前回と同じ → 前回の結果をそのまま使う
+      fixed : 企業一覧・キャパは同じで一部の学生だけ変化 → 変化のない学生の割当を固定して解く
+      full  : 学科全体を解き直す
+    """
+    same_params = (last_run is not None
+                   and last_run.get("cap") == cap
+                   and last_run.get("num_slots") == num_slots
+                   and last_run.get("seed") == seed
+                   and last_run.get("engine", PATTERN_A_ENGINE) == engine
+                   and last_run.get("portfolio_budget", PORTFOLIO_BUDGET) == portfolio_budget
+                   and last_run.get("pref_depth") == pref_depth)
+    plan = {}
+    for dept, fp in fingerprint.items():
+        prev_fp = last_run["fingerprint"].get(dept) if same_params else None
+        prev = last_run["results"].get(dept) if same_params else None
+        if prev is None or prev_fp is None:
+            plan[dept] = ("full", None)
+        elif prev_fp == fp:
+            plan[dept] = ("reuse", None)
+        elif (prev_fp["companies"] == fp["companies"]
+              and prev_fp.get("capacity") == fp["capacity"] and not prev["skipped"]):
+            fixed = {
+                sid: prev["schedule"].row(sid)
+                for sid, prefs in fp["students"].items()
+                if prev_fp["students"].get(sid) == prefs and sid in prev["schedule"]
+            }
+            plan[dept] = ("fixed", fixed) if fixed else ("full", None)
+        else:
+            plan[dept] = ("full", None)
+    return plan
+
+
+def run_assignment_pipeline(cap, path_students="uploads/students.csv",
+                            path_companies="uploads/companies.csv", progress=None,
+                            dept_workers=DEPT_WORKERS, incremental=False, log_level=None,
+                            seed=None, use_cache=False, num_slots=None, pref_depth=None,
+                            engine=PATTERN_A_ENGINE, portfolio_budget=PORTFOLIO_BUDGET):
+    """
+    読込 → 学科ごとの割当 → 学科横断の調整 → schedule.csv / diagnosis.csv / logs.txt 出力
+    dept_workers > 1 で学科ごとの割当をプロセスプールで並列実行する。
+    incremental=True なら前回実行（LAST_RUN_PATH）との差分がある学科だけ解き直し、
+    それ以外の学科は前回の割当をそのまま使う。
+    log_level（debug / info / warning / error）未満のログは出さない（既定は telemetry.LOG_LEVEL）。
+    工程ごとの所要時間・カウンタ・CP-SAT の統計は結果DBの events に保存する。
+    seed は実行シード（省略時は差分再計算なら前回のシード、それ以外は新しく引く）。
+    同じ入力ファイル・シード・パラメータなら同じ割当になり、シードは結果DBと summary に残る。
+    use_cache=True なら同じ条件の過去の実行を結果DBから探し、あれば解き直さずにその結果を出力する。
+    num_slots はコマ数（省略時は希望列の数から決めた mode）、pref_depth は使う希望の深さ
+    （第 pref_depth 希望まで。省略時は CSV の希望列すべて）。
+    engine はパターン A の希望割当の解き方（"greedy" / "flow"。省略時は PATTERN_A_ENGINE）。
+    portfolio_budget（秒）を指定すると学科ごとに複数のエンジンを競争させる（省略時は PORTFOLIO_BUDGET）。
+    競争させた実行は処理時間で結果が変わるので、シードが同じでも再現せずキャッシュもしない。
+
+    戻り値: 画面表示用のサマリ dict
+    """
+    with telemetry.collect(log_level) as rec:
+        with telemetry.phase("total"):
+            summary = _run_pipeline(cap, path_students, path_companies, progress,
+                                    dept_workers, incremental, log_level, seed, use_cache,
+                                    num_slots, pref_depth, engine, portfolio_budget)
+    summary["timings"] = {
+        r["phase"]: r["sec"] for r in rec.records
+        if r["kind"] == "phase" and "dept" not in r
+    }
+    if summary.get("run_id") is not None:
+        try:
+            save_events(summary["run_id"], rec.records)
+        except sqlite3.Error as e:
+            telemetry.error("計測ログの保存に失敗しました", error=repr(e))
+    return summary
+
+
+def _resolve_seed(seed, last_run):
+    if seed is not None:
+        return int(seed)
+    if last_run is not None and last_run.get("seed") is not None:
+        return last_run["seed"]
+    return random.SystemRandom().randrange(2**31)
+
+
+def _restore_cached_run(cached, cap, seed):
+    """キャッシュヒット：過去の実行を新しい run として複製し、ファイル出力を作り直す"""
+    run_id = copy_run(cached["id"])
+    with closing(connect()) as conn:
+        output_df = schedule_frame(run_id, conn=conn)
+        df_diag = diagnosis_frame(run_id, conn=conn)
+        log_lines = step_log_lines(run_id, conn=conn)
+        run = get_run(run_id, conn=conn)
+    output_df.to_csv("schedule.csv.tmp", index=False)
+    os.replace("schedule.csv.tmp", "schedule.csv")
+    if df_diag.empty:
+        if os.path.exists("diagnosis.csv"):
+            os.remove("diagnosis.csv")
+    else:
+        df_diag.to_csv("diagnosis.csv", index=False)
+    with open("logs.txt", "w", encoding="utf-8") as logf:
+        logf.write("\n".join(log_lines) + "\n")
+    return {
+        "mode": run["mode"],
+        "num_slots": run["num_slots"],
+        "shared_capacity": cap,
+        "students": run["students"],
+        "dept_patterns": json.loads(run["dept_patterns"] or "{}"),
+        "cross_assign": run["cross_assign"],
+        "solved_departments": [],
+        "seed": seed,
+        "run_id": run_id,
+        "cached_from": cached["id"],
+    }
+
+
+def _run_pipeline(cap, path_students, path_companies, progress, dept_workers,
+                  incremental, log_level, seed=None, use_cache=False, num_slots=None,
+                  pref_depth=None, engine=PATTERN_A_ENGINE, portfolio_budget=PORTFOLIO_BUDGET):
+    _report(progress, "_state", "running")
+    last_run = _load_last_run() if incremental else None
+    seed = _resolve_seed(seed, last_run)
+    cache_key = run_cache_key(path_students, path_companies, cap, seed,
+                              num_slots, pref_depth, engine, portfolio_budget)
+    telemetry.info("実行シード", seed=seed, cache_key=cache_key)
+
+    if use_cache:
+        try:
+            cached = find_run(cache_key)
+            if cached is not None:
+                with telemetry.phase("cache_restore"):
+                    summary = _restore_cached_run(cached, cap, seed)
+                telemetry.info("キャッシュ済みの結果を使います", cached_from=cached["id"])
+                return summary
+        except sqlite3.Error as e:
+            telemetry.error("結果キャッシュを読み込めません", error=repr(e))
+
+    with telemetry.phase("load"):
+        df_preference, mode, student_dept_map = load_students(path_students)
+        df_company = load_companies(path_companies)
+        student_ids = df_preference["student_id"].unique()
+        if pref_depth:
+            # 深い希望は使わない（希望が残らない学生も割当の対象には残す）
+            df_preference = df_preference[df_preference["rank"] <= pref_depth]
+        # 希望・企業の索引を 1 回だけ構築し、全アサイナで共有する
+        pref_index = build_preference_index(df_preference, df_company)
+    NUM_SLOTS = num_slots or mode
+    telemetry.info("コマ数・希望の深さ", num_slots=NUM_SLOTS, pref_depth=pref_index.depth)
+
+    # 全体の結果用辞書（割当表は学科ごとの Schedule をまとめてから dict にする）
+    dept_schedules = []
+    student_score = {}
+    student_assigned_companies = {}
+    all_reason_logs = []
+    filled_step4_total = 0
+    filled_step5_total = 0
+    # 各学科ごとのログ用辞書
+    dept_log_summary = {}  # {dept: {"step4": X, "step5": Y}}
+    cross_total = 0
+    dept_patterns = {}
+
+
+    # 学科ごとにグループ化
+    dept_to_students = defaultdict(list)
+    for sid in student_ids:
+        dept_to_students[ student_dept_map[sid] ].append(sid)
+    _report(progress, "_total", len(dept_to_students))
+        
+    
+    # 学科ループに入る前に diagnosis.csv をリセット
+    if os.path.exists("diagnosis.csv"):
+        os.remove("diagnosis.csv")
+
+
+    # 学科 → 企業 DataFrame / 希望 DataFrame（ループ内で毎回マスクしない）
+    company_frames = dict(tuple(df_company.groupby("department_id", sort=False)))
+    pref_frames = dict(tuple(
+        df_preference.groupby(df_preference["student_id"].map(student_dept_map), sort=False)
+    ))
+
+    tasks = [
+        (dept, sids,
+         pref_frames.get(dept, df_preference.iloc[0:0]),
+         company_frames.get(dept, df_company.iloc[0:0]))
+        for dept, sids in dept_to_students.items()
+    ]
+
+    # 差分再計算：入力が変わっていない学科は前回の結果を再利用
+    fingerprint = _input_fingerprint(dept_to_students, pref_index,
+                                     company_capacity_table(df_company, cap, NUM_SLOTS))
+    results = {}
+    fixed_by_dept = {}
+    if incremental:
+        plan = plan_incremental(fingerprint, last_run, cap, NUM_SLOTS, seed, engine,
+                                portfolio_budget, pref_index.depth)
+        for dept, (action, fixed) in plan.items():
+            if action == "reuse":
+                results[dept] = last_run["results"][dept]
+                _report(progress, dept, "reused")
+            elif action == "fixed":
+                fixed_by_dept[dept] = fixed
+        telemetry.info("差分再計算", reused=len(results), fixed=len(fixed_by_dept),
+                       full=len(tasks) - len(results) - len(fixed_by_dept))
+    solved_depts = [task[0] for task in tasks if task[0] not in results]
+    pending = [task for task in tasks if task[0] not in results]
+
+    # 学科ごとに処理（dept_workers > 1 ならプロセスプールで並列）
+    # 子プロセスでも同じレベルで記録する
+    dept_level = telemetry.current().level
+    with telemetry.phase("solve_departments", departments=len(pending)):
+        if dept_workers > 1 and len(pending) > 1:
+            # CP-SAT 自身も num_search_workers でマルチスレッドなので、CPU を学科並列数で分け合う
+            cp_workers = max(1, min(CP_SAT_WORKERS, (os.cpu_count() or 1) // dept_workers))
+            ctx = multiprocessing.get_context("spawn")
+            with ProcessPoolExecutor(max_workers=dept_workers, mp_context=ctx) as pool:
+                futures = {}
+                for dept, sids, df_pref_dept, df_dept_company in pending:
+                    _report(progress, dept, "running")
+                    futures[pool.submit(
+                        solve_department, dept, sids, df_pref_dept, df_dept_company,
+                        pref_index, student_dept_map, cap, NUM_SLOTS, cp_workers,
+                        fixed_by_dept.get(dept), dept_level, seed, engine, portfolio_budget,
+                    )] = dept
+                for future in as_completed(futures):
+                    result = future.result()
+                    results[result["dept"]] = result
+                    _report(progress, result["dept"], _progress_label(result))
+        else:
+            for dept, sids, df_pref_dept, df_dept_company in pending:
+                _report(progress, dept, "running")
+                result = solve_department(
+                    dept, sids, df_pref_dept, df_dept_company,
+                    pref_index, student_dept_map, cap, NUM_SLOTS,
+                    fixed_schedule=fixed_by_dept.get(dept), log_level=dept_level, seed=seed,
+                    engine=engine, portfolio_budget=portfolio_budget,
+                )
+                results[dept] = result
+                _report(progress, dept, _progress_label(result))
+
+    # 次回の差分再計算用に、学科横断の調整前の結果を保存
+    _save_last_run({
+        "cap": cap,
+        "num_slots": NUM_SLOTS,
+        "seed": seed,
+        "engine": engine,
+        "portfolio_budget": portfolio_budget,
+        "pref_depth": pref_index.depth,
+        "fingerprint": fingerprint,
+        "results": results,
+    })
+
+    # 学科の並び順（学生 CSV の出現順）でマージするので、並列でも結果は同じ順序になる
+    diag_frames = []
+    for dept, _, _, _ in tasks:
+        result = results[dept]
+        dept_patterns[dept] = result["pattern"]
+        if dept in solved_depts:
+            telemetry.merge(result.get("events", ()))
+        if result["skipped"]:
+            continue
+
+        dept_schedules.append(result["schedule"])
+        student_score.update(result["score"])
+        student_assigned_companies.update(result["assigned"])
+        all_reason_logs.append(result["reasons"])
+        filled_step4_total += result["filled4"]
+        filled_step5_total += result["filled5"]
+        dept_log_summary[dept] = result["log"]
+        cross_total += result["log"]["cross_assign"]
+
+        if not result["diag"].empty:
+            diag_frames.append(result["diag"])
+        result["diag"].to_csv(
+            "diagnosis.csv",
+            mode="a",            # 追記
+            index=False,
+            header=not os.path.exists("diagnosis.csv")  # 最初の学科だけヘッダ
+        )
+
+    total_cross_assign = sum(dept_log_summary[d].get("cross_assign", 0)
+                          for d in dept_log_summary)
+    
+    telemetry.info("全学科集計",
+                   cross_pref=sum(d.get('cross_pref', 0) for d in dept_log_summary.values()),
+                   cross_assign=total_cross_assign)
+
+
+    # --- Post adjust across departments ---
+    # 学科横断の調整は dict の割当で行う（まとめた表はコピーなので保存済みの結果は書き換わらない）
+    student_schedule = Schedule.concat(dept_schedules, NUM_SLOTS).to_dict()
+    with telemetry.phase("overflow_adjust"):
+        adjust_overflow_assignments(
+            student_schedule,
+            student_score,
+            student_dept_map,
+            df_company,
+            cap,
+            NUM_SLOTS,
+            dept_patterns,
+            rng=derive_rng(seed, "adjust"),
+        )
+    with telemetry.phase("rescore"):
+        student_score.update(calc_score_from_assignment(student_schedule, df_preference, pref_index))
+
+
+    # --- CSV出力 ---
+    with telemetry.phase("csv_write"):
+        output_df = Schedule.from_dict(student_schedule, num_slots=NUM_SLOTS).to_frame()
+        output_df.reset_index(inplace=True)
+        output_df["dept"] = output_df["student_id"].map(student_dept_map)
+        output_df["score"] = output_df["student_id"].map(lambda sid: student_score.get(sid, 0))
+        # 一時ファイルに書いてから置き換える（照会側が書きかけの CSV を読まないように）
+        output_df.to_csv("schedule.csv.tmp", index=False)
+        os.replace("schedule.csv.tmp", "schedule.csv")
+
+        # --- logs.txt 出力 ---
+        with open("logs.txt", "w", encoding="utf-8") as logf:
+            logf.write(f"STEP 4: 学科マッチ補完数（合計） = {filled_step4_total}\n")
+            logf.write(f"STEP 5: 0人スロット補完数（合計） = {filled_step5_total}\n")
+            logf.write("\n--- 学科別 補完内訳 ---\n")
+            for dept, counts in dept_log_summary.items():
+                logf.write(f"学科 {dept} → STEP4: {counts['step4']}件, STEP5: {counts['step5']}件\n")
+
+            logf.write("\n--- 補完理由一覧 ---\n")
+            for reason_logs in all_reason_logs:
+                for sid, slot_reason in reason_logs.items():
+                    for slot, reason in slot_reason.items():
+                        logf.write(f"{sid} の slot_{slot}：{reason}\n")
+
+            logf.write("\n--- 学科外希望／割当件数 ---\n")
+            for dept, counts in dept_log_summary.items():
+                logf.write(
+                    f"学科 {dept} → cross_pref = {counts.get('cross_pref',0)} 件, "
+                    f"cross_assign = {counts.get('cross_assign',0)} 件\n"
+                )
+            logf.write(f"\n全学科合計 cross_assign = {cross_total} 件\n")
+
+    summary = {
+        "mode": mode,
+        "num_slots": NUM_SLOTS,
+        "pref_depth": pref_index.depth,
+        "shared_capacity": cap,
+        "students": len(student_schedule),
+        "dept_patterns": dept_patterns,
+        "cross_assign": cross_total,
+        "solved_departments": solved_depts,
+        "seed": seed,
+        "engine": engine,
+        "portfolio_budget": portfolio_budget,
+    }
+    # 前回の割当を固定して解いた学科があると入力だけでは結果が決まらないのでキャッシュしない
+    if fixed_by_dept:
+        cache_key = None
+
+    # --- 結果を SQLite に保存（画面側はここから引く／過去の実行も残る） ---
+    try:
+        with telemetry.phase("db_write"):
+            summary["run_id"] = save_run(
+                summary, student_schedule, student_score, student_dept_map,
+                pd.concat(diag_frames, ignore_index=True) if diag_frames else None,
+                dept_log_summary, all_reason_logs, incremental=incremental,
+                cache_key=cache_key,
+            )
+    except sqlite3.Error as e:
+        telemetry.error("結果DBへの保存に失敗しました", error=repr(e))
+        summary["run_id"] = None
+    return summary
@@ -0,0 +1,168 @@
+# utils/portfolio.py
+"""
+ソルバーのポートフォリオ実行（学科ごとの制限時間つきの競争）。
+
+  race(engines, budget, quality)   … 複数のエンジンを別プロセスで同時に走らせ、
+                                     期限までに終わったものから quality が最大の結果を返す
+  solve_department_portfolio(...)  … パターン A / B の学科を ENGINES のエンジンで競争させる
+
+  パターン A: greedy（希望順の貪欲法） / flow（最小費用流）
+  パターン B: strict（順列の厳密割当 run_strict_scheduler） / cp_sat（CP-SAT）
+
+期限を過ぎても終わらないエンジンは止める（CP-SAT には制限時間も渡す）。
+期限までに 1 つも終わらなかったときだけ、最初に終わったエンジンの結果を待つ。
+結果の良し悪しは utils.metrics.quality_key（0訪問学生 → max_slots 未満 → 希望スコア …）で比べ、
+同点なら ENGINES で先に書いたエンジンを選ぶ。
+エンジンごとの状態・所要時間・品質と勝者は telemetry の "portfolio" レコードに残す。
+"""
+import multiprocessing
+import time
+from multiprocessing.connection import wait
+
+from utils import telemetry
+from utils.assigner import run_pattern_a
+from utils.metrics import schedule_metrics, quality_key
+from utils.strict_assigner import run_strict_scheduler
+from utils.strict_assigner_cp import run_strict_scheduler_cp
+
+# パターンごとに競争させるエンジン（同点のときはこの順で優先）
+ENGINES = {
+    "A": ("greedy", "flow"),
+    "B": ("cp_sat", "strict"),
+}
+# CP-SAT は 2 段で解くので、1 段あたりの制限時間を「子プロセスが動き出した時点の残り時間」の
+# この割合にする（プロセス起動・モデル構築のぶんを残す）
+CP_SAT_BUDGET_SHARE = 0.4
+
+
+def _worker(conn, name, fn, args, kwargs, log_level, context):
+    start = time.perf_counter()
+    try:
+        with telemetry.collect(log_level, engine=name, **context) as rec:
+            out = fn(*args, **kwargs)
+        conn.send(("done", out, rec.records, time.perf_counter() - start))
+    except Exception as e:
+        conn.send(("error", repr(e), [], time.perf_counter() - start))
+    finally:
+        conn.close()
+
+
+def race(engines, budget, quality, log_level=None):
+    """
+    engines: {name: (fn, args, kwargs)}（fn はプロセス間で渡せるモジュール関数）
+    quality: fn の戻り値 → 比較キー（大きいほど良い）
+    戻り値: (勝ったエンジン名, その戻り値, {name: {"status", "sec", "quality"}})
+    """
+    ctx = multiprocessing.get_context("spawn")
+    level = log_level or telemetry.current().level
+    context = telemetry.current().context
+    start = time.perf_counter()
+    running = {}
+    for name, (fn, args, kwargs) in engines.items():
+        recv, send = ctx.Pipe(duplex=False)
+        proc = ctx.Process(target=_worker, daemon=True,
+                           args=(send, name, fn, args, kwargs, level, context))
+        proc.start()
+        send.close()
+        running[recv] = (name, proc)
+
+    results, report = {}, {}
+    while running:
+        left = budget - (time.perf_counter() - start)
+        if left <= 0 and results:
+            break
+        # 期限切れでもまだ 1 つも終わっていなければ、最初の 1 つを待つ
+        ready = wait(list(running), timeout=left if left > 0 else None)
+        for conn in ready:
+            name, proc = running.pop(conn)
+            try:
+                status, out, records, sec = conn.recv()
+            except EOFError:
+                status, out, records, sec = "error", "プロセスが異常終了しました", [], None
+            proc.join()
+            telemetry.merge(records)
+            report[name] = {"status": status,
+                            "sec": round(sec if sec is not None else time.perf_counter() - start, 3)}
+            if status == "done":
+                results[name] = out
+                report[name]["quality"] = list(quality(out))
+            else:
+                report[name]["error"] = out
+
+    for conn, (name, proc) in running.items():
+        proc.terminate()
+        proc.join()
+        report[name] = {"status": "timeout", "sec": round(time.perf_counter() - start, 3)}
+
+    if not results:
+        raise RuntimeError(f"すべてのエンジンが失敗しました: {report}")
+    order = list(engines)
+    winner = max(results, key=lambda n: (quality(results[n]), -order.index(n)))
+    telemetry.record("portfolio", budget=budget, winner=winner, engines=report)
+    return winner, results[winner], report
+
+
+# ---------------- 学科単位のエンジン（別プロセスで実行するのでモジュール関数） ----------------
+def _engine_pattern_a(engine, df_dept_pref, df_dept_company, sids, dept, student_dept_map,
+                      cap, num_slots, pref_index, fixed_schedule, rng):
+    return run_pattern_a(df_dept_pref, df_dept_company, sids, dept, student_dept_map, cap,
+                         num_slots, pref_index=pref_index, fixed_schedule=fixed_schedule,
+                         rng=rng, engine=engine)
+
+
+def _engine_strict(df_dept_pref, df_dept_company, sids, dept, cap, num_slots, pref_index):
+    return run_strict_scheduler(df_dept_pref, df_dept_company, sids, dept, cap, num_slots,
+                                pref_index=pref_index)
+
+
+def _engine_cp_sat(df_dept_pref, df_dept_company, sids, dept, cap, num_slots, pref_index,
+                   max_slots, deadline, cp_workers, sparse, fixed_schedule, random_seed):
+    # deadline は time.time() の時刻（プロセスをまたいで比べられる）
+    time_limit = max(0.5, (deadline - time.time()) * CP_SAT_BUDGET_SHARE)
+    stats = {}
+    out = run_strict_scheduler_cp(
+        df_dept_pref, df_dept_company, sids, dept, cap, num_slots,
+        time_limit_sec=time_limit, max_slots=max_slots, pref_index=pref_index,
+        num_workers=cp_workers, sparse=sparse, stats=stats,
+        fixed_schedule=fixed_schedule, random_seed=random_seed,
+    )
+    telemetry.record("cp_sat", **stats)
+    return out
+
+
+def solve_department_portfolio(pattern, budget, df_dept_pref, df_dept_company, sids, dept,
+                               student_dept_map, cap, num_slots, pref_index, max_slots=None,
+                               fixed_schedule=None, rng=None, cp_workers=1, sparse=True,
+                               cp_seed=None):
+    """
+    学科 1 つ分を ENGINES[pattern] のエンジンで競争させ、勝ったエンジンの戻り値を返す
+    （A は run_pattern_a、B は run_strict_scheduler(_cp) と同じ形）。
+    B で fixed_schedule があるときは、固定を守れる cp_sat だけで解く。
+    """
+    valid = pref_index.companies_for_dept(dept)
+    engines = {}
+    for name in ENGINES[pattern]:
+        if name in ("greedy", "flow"):
+            engines[name] = (_engine_pattern_a, (name, df_dept_pref, df_dept_company, sids, dept,
+                                                 student_dept_map, cap, num_slots, pref_index,
+                                                 fixed_schedule, rng), {})
+        elif name == "strict" and not fixed_schedule:
+            engines[name] = (_engine_strict, (df_dept_pref, df_dept_company, sids, dept, cap,
+                                              num_slots, pref_index), {})
+        elif name == "cp_sat":
+            engines[name] = (_engine_cp_sat, (df_dept_pref, df_dept_company, sids, dept, cap,
+                                              num_slots, pref_index, max_slots,
+                                              time.time() + budget, cp_workers,
+                                              sparse, fixed_schedule, cp_seed), {})
+
+    target = min(num_slots, max_slots) if max_slots else None
+
+    def quality(out):
+        # 戻り値の残キャパ（A は 4 番目、B は 2 番目）でキャパ 0 のコマを 0人ブースから除く
+        capacity = out[3] if pattern == "A" else out[1]
+        return quality_key(schedule_metrics(out[0], pref_index, valid, num_slots, target,
+                                            capacity))
+
+    winner, out, _ = race(engines, budget, quality)
+    telemetry.info("ポートフォリオの勝者", pattern=pattern, engine=winner)
+    return out
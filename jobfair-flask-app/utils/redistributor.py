@@ -1,4 +1,9 @@
+from utils import telemetry
+
+
 def fill_remaining_gaps(student_schedule, company_capacity, max_slots):
+    if not student_schedule:      # 差分再計算で学科の全員が固定のとき
+        return 0
     num_slots = len(next(iter(student_schedule.values())))
     filled = 0
     # ① 残キャパ slot を列挙
@@ -20,4 +25,5 @@ def fill_remaining_gaps(student_schedule, company_capacity, max_slots):
             company_capacity[cname][slot] -= 1
             filled += 1
             break
-    print(f"✅ GAP 再配分で {filled} コマ補完")
+    telemetry.debug("GAP 再配分", filled=filled)
+    return filled
@@ -0,0 +1,398 @@
+# utils/result_store.py
+"""
+割当結果の保存先（SQLite）。
+
+1 回の割当実行ごとに runs に 1 行追加し、その run_id で
+  assignments    学生 × コマ の割当
+  diagnosis      build_diagnosis の行（学科外希望・学科外割当）
+  step_counters  学科ごとの STEP4/STEP5 補完数・学科外件数
+  reasons        補完理由
+  events         計測ログ（utils.telemetry のレコード：工程ごとの所要時間・カウンタ・CP-SAT 統計など）
+を 1 トランザクションでまとめて書き込む。過去の実行もそのまま残るので履歴として引ける。
+schedule.csv などのファイル出力はダウンロード・互換用にこれまでどおり残す。
+
+runs には乱数シードと結果キャッシュのキー（入力ファイルのハッシュ・シード・パラメータ）も
+保存する。同じキーの実行があれば find_run で見つけて copy_run で複製し、
+schedule_frame / diagnosis_frame / step_log_lines からファイル出力を作り直せる
+（割当を解き直さない）。
+
+テーブル作成・列の追加は DB ファイルごとにプロセス内で 1 回だけ行う（最初の connect のとき）。
+読み出し関数は conn を渡せば開いている接続を使うので、画面側は 1 リクエストで 1 接続を共有する。
+"""
+import json
+import os
+import sqlite3
+import threading
+from contextlib import closing, contextmanager
+from datetime import datetime
+
+import pandas as pd
+
+from utils.telemetry import LEVELS
+
+DB_PATH = "results.db"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    id            INTEGER PRIMARY KEY AUTOINCREMENT,
+    created_at    TEXT NOT NULL,
+    cap           INTEGER,
+    num_slots     INTEGER,
+    mode          INTEGER,
+    students      INTEGER,
+    cross_assign  INTEGER,
+    incremental   INTEGER,
+    dept_patterns TEXT,
+    seed          INTEGER,
+    cache_key     TEXT,
+    cached_from   INTEGER
+);
+CREATE TABLE IF NOT EXISTS assignments (
+    run_id     INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    student_id TEXT NOT NULL,
+    dept       TEXT,
+    slot       INTEGER NOT NULL,
+    company    TEXT,
+    score      INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_assignments_student ON assignments(run_id, student_id);
+CREATE INDEX IF NOT EXISTS idx_assignments_dept    ON assignments(run_id, dept);
+CREATE TABLE IF NOT EXISTS diagnosis (
+    run_id       INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    student_id   TEXT,
+    student_dept TEXT,
+    company      TEXT,
+    company_dept TEXT,
+    rank         INTEGER,
+    phase        TEXT,
+    result       TEXT,
+    slot         INTEGER
+);
+CREATE INDEX IF NOT EXISTS idx_diagnosis_dept ON diagnosis(run_id, student_dept, result);
+CREATE TABLE IF NOT EXISTS step_counters (
+    run_id       INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    dept         TEXT NOT NULL,
+    step4        INTEGER,
+    step5        INTEGER,
+    cross_pref   INTEGER,
+    cross_assign INTEGER,
+    PRIMARY KEY (run_id, dept)
+);
+CREATE TABLE IF NOT EXISTS reasons (
+    run_id     INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    student_id TEXT,
+    slot       INTEGER,
+    reason     TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_reasons_run ON reasons(run_id);
+CREATE TABLE IF NOT EXISTS events (
+    run_id INTEGER NOT NULL REFERENCES runs(id) ON DELETE CASCADE,
+    seq    INTEGER NOT NULL,
+    ts     TEXT,
+    level  TEXT,
+    kind   TEXT,
+    dept   TEXT,
+    phase  TEXT,
+    sec    REAL,
+    data   TEXT,
+    PRIMARY KEY (run_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_events_kind ON events(run_id, kind);
+"""
+
+# 後から runs に足した列（古い results.db には ALTER TABLE で追加する）
+_RUNS_ADDED_COLUMNS = {
+    "seed": "INTEGER",
+    "cache_key": "TEXT",
+    "cached_from": "INTEGER",
+}
+
+
+_init_lock = threading.Lock()
+_initialized = set()     # テーブル作成・列の追加を済ませた DB ファイル（絶対パス）
+
+
+def connect(path=DB_PATH):
+    key = None if path == ":memory:" else os.path.abspath(path)
+    # ファイルが消されていたら作り直す
+    fresh = key is None or key not in _initialized or not os.path.exists(path)
+    conn = sqlite3.connect(path, timeout=30)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA foreign_keys=ON")
+    if fresh:
+        with _init_lock:
+            conn.execute("PRAGMA journal_mode=WAL")      # 書込中も画面側から読める（DB に残る設定）
+            conn.executescript(_SCHEMA)
+            _migrate(conn)
+            if key is not None:
+                _initialized.add(key)
+    return conn
+
+
+@contextmanager
+def _reading(conn, path):
+    """読み出し用の接続。conn を渡されたらそれを使い（閉じない）、無ければ開いて閉じる"""
+    if conn is not None:
+        yield conn
+    else:
+        with closing(connect(path)) as own:
+            yield own
+
+
+def _migrate(conn):
+    have = {r["name"] for r in conn.execute("PRAGMA table_info(runs)")}
+    for name, decl in _RUNS_ADDED_COLUMNS.items():
+        if name not in have:
+            conn.execute(f"ALTER TABLE runs ADD COLUMN {name} {decl}")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_runs_cache_key ON runs(cache_key)")
+
+
+def _none(v):
+    """NaN → None、numpy 型 → Python 型（sqlite3 にそのまま渡せる形）"""
+    if v is None:
+        return None
+    if not isinstance(v, str) and pd.isna(v):
+        return None
+    return v.item() if hasattr(v, "item") else v
+
+
+def save_run(summary, student_schedule, student_score, student_dept_map,
+             df_diag, dept_log_summary, reason_logs, incremental=False, cache_key=None,
+             path=DB_PATH):
+    """
+    1 回分の結果を 1 トランザクションで書き込み、run_id を返す。
+    cache_key は同じ入力・シード・パラメータなら同じ結果になる実行だけに付ける（それ以外は None）。
+    """
+    with closing(connect(path)) as conn, conn:
+        cur = conn.execute(
+            "INSERT INTO runs (created_at, cap, num_slots, mode, students, cross_assign,"
+            " incremental, dept_patterns, seed, cache_key)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            (datetime.now().isoformat(timespec="seconds"), summary["shared_capacity"],
+             summary["num_slots"], summary["mode"], summary["students"],
+             summary["cross_assign"], int(bool(incremental)),
+             json.dumps(summary["dept_patterns"], ensure_ascii=False),
+             summary.get("seed"), cache_key),
+        )
+        run_id = cur.lastrowid
+
+        conn.executemany(
+            "INSERT INTO assignments (run_id, student_id, dept, slot, company, score)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            ((run_id, sid, student_dept_map.get(sid), slot, _none(company),
+              _none(student_score.get(sid, 0)))
+             for sid, slots in student_schedule.items()
+             for slot, company in enumerate(slots)),
+        )
+
+        if df_diag is not None and not df_diag.empty:
+            cols = ["student_id", "student_dept", "company", "company_dept",
+                    "rank", "phase", "result", "slot"]
+            df = df_diag.reindex(columns=cols)
+            conn.executemany(
+                "INSERT INTO diagnosis (run_id, student_id, student_dept, company, company_dept,"
+                " rank, phase, result, slot) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                ((run_id, *(_none(v) for v in row)) for row in df.itertuples(index=False)),
+            )
+
+        conn.executemany(
+            "INSERT INTO step_counters (run_id, dept, step4, step5, cross_pref, cross_assign)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            ((run_id, dept, c.get("step4", 0), c.get("step5", 0),
+              c.get("cross_pref", 0), c.get("cross_assign", 0))
+             for dept, c in dept_log_summary.items()),
+        )
+        conn.executemany(
+            "INSERT INTO reasons (run_id, student_id, slot, reason) VALUES (?, ?, ?, ?)",
+            ((run_id, sid, slot, reason)
+             for reason_log in reason_logs
+             for sid, slot_reason in reason_log.items()
+             for slot, reason in slot_reason.items()),
+        )
+    return run_id
+
+
+def copy_run(run_id, path=DB_PATH):
+    """
+    過去の実行の結果（events 以外）を新しい run として複製し、新しい run_id を返す。
+    キャッシュから結果を返すときも実行履歴・直近の実行として 1 件残すため。
+    """
+    with closing(connect(path)) as conn, conn:
+        cur = conn.execute(
+            "INSERT INTO runs (created_at, cap, num_slots, mode, students, cross_assign,"
+            " incremental, dept_patterns, seed, cache_key, cached_from)"
+            " SELECT ?, cap, num_slots, mode, students, cross_assign, incremental,"
+            " dept_patterns, seed, cache_key, id FROM runs WHERE id = ?",
+            (datetime.now().isoformat(timespec="seconds"), run_id),
+        )
+        new_id = cur.lastrowid
+        conn.execute(
+            "INSERT INTO assignments (run_id, student_id, dept, slot, company, score)"
+            " SELECT ?, student_id, dept, slot, company, score FROM assignments"
+            " WHERE run_id = ? ORDER BY rowid", (new_id, run_id))
+        conn.execute(
+            "INSERT INTO diagnosis (run_id, student_id, student_dept, company, company_dept,"
+            " rank, phase, result, slot)"
+            " SELECT ?, student_id, student_dept, company, company_dept, rank, phase, result, slot"
+            " FROM diagnosis WHERE run_id = ? ORDER BY rowid", (new_id, run_id))
+        conn.execute(
+            "INSERT INTO step_counters (run_id, dept, step4, step5, cross_pref, cross_assign)"
+            " SELECT ?, dept, step4, step5, cross_pref, cross_assign FROM step_counters"
+            " WHERE run_id = ? ORDER BY rowid", (new_id, run_id))
+        conn.execute(
+            "INSERT INTO reasons (run_id, student_id, slot, reason)"
+            " SELECT ?, student_id, slot, reason FROM reasons WHERE run_id = ? ORDER BY rowid",
+            (new_id, run_id))
+    return new_id
+
+
+def save_events(run_id, records, path=DB_PATH):
+    """telemetry のレコードを保存（共通の項目は列に、残りは data に JSON で）"""
+    common = ("ts", "level", "kind", "dept", "phase", "sec")
+    with closing(connect(path)) as conn, conn:
+        conn.executemany(
+            "INSERT INTO events (run_id, seq, ts, level, kind, dept, phase, sec, data)"
+            " VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            ((run_id, seq, *(rec.get(k) for k in common),
+              json.dumps({k: v for k, v in rec.items() if k not in common},
+                         ensure_ascii=False, default=str))
+             for seq, rec in enumerate(records)),
+        )
+
+
+# ---------------- 読み出し ----------------
+def latest_run(path=DB_PATH, conn=None):
+    """直近の実行（無ければ None）"""
+    with _reading(conn, path) as conn:
+        row = conn.execute("SELECT * FROM runs ORDER BY id DESC LIMIT 1").fetchone()
+    return dict(row) if row else None
+
+
+def find_run(cache_key, path=DB_PATH, conn=None):
+    """同じ cache_key の直近の実行（無ければ None）"""
+    if cache_key is None:
+        return None
+    with _reading(conn, path) as conn:
+        row = conn.execute("SELECT * FROM runs WHERE cache_key = ? ORDER BY id DESC LIMIT 1",
+                           (cache_key,)).fetchone()
+    return dict(row) if row else None
+
+
+def get_run(run_id, path=DB_PATH, conn=None):
+    with _reading(conn, path) as conn:
+        row = conn.execute("SELECT * FROM runs WHERE id = ?", (run_id,)).fetchone()
+    return dict(row) if row else None
+
+
+def list_runs(limit=20, path=DB_PATH, conn=None):
+    with _reading(conn, path) as conn:
+        rows = conn.execute("SELECT * FROM runs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+    return [dict(r) for r in rows]
+
+
+def load_schedule(run_id, path=DB_PATH, conn=None):
+    """sid -> [slot0, slot1, ...]"""
+    with _reading(conn, path) as conn:
+        rows = conn.execute(
+            "SELECT student_id, slot, company FROM assignments WHERE run_id = ?"
+            " ORDER BY rowid", (run_id,)).fetchall()
+    schedule = {}
+    for r in rows:
+        slots = schedule.setdefault(r["student_id"], [])
+        slots.extend([None] * (r["slot"] + 1 - len(slots)))
+        slots[r["slot"]] = r["company"]
+    return schedule
+
+
+def schedule_frame(run_id, path=DB_PATH, conn=None):
+    """schedule.csv と同じ形（student_id, slot_0.., dept, score）の DataFrame"""
+    with _reading(conn, path) as conn:
+        run = conn.execute("SELECT num_slots FROM runs WHERE id = ?", (run_id,)).fetchone()
+        rows = conn.execute(
+            "SELECT student_id, dept, slot, company, score FROM assignments WHERE run_id = ?"
+            " ORDER BY rowid", (run_id,)).fetchall()
+    num_slots = run["num_slots"] if run else 0
+    records = {}
+    for r in rows:
+        rec = records.get(r["student_id"])
+        if rec is None:
+            rec = records[r["student_id"]] = {"student_id": r["student_id"],
+                                              "dept": r["dept"], "score": r["score"]}
+        rec[f"slot_{r['slot']}"] = r["company"]
+    columns = ["student_id"] + [f"slot_{i}" for i in range(num_slots)] + ["dept", "score"]
+    return pd.DataFrame(list(records.values()), columns=columns)
+
+
+def diagnosis_frame(run_id, path=DB_PATH, conn=None):
+    """diagnosis.csv と同じ列の DataFrame"""
+    with _reading(conn, path) as conn:
+        return pd.read_sql_query(
+            "SELECT student_id, student_dept, company, company_dept, rank, phase, result, slot"
+            " FROM diagnosis WHERE run_id = ? ORDER BY rowid", conn, params=(run_id,))
+
+
+def step_log_lines(run_id, path=DB_PATH, conn=None):
+    """logs.txt と同じ内容の行リスト"""
+    with _reading(conn, path) as conn:
+        counters = conn.execute(
+            "SELECT * FROM step_counters WHERE run_id = ? ORDER BY rowid", (run_id,)).fetchall()
+        reasons = conn.execute(
+            "SELECT student_id, slot, reason FROM reasons WHERE run_id = ? ORDER BY rowid",
+            (run_id,)).fetchall()
+        cross_total = conn.execute(
+            "SELECT cross_assign FROM runs WHERE id = ?", (run_id,)).fetchone()[0]
+
+    lines = [
+        f"STEP 4: 学科マッチ補完数（合計） = {sum(c['step4'] for c in counters)}",
+        f"STEP 5: 0人スロット補完数（合計） = {sum(c['step5'] for c in counters)}",
+        "",
+        "--- 学科別 補完内訳 ---",
+    ]
+    lines += [f"学科 {c['dept']} → STEP4: {c['step4']}件, STEP5: {c['step5']}件" for c in counters]
+    lines += ["", "--- 補完理由一覧 ---"]
+    lines += [f"{r['student_id']} の slot_{r['slot']}：{r['reason']}" for r in reasons]
+    lines += ["", "--- 学科外希望／割当件数 ---"]
+    lines += [f"学科 {c['dept']} → cross_pref = {c['cross_pref']} 件, "
+              f"cross_assign = {c['cross_assign']} 件" for c in counters]
+    lines += ["", f"全学科合計 cross_assign = {cross_total} 件"]
+    return lines
+
+
+def diagnosis_summary(run_id, path=DB_PATH, conn=None):
+    """学科 × 判定結果 の件数表（DataFrame）"""
+    with _reading(conn, path) as conn:
+        df = pd.read_sql_query(
+            "SELECT student_dept, result, COUNT(*) AS n FROM diagnosis"
+            " WHERE run_id = ? GROUP BY student_dept, result", conn, params=(run_id,))
+    if df.empty:
+        return df
+    return df.pivot(index="student_dept", columns="result", values="n").fillna(0).astype(int)
+
+
+def run_events(run_id, kinds=None, min_level=None, path=DB_PATH, conn=None):
+    """計測ログのレコード（dict）のリスト。kinds / min_level で絞り込む"""
+    sql, params = "SELECT * FROM events WHERE run_id = ?", [run_id]
+    if kinds:
+        sql += f" AND kind IN ({', '.join('?' * len(kinds))})"
+        params += list(kinds)
+    if min_level:
+        levels = [k for k, v in LEVELS.items() if v >= LEVELS[min_level]]
+        sql += f" AND level IN ({', '.join('?' * len(levels))})"
+        params += levels
+    with _reading(conn, path) as conn:
+        rows = conn.execute(sql + " ORDER BY seq", params).fetchall()
+    events = []
+    for r in rows:
+        rec = {k: r[k] for k in ("seq", "ts", "level", "kind", "dept", "phase", "sec")}
+        rec.update(json.loads(r["data"] or "{}"))
+        events.append(rec)
+    return events
+
+
+def phase_timings(run_id, path=DB_PATH, conn=None):
+    """工程 × 学科 の所要時間表（DataFrame。学科をまたぐ工程の dept は空）"""
+    with _reading(conn, path) as conn:
+        return pd.read_sql_query(
+            "SELECT phase, COALESCE(dept, '') AS dept, COUNT(*) AS calls, SUM(sec) AS sec"
+            " FROM events WHERE run_id = ? AND kind = 'phase'"
+            " GROUP BY phase, dept ORDER BY MIN(seq)", conn, params=(run_id,))
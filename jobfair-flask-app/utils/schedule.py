@@ -0,0 +1,282 @@
+# utils/schedule.py
+"""
+NumPy 配列で持つ割当表。
+
+従来の student_schedule（dict[sid] -> [企業名 or None, ...]）と同じ内容を
+  slots[i, t]      = 学生 i のコマ t の企業番号（空きは -1）
+  occupancy[j, t]  = 企業 j・コマ t の割当人数
+  filled[i]        = 学生 i の割当コマ数
+で持つ。assign / clear で occupancy と filled も常に更新するので、
+0人ブースや未充足学生の検出は全体を走査せず配列演算で済む。
+
+パイプラインでは学科ごとの割当（_solve_department の戻り値）をこの形で受け渡し、
+concat でまとめて schedule.csv に書く（to_frame）。学科横断の調整
+（adjust_overflow_assignments）と結果DBへの保存は dict に戻して行う。
+画面側の索引（utils.schedule_index）も schedule.csv を from_frame で読み直して使う。
+"""
+import bisect
+
+import numpy as np
+import pandas as pd
+
+EMPTY = -1
+
+
+def _is_empty(value):
+    """None / NaN / 空文字は空きコマ扱い"""
+    return value is None or value == "" or (isinstance(value, float) and value != value)
+
+
+class Schedule:
+    def __init__(self, student_ids, companies, num_slots):
+        self.student_ids = list(student_ids)
+        self.num_slots = num_slots
+        self.companies = []
+        self.company_index = {}
+        self.student_index = {sid: i for i, sid in enumerate(self.student_ids)}
+        self.slots = np.full((len(self.student_ids), num_slots), EMPTY, dtype=np.int32)
+        self.occupancy = np.zeros((0, num_slots), dtype=np.int32)
+        self.filled = np.zeros(len(self.student_ids), dtype=np.int32)
+        self.add_companies(companies)
+
+    # ---------------- 構築・変換 ----------------
+    @classmethod
+    def from_dict(cls, student_schedule, companies=(), num_slots=None):
+        """dict 形式の割当から作る（companies に無い企業名は自動で追加）"""
+        if num_slots is None:
+            num_slots = len(next(iter(student_schedule.values()), []))
+        sched = cls(student_schedule.keys(), companies, num_slots)
+        for i, row in enumerate(student_schedule.values()):
+            for t, cname in enumerate(row[:num_slots]):
+                if _is_empty(cname):
+                    continue
+                j = sched.company_id(cname, add=True)
+                sched.slots[i, t] = j
+                sched.occupancy[j, t] += 1
+                sched.filled[i] += 1
+        return sched
+
+    @classmethod
+    def from_frame(cls, df, slot_columns):
+        """schedule.csv の DataFrame（student_id 列 + slot_columns）から作る（NaN は空き）"""
+        values = df[slot_columns]
+        companies = [c for c in pd.unique(values.to_numpy().ravel()).tolist() if not _is_empty(c)]
+        sched = cls(df["student_id"].astype(str), companies, len(slot_columns))
+        # 学籍番号が重複しているときは先頭の行を引く
+        sched.student_index = {}
+        for i, sid in enumerate(sched.student_ids):
+            sched.student_index.setdefault(sid, i)
+        if len(df) and slot_columns:
+            sched.slots = np.column_stack([
+                pd.Categorical(values[col], categories=companies).codes for col in slot_columns
+            ]).astype(np.int32)
+            sched._recount()
+        return sched
+
+    @classmethod
+    def concat(cls, schedules, num_slots):
+        """学科ごとの割当表を 1 つにまとめる（学生は schedules の順に並ぶ）"""
+        schedules = list(schedules)
+        merged = cls([sid for sched in schedules for sid in sched.student_ids],
+                     [c for sched in schedules for c in sched.companies], num_slots)
+        if schedules:
+            # 学科ごとの企業番号をまとめた表の番号に付け替える（空き -1 は末尾の EMPTY へ）
+            merged.slots = np.vstack([
+                np.array([merged.company_index[c] for c in sched.companies] + [EMPTY],
+                         dtype=np.int32)[sched.slots]
+                for sched in schedules
+            ]).reshape(len(merged.student_ids), num_slots)
+            merged._recount()
+        return merged
+
+    def _recount(self):
+        """slots から occupancy / filled を作り直す"""
+        mask = self.slots != EMPTY
+        self.filled = mask.sum(axis=1).astype(np.int32)
+        self.occupancy = np.zeros((len(self.companies), self.num_slots), dtype=np.int32)
+        rows, cols = np.nonzero(mask)
+        np.add.at(self.occupancy, (self.slots[rows, cols], cols), 1)
+
+    def to_frame(self):
+        """schedule.csv と同じ形の DataFrame（index = student_id、列 = slot_0 ...。空きは None）"""
+        names = np.array(self.companies + [None], dtype=object)
+        return pd.DataFrame(names[self.slots],
+                            index=pd.Index(self.student_ids, name="student_id"),
+                            columns=[f"slot_{t}" for t in range(self.num_slots)])
+
+    def to_dict(self):
+        names = self.companies
+        return {
+            sid: [names[j] if j != EMPTY else None for j in row]
+            for sid, row in zip(self.student_ids, self.slots.tolist())
+        }
+
+    def add_companies(self, companies):
+        new = [c for c in dict.fromkeys(companies) if c not in self.company_index]
+        for c in new:
+            self.company_index[c] = len(self.companies)
+            self.companies.append(c)
+        if new:
+            self.occupancy = np.vstack(
+                [self.occupancy, np.zeros((len(new), self.num_slots), dtype=np.int32)]
+            )
+
+    def company_id(self, cname, add=False):
+        j = self.company_index.get(cname)
+        if j is None and add:
+            self.add_companies([cname])
+            j = self.company_index[cname]
+        return j
+
+    # ---------------- 参照 ----------------
+    def __len__(self):
+        return len(self.student_ids)
+
+    def __contains__(self, sid):
+        return sid in self.student_index
+
+    def get(self, sid, slot):
+        j = self.slots[self.student_index[sid], slot]
+        return self.companies[j] if j != EMPTY else None
+
+    def row(self, sid):
+        return [self.companies[j] if j != EMPTY else None
+                for j in self.slots[self.student_index[sid]].tolist()]
+
+    def count(self, cname, slot):
+        j = self.company_index.get(cname)
+        return 0 if j is None else int(self.occupancy[j, slot])
+
+    def company_total(self, cname):
+        """企業の全コマ合計人数"""
+        j = self.company_index.get(cname)
+        return 0 if j is None else int(self.occupancy[j].sum())
+
+    def has_company(self, sid, cname):
+        j = self.company_index.get(cname)
+        return j is not None and bool((self.slots[self.student_index[sid]] == j).any())
+
+    def filled_count(self, sid):
+        return int(self.filled[self.student_index[sid]])
+
+    # ---------------- 更新（人数カウンタも同時に更新） ----------------
+    def assign(self, sid, slot, cname):
+        i = self.student_index[sid]
+        self.clear(sid, slot)
+        j = self.company_id(cname, add=True)
+        self.slots[i, slot] = j
+        self.occupancy[j, slot] += 1
+        self.filled[i] += 1
+
+    def clear(self, sid, slot):
+        """コマを空ける。空けた企業名を返す（元から空きなら None）"""
+        i = self.student_index[sid]
+        j = self.slots[i, slot]
+        if j == EMPTY:
+            return None
+        self.slots[i, slot] = EMPTY
+        self.occupancy[j, slot] -= 1
+        self.filled[i] -= 1
+        return self.companies[j]
+
+    # ---------------- 集計（utils/logger の各チェックに対応） ----------------
+    def _company_ids(self, companies):
+        return [self.company_id(c, add=True) for c in dict.fromkeys(companies)]
+
+    def company_zero_slots(self, companies, capacity=None):
+        """
+        割当ゼロの (企業, コマ) を companies の順・コマ順で返す。
+        capacity（企業 -> コマごとのキャパ）を渡すと、キャパ 0 のコマ（出展しないコマ）は除く
+        """
+        ids = self._company_ids(companies)
+        if not ids:
+            return []
+        rows, cols = np.nonzero(self.occupancy[ids] == 0)
+        zero = [(self.companies[ids[r]], int(t)) for r, t in zip(rows.tolist(), cols.tolist())]
+        if capacity is not None:
+            zero = [(c, t) for c, t in zero if c not in capacity or capacity[c][t] > 0]
+        return zero
+
+    def summarize(self, companies):
+        """企業ごとのコマ別人数 dict[c] -> [slot0, slot1, ...]"""
+        ids = self._company_ids(companies)
+        return {self.companies[j]: self.occupancy[j].tolist() for j in ids}
+
+    def zero_visit_students(self):
+        return [self.student_ids[i] for i in np.nonzero(self.filled == 0)[0].tolist()]
+
+    def underfilled_students(self, max_slots):
+        return [self.student_ids[i] for i in np.nonzero(self.filled < max_slots)[0].tolist()]
+
+    def discontinuous_students(self):
+        """割当コマが連続していない（飛びコマがある）学生"""
+        if not len(self.student_ids):
+            return []
+        mask = self.slots != EMPTY
+        first = mask.argmax(axis=1)
+        last = self.num_slots - 1 - mask[:, ::-1].argmax(axis=1)
+        bad = (self.filled > 1) & (last - first + 1 != self.filled)
+        return [self.student_ids[i] for i in np.nonzero(bad)[0].tolist()]
+
+
+class ScoreQueue:
+    """
+    学生をスコア降順（同点は student_score の登録順）に並べた優先度キュー。
+    sorted(student_score.items(), key=-score) と同じ順序を、スコア更新のたびに
+    全体をソートし直さず 1 人分の挿し直し（二分探索）で保つ。
+    ※ 反復中に update() したら、その反復はすぐ抜けること。
+    """
+    def __init__(self, student_score, exclude=()):
+        self.student_score = student_score
+        self._order = {sid: i for i, sid in enumerate(student_score)}
+        exclude = set(exclude)
+        self._keys = sorted(
+            (-sc, self._order[sid], sid)
+            for sid, sc in student_score.items() if sid not in exclude
+        )
+        self._members = {sid for _, _, sid in self._keys}
+
+    def __iter__(self):
+        return (sid for _, _, sid in self._keys)
+
+    def update(self, sid, score):
+        """student_score[sid] を score にして並び順も直す"""
+        if sid in self._members:
+            old = (-self.student_score[sid], self._order[sid], sid)
+            del self._keys[bisect.bisect_left(self._keys, old)]
+            bisect.insort(self._keys, (-score, self._order[sid], sid))
+        self.student_score[sid] = score
+
+
+class ZeroBooths:
+    """
+    0人ブース (企業, コマ) の集合。Schedule の人数カウンタを見て 1 件ずつ更新し、
+    find_company_zero_slots と同じ順（companies 順 → コマ順）で取り出せる。
+    capacity を渡すと、キャパ 0 のコマ（出展しないコマ）は 0人ブースとして扱わない。
+    """
+    def __init__(self, schedule, companies, capacity=None):
+        self.schedule = schedule
+        self._order = {
+            (c, t): k
+            for k, (c, t) in enumerate(
+                (c, t) for c in dict.fromkeys(companies) for t in range(schedule.num_slots)
+            )
+        }
+        self._zero = set(schedule.company_zero_slots(companies, capacity))
+        # 割当ゼロでキャパも 0 のコマは出展しないコマ（後から人が入ることもない）
+        self._closed = set(schedule.company_zero_slots(companies)) - self._zero
+
+    def refresh(self, cname, slot):
+        """(cname, slot) の人数が変わったら呼ぶ"""
+        if (cname, slot) not in self._order or (cname, slot) in self._closed:
+            return
+        if self.schedule.count(cname, slot) == 0:
+            self._zero.add((cname, slot))
+        else:
+            self._zero.discard((cname, slot))
+
+    def ordered(self):
+        return sorted(self._zero, key=self._order.__getitem__)
+
+    def __len__(self):
+        return len(self._zero)
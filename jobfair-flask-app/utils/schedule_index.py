@@ -0,0 +1,138 @@
+# utils/schedule_index.py
+"""
+schedule.csv のメモリ内索引（学籍番号 → 行）。
+
+学生の照会のたびに CSV を読み直さないよう、読込結果をプロセス内に保持する。
+コマ列は配列版の割当表（utils.schedule.Schedule）にも読み込み、空きコマの判定や
+API 用の行はそこから作る。
+ファイルの mtime・サイズが変わったときだけ読み直す（確認は CHECK_INTERVAL_SEC に 1 回）。
+"""
+import math
+import os
+import threading
+import time
+
+import numpy as np
+import pandas as pd
+from pandas.errors import EmptyDataError
+
+from utils import telemetry
+from utils.schedule import Schedule
+
+SCHEDULE_PATH = "schedule.csv"
+CHECK_INTERVAL_SEC = 1.0      # mtime を確認する間隔（これより短い間隔の照会は stat もしない）
+
+
+class _Snapshot:
+    """ある時点の schedule.csv の内容（作ったあとは変更しない）"""
+    def __init__(self, stamp=None, df=None):
+        self.stamp = stamp                        # (mtime_ns, size)。ファイル無しは None
+        self.df = df if df is not None else pd.DataFrame()
+        self.columns = list(self.df.columns)
+        self.rows = {}
+        if "student_id" in self.df.columns:
+            for rec in self.df.to_dict("records"):
+                self.rows.setdefault(str(rec["student_id"]), rec)   # 重複時は先頭行
+        self.slot_columns = [c for c in self.columns if str(c).startswith("slot_")]
+        self.schedule = Schedule.from_frame(self.df, self.slot_columns) \
+            if "student_id" in self.df.columns else Schedule([], [], 0)
+        # API 用（JSON にそのまま出せる形）も読込時に作っておく
+        self.api_rows = {sid: self._to_api(rec) for sid, rec in self.rows.items()}
+        # 絞り込み用：空きコマがある学生か / 学科一覧
+        self.unfilled = self.schedule.filled < self.schedule.num_slots
+        self.depts = sorted(self.df["dept"].dropna().unique().tolist()) if "dept" in self.df else []
+
+    def _to_api(self, rec):
+        def clean(v):
+            return None if pd.isna(v) else (v.item() if hasattr(v, "item") else v)
+        return {
+            "student_id": str(rec["student_id"]),
+            "dept": clean(rec.get("dept")),
+            "score": clean(rec.get("score")),
+            "slots": self.schedule.row(str(rec["student_id"])),
+        }
+
+    def query(self, dept=None, score_min=None, score_max=None, unfilled=None):
+        """条件に合う行の位置（np.ndarray）。DataFrame はまだ切り出さない"""
+        df = self.df
+        mask = np.ones(len(df), dtype=bool)
+        if dept and "dept" in df:
+            mask &= (df["dept"] == dept).to_numpy()
+        if score_min is not None and "score" in df:
+            mask &= (df["score"] >= score_min).to_numpy()
+        if score_max is not None and "score" in df:
+            mask &= (df["score"] <= score_max).to_numpy()
+        if unfilled is not None:
+            mask &= self.unfilled == unfilled
+        return np.flatnonzero(mask)
+
+    def page(self, positions, page=1, per_page=50):
+        """query() の結果から 1 ページ分だけ DataFrame にする → (df, ページ数)"""
+        pages = max(1, math.ceil(len(positions) / per_page))
+        page = min(max(1, page), pages)
+        start = (page - 1) * per_page
+        return self.df.iloc[positions[start:start + per_page]], pages
+
+    @property
+    def version(self):
+        """スケジュールの版（ファイル無しは None）"""
+        if self.stamp is None:
+            return None
+        return f"{self.stamp[0]:x}-{self.stamp[1]:x}"
+
+    @property
+    def mtime(self):
+        return None if self.stamp is None else self.stamp[0] / 1e9
+
+
+class ScheduleIndex:
+    def __init__(self, path=SCHEDULE_PATH, check_interval=CHECK_INTERVAL_SEC):
+        self.path = path
+        self.check_interval = check_interval
+        self._snapshot = _Snapshot()
+        self._checked_at = None
+        self._lock = threading.Lock()
+
+    def _stamp(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+
+    def snapshot(self):
+        """最新の内容を返す（必要なときだけ読み直す）"""
+        now = time.monotonic()
+        if self._checked_at is not None and now - self._checked_at < self.check_interval:
+            return self._snapshot
+        with self._lock:
+            self._checked_at = now
+            stamp = self._stamp()
+            if stamp != self._snapshot.stamp:
+                self._snapshot = self._load(stamp)
+        return self._snapshot
+
+    def _load(self, stamp):
+        if stamp is None or stamp[1] == 0:
+            return _Snapshot(stamp)
+        try:
+            df = pd.read_csv(self.path)
+        except EmptyDataError:
+            return _Snapshot(stamp)
+        except Exception as e:
+            # 書き込み途中などで読めないときは前の内容のまま、次回また確認する
+            telemetry.warning("schedule.csv の読込に失敗", path=self.path, error=repr(e))
+            self._checked_at = None
+            return self._snapshot
+        return _Snapshot(stamp, df)
+
+    def get(self, student_id):
+        """学籍番号の行（列名 → 値の dict）。見つからなければ None"""
+        return self.snapshot().rows.get(str(student_id).strip())
+
+    @property
+    def version(self):
+        return self.snapshot().version
+
+
+schedule_index = ScheduleIndex()
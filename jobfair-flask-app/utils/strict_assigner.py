@@ -1,50 +1,112 @@
 import math
-import itertools
 
+from utils import telemetry
 
-def assign_one_student(student_id, preferences, company_capacity, valid_companies, num_slots, initial_max_slots):
-    prefs = preferences[preferences["student_id"] == student_id].sort_values(by="rank")["company_name"].tolist()
 
-    
-    
-    for max_slots in range(initial_max_slots, 0, -1):
-        ranked_subset = prefs[:max_slots]      # 高順位だけに限定
-        
-        # ---- スロット混雑度を計算（残キャパ合計が少ない方が混雑） ----
+def _can_match(slots, companies, company_capacity):
+    """slots の各コマに companies から別々の企業を割り当てられるか（二部マッチング・増加路法）"""
+    match = {}                      # company -> slot
+
+    def augment(slot, seen):
+        for c in companies:
+            if c in seen or company_capacity[c][slot] <= 0:
+                continue
+            seen.add(c)
+            if c not in match or augment(match[c], seen):
+                match[c] = slot
+                return True
+        return False
+
+    return all(augment(slot, set()) for slot in slots)
+
+
+def _first_matching(slots, companies, company_capacity):
+    """
+    コマ → 企業 の完全マッチングのうち、先頭のコマから順に希望順位の高い企業を選んだもの
+    （itertools.permutations(companies) を順に試して最初に見つかる組合せと同じ）。
+    各コマで「この企業にしても残りのコマが埋まるか」をマッチングで確かめながら確定するので、
+    希望数・コマ数が増えても多項式時間で済む。見つからなければ None。
+    """
+    if not _can_match(slots, companies, company_capacity):
+        return None
+    chosen, left = [], list(companies)
+    for i, slot in enumerate(slots):
+        for c in left:
+            rest = [x for x in left if x != c]
+            if company_capacity[c][slot] > 0 and _can_match(slots[i + 1:], rest, company_capacity):
+                chosen.append(c)
+                left = rest
+                break
+        else:
+            return None
+    return chosen
+
+
+def assign_one_student(student_id, preferences, company_capacity, valid_companies, num_slots,
+                       initial_max_slots, slot_load=None):
+    """
+    学生 1 人に連続した max_slots コマ（initial_max_slots から 1 ずつ減らして試す）を割り当て、
+    company_capacity を減らして (コマ, 企業) を返す（割り当てられなければ None）。
+    slot_load（コマごとの残キャパ合計）を渡すと、全企業を数え直さずにそれを使い、割当ぶんを引いて更新する。
+    """
+    # preferences は PreferenceIndex（旧来の DataFrame も受け付ける）
+    if hasattr(preferences, "ranked_companies"):
+        prefs = list(preferences.ranked_companies(student_id))
+    else:
+        prefs = preferences[preferences["student_id"] == student_id].sort_values(by="rank")["company_name"].tolist()
+    # 索引は全学科共通なので、学科外の希望（キャパ表に無い企業）は除く
+    prefs = [c for c in prefs if c in company_capacity]
+
+    # ---- スロット混雑度（残キャパ合計が少ない方が混雑）。割当が決まるまで変わらないので 1 回だけ ----
+    if slot_load is None:
         slot_load = [
             sum(cap[slot] for cap in company_capacity.values())
             for slot in range(num_slots)
         ]
+
+    for max_slots in range(initial_max_slots, 0, -1):
+        ranked_subset = prefs[:max_slots]      # 高順位だけに限定
+        if len(set(ranked_subset)) < max_slots:
+            continue                           # 希望が足りない（同じ企業の重複は 1 社）
+
         starts = sorted(                     # ← 空いている窓を優先
             range(num_slots - max_slots + 1),
             key=lambda s: sum(slot_load[s:s+max_slots])
         )
         for start_slot in starts:
             slots_to_try = list(range(start_slot, start_slot + max_slots))
-
-            for companies in itertools.permutations(ranked_subset, max_slots):
-                if len(set(companies)) < len(companies):
-                    continue
-
-                if all(company_capacity[company][slot] > 0 for company, slot in zip(companies, slots_to_try)):
-                    for company, slot in zip(companies, slots_to_try):
-                        company_capacity[company][slot] -= 1
-                    return slots_to_try, companies
+            companies = _first_matching(slots_to_try, ranked_subset, company_capacity)
+            if companies is not None:
+                for company, slot in zip(companies, slots_to_try):
+                    company_capacity[company][slot] -= 1
+                    slot_load[slot] -= 1
+                return slots_to_try, tuple(companies)
 
     return None
 
-def run_strict_scheduler(df_preference, df_company, student_ids, dept_id, cap, num_slots=4):
-    valid_companies = df_company[df_company["department_id"] == dept_id]["company_name"].tolist()
-    company_capacity = { cname: [cap] * num_slots for cname in valid_companies }
-    total_capacity = len(valid_companies) * cap * num_slots
-    initial_max_slots = min(4, math.floor(total_capacity / len(student_ids)))
+def run_strict_scheduler(df_preference, df_company, student_ids, dept_id, cap, num_slots=4,
+                         pref_index=None):
+    """
+    学生ごとに連続コマを希望順に割り当てる（パターン B）。
+    キャパは df_company のキャパ列（company_capacity_table）、無ければ共通キャパ cap。
+    """
+    from utils.data_loader import build_preference_index, company_capacity_table
+    if pref_index is None:
+        pref_index = build_preference_index(df_preference, df_company)
+    valid_companies = pref_index.companies_for_dept(dept_id)
+    company_capacity = company_capacity_table(df_company, cap, num_slots, valid_companies)
+    total_capacity = sum(sum(company_capacity[c]) for c in valid_companies)
+    initial_max_slots = min(num_slots, math.floor(total_capacity / len(student_ids)))
 
     student_schedule = {}
     unassigned_students = []
+    # コマごとの残キャパ合計（assign_one_student が割当ぶんを引いていく）
+    slot_load = [sum(caps[slot] for caps in company_capacity.values()) for slot in range(num_slots)]
 
     for sid in student_ids:
         result = assign_one_student(
-            sid, df_preference, company_capacity, valid_companies, num_slots, initial_max_slots
+            sid, pref_index, company_capacity, valid_companies, num_slots, initial_max_slots,
+            slot_load=slot_load,
         )
 
         if result:
@@ -57,12 +119,12 @@ def run_strict_scheduler(df_preference, df_company, student_ids, dept_id, cap, n
             student_schedule[sid] = [None] * num_slots
             unassigned_students.append(sid)
 
-    print(f"✅ 完全空きコマゼロ割当完了 → 要手動救済: {len(unassigned_students)}人")
+    telemetry.debug("完全空きコマゼロ割当完了", unassigned=len(unassigned_students))
     return student_schedule, company_capacity, unassigned_students
 
 def redistribute_zero_slots_B(student_schedule, company_capacity,
                               df_preference,     # 希望順位→点数用
-                              valid_companies, max_slots, num_slots=3):
+                              valid_companies, max_slots, num_slots=3, pref_index=None):
     """
     0人ブースを埋めながら、max_slots 未満の学生を優先的に充足。
     ・学生側は「連続枠」制約を死守（飛びコマ禁止）
@@ -70,18 +132,20 @@ def redistribute_zero_slots_B(student_schedule, company_capacity,
     戻り値:  (補完した件数, 残った0人ブース list)
     """
     from utils.logger import find_company_zero_slots, find_underfilled_students
+    from utils.data_loader import build_preference_index, score_points
     filled_total = 0
 
     # 希望辞書 (sid -> {company: rank})
-    pref_dict = (df_preference.groupby("student_id")
-                              .apply(lambda df: {r["company_name"]: r["rank"] for _, r in df.iterrows()})
-                              .to_dict())
+    if pref_index is None:
+        pref_index = build_preference_index(df_preference)
+    pref_dict = pref_index.student_rank
 
     MAX_ITER = 1000           # 充分に大きい値
     loop_cnt = 0
 
     while True:
-        zero_slots = find_company_zero_slots(student_schedule, valid_companies, num_slots)
+        zero_slots = find_company_zero_slots(student_schedule, valid_companies, num_slots,
+                                             capacity=company_capacity)
         underfilled = find_underfilled_students(student_schedule, max_slots)
         if not zero_slots or not underfilled:
             break
@@ -111,10 +175,7 @@ def redistribute_zero_slots_B(student_schedule, company_capacity,
 
                 # スコア即時加点（希望順位で決める）
                 rank = pref_dict.get(sid, {}).get(cname)
-                if   rank == 1: delta = 3
-                elif rank == 2: delta = 2
-                elif rank in (3,4): delta = 1
-                else:           delta = 0
+                delta = score_points(rank, pref_index.depth)
                 # 後でまとめて再計算するならここはスキップしても OK
                 # student_score[sid] += delta
 
@@ -128,39 +189,48 @@ def redistribute_zero_slots_B(student_schedule, company_capacity,
         
         loop_cnt += 1
         if loop_cnt > MAX_ITER:
-            print("⚠️ redistribute_zero_slots_B: 安全弁で強制終了")
+            telemetry.warning("redistribute_zero_slots_B: 安全弁で強制終了", loops=loop_cnt)
             break
 
     # 残った 0 人ブースを返す
-    remaining = find_company_zero_slots(student_schedule, valid_companies, num_slots)
+    remaining = find_company_zero_slots(student_schedule, valid_companies, num_slots,
+                                        capacity=company_capacity)
     return filled_total, remaining
 
 
 def assign_zero_slots_hiScore_B(student_schedule, student_score,
                                 company_capacity, valid_companies,
-                                df_preference, num_slots=3):
+                                df_preference, num_slots=3, pref_index=None):
     """残った 0 人ブースをスコア高い学生で“置換あり”補完。
        ・連続枠を壊さない
        ・置換で新たな 0 人ブースを生まない
        ・capacity ±1 を厳密更新
+       人数・0人ブース・スコア順は Schedule / ZeroBooths / ScoreQueue で差分更新する。
        返り値: (補完数, 最終的に残った0人ブースlist)
     """
-    from utils.logger import find_company_zero_slots
-    from utils.logger import find_discontinuous_students
-    pref_dict = (df_preference.groupby("student_id")
-                 .apply(lambda df: {r["company_name"]: r["rank"] for _, r in df.iterrows()})
-                 .to_dict())
+    from utils.data_loader import build_preference_index, score_points
+    from utils.schedule import Schedule, ScoreQueue, ZeroBooths
+    if pref_index is None:
+        pref_index = build_preference_index(df_preference)
+    pref_dict = pref_index.student_rank
+
+    sched = Schedule.from_dict(student_schedule, valid_companies, num_slots)
+    zero_booths = ZeroBooths(sched, valid_companies, company_capacity)
+    queue = ScoreQueue(student_score)
+    valid_set = set(valid_companies)
 
     total_filled = 0
+    MAX_ITER = 1000           # 置換が循環したときの安全弁
+    loop_cnt = 0
     while True:
-        zero_slots = find_company_zero_slots(student_schedule, valid_companies, num_slots)
+        zero_slots = zero_booths.ordered()
         if not zero_slots:
             break
 
         progress = 0
         for cname, slot in zero_slots:
             # スコア降順
-            for sid, _ in sorted(student_score.items(), key=lambda x: -x[1]):
+            for sid in queue:
                 slots = student_schedule[sid]
                 # --- ① 空きがあればそのまま割当 -----------------
                 if slots[slot] is None and cname not in slots:
@@ -169,7 +239,9 @@ def assign_zero_slots_hiScore_B(student_schedule, student_score,
                     if max(idx)-min(idx)+1 != len(idx):
                         continue
                     # 割当
-                    student_schedule[sid][slot] = cname
+                    slots[slot] = cname
+                    sched.assign(sid, slot, cname)
+                    zero_booths.refresh(cname, slot)
                     company_capacity[cname][slot] -= 1
                     progress += 1; total_filled += 1
                 # --- ② 全枠埋まり → 置換 -----------------------
@@ -179,9 +251,9 @@ def assign_zero_slots_hiScore_B(student_schedule, student_score,
                     idx_replace = ranks.index(max(ranks))
                     old_c = slots[idx_replace]
 
-                    # old_c の残人数チェック
-                    if old_c and old_c in valid_companies:
-                        others = sum(old_c in sc for s2,sc in student_schedule.items() if s2!=sid)
+                    # old_c の残人数チェック（自分以外で old_c に入っている人数）
+                    if old_c and old_c in valid_set:
+                        others = sched.company_total(old_c) - slots.count(old_c)
                         if others == 0:            # 0人ブース化するならNG
                             continue
 
@@ -194,36 +266,47 @@ def assign_zero_slots_hiScore_B(student_schedule, student_score,
                         continue
 
                     # capacity 戻す / 減らす
-                    if old_c and old_c in valid_companies:
+                    if old_c and old_c in valid_set:
                         company_capacity[old_c][idx_replace] += 1
-                    student_schedule[sid][idx_replace] = None
-                    student_schedule[sid][slot] = cname
+                    overwritten = slots[slot]
+                    slots[idx_replace] = None
+                    slots[slot] = cname
+                    sched.clear(sid, idx_replace)
+                    sched.assign(sid, slot, cname)
+                    for booth in ((cname, slot), (old_c, idx_replace), (overwritten, slot)):
+                        zero_booths.refresh(*booth)
                     company_capacity[cname][slot] -= 1
                     progress += 1; total_filled += 1
 
-                if progress:  # スコア再計算
-                    score = 0
-                    for c in student_schedule[sid]:
-                        r = pref_dict.get(sid, {}).get(c)
-                        score += (5-r) if r and 1<=r<=4 else 0
-                    student_score[sid] = score
+                if progress:  # スコア再計算（calc_score_from_assignment と同じ配点）
+                    prefs = pref_dict.get(sid, {})
+                    score = sum(score_points(prefs.get(c), pref_index.depth)
+                                for c in student_schedule[sid])
+                    queue.update(sid, score)
                     break        # 次の zero_slot へ
 
         if progress == 0:
             break               # これ以上動かせない
 
-    remaining = find_company_zero_slots(student_schedule, valid_companies, num_slots)
+        loop_cnt += 1
+        if loop_cnt > MAX_ITER:
+            telemetry.warning("assign_zero_slots_hiScore_B: 安全弁で強制終了", loops=loop_cnt)
+            break
+
+    remaining = zero_booths.ordered()
     return total_filled, remaining
 
-def calc_score_from_assignment(student_schedule, df_preference):
+def calc_score_from_assignment(student_schedule, df_preference, pref_index=None):
     """
     各学生のスコアを計算する（割当企業と希望順位を照合）
-    第1希望5点、第2希望4点、第3希望3点、第4希望2点、それ以外は0点など
+    第1希望3点、第2希望2点、第3・第4希望1点、希望外0点
+    （第5希望以降がある場合は utils.data_loader.score_points の配点）
     """
+    from utils.data_loader import build_preference_index, score_points
     student_score = {}
-    pref_dict = df_preference.groupby("student_id").apply(
-        lambda df: {row["company_name"]: row["rank"] for _, row in df.iterrows()}
-    ).to_dict()
+    if pref_index is None:
+        pref_index = build_preference_index(df_preference)
+    pref_dict = pref_index.student_rank
 
     for sid, slots in student_schedule.items():
         prefs = pref_dict.get(sid, {})
@@ -231,16 +314,7 @@ def calc_score_from_assignment(student_schedule, df_preference):
         for company in slots:
             if not company or company == "自由訪問枠":
                 continue
-            rank = prefs.get(company)
-            if rank == 1:
-                score += 3
-            elif rank == 2:
-                score += 2
-            elif rank == 3:
-                score += 1
-            elif rank == 4:
-                score += 1
-            # else: 0点
+            score += score_points(prefs.get(company), pref_index.depth)
         student_score[sid] = score
     return student_score
 
@@ -2,6 +2,10 @@ from ortools.sat.python import cp_model
 import pandas as pd
 from typing import Dict, List, Tuple
 from utils.redistributor import fill_remaining_gaps
+from utils.data_loader import (
+    PreferenceIndex, build_preference_index, preference_points, company_capacity_table,
+)
+from utils import telemetry
 
 
 # ---------------------------------------------------------
@@ -23,13 +27,14 @@ CP‑SAT 版の“厳密割当”
 **現在の実装範囲**
   * 1スロット1社
   * 同一企業の重複禁止
-  * 企業キャパ制約
+  * 企業キャパ制約（企業ごと・コマごと。キャパ 0 のコマは出展なしで 0人ブースにしない）
   * 学生ごとの max_slots 制約
   * 学生の連続枠（飛びコマ禁止）
   * 企業側 0人ブース禁止（ハード）
   * 学生の連続枠（飛びコマ禁止）
   * 企業側 0人ブース禁止（ハード）
-  * 学生希望スコア最大化（第1〜第4希望を 5,4,3,2 点）
+  * 学生希望スコア最大化（第1〜第4希望を 5,4,3,2 点。深い希望は preference_points）
+  * sparse モード：希望企業 + 補完候補だけに変数を作る
 
 **未実装 / TODO**
   * 希望外を避けるペナルティ／公平性指標
@@ -39,16 +44,48 @@ CP‑SAT 版の“厳密割当”
 """
 
 
-def _build_score_map(df_preference: pd.DataFrame) -> Dict[str, Dict[str, int]]:
+def _build_score_map(pref_index: PreferenceIndex) -> Dict[str, Dict[str, int]]:
     """score[sid][company] → 点数"""
-    rank_points = {1: 5, 2: 4, 3: 3, 4: 2}
-    score: Dict[str, Dict[str, int]] = {}
-    for _, row in df_preference.iterrows():
-        sid = row["student_id"]
-        company = row["company_name"]
-        rank = int(row["rank"])
-        score.setdefault(sid, {})[company] = rank_points.get(rank, 0)
-    return score
+    return {
+        sid: {company: preference_points(rank, pref_index.depth) for company, rank in ranks.items()}
+        for sid, ranks in pref_index.student_rank.items()
+    }
+
+
+def _sparse_candidates(S, C, score_map, num_slots, filler_per_student, max_slots=0):
+    """
+    学生ごとに変数を作る企業の候補を決める（sparse モデル用）。
+      * 学科内の希望企業はすべて
+      * 補完候補として、その時点で候補学生が少ない企業から filler_per_student 社
+        （希望企業と合わせて max_slots 社に満たなければ、足りないぶんまで増やす）
+      * 0人ブース禁止を満たせるよう、各企業に最低 num_slots 人の候補を確保
+    """
+    candidates = {s: [c for c in C if c in score_map.get(s, {})] for s in S}
+    demand = {c: 0 for c in C}
+    for cands in candidates.values():
+        for c in cands:
+            demand[c] += 1
+
+    order = {c: i for i, c in enumerate(C)}
+    for s in S:
+        chosen = set(candidates[s])
+        n_fillers = max(filler_per_student, max_slots - len(chosen))
+        fillers = sorted((c for c in C if c not in chosen),
+                         key=lambda c: (demand[c], order[c]))[:n_fillers]
+        for c in fillers:
+            candidates[s].append(c)
+            demand[c] += 1
+
+    # 候補学生が num_slots 人に満たない企業には、候補の少ない学生を足す
+    for c in C:
+        if demand[c] >= num_slots:
+            continue
+        pool = sorted((s for s in S if c not in candidates[s]),
+                      key=lambda s: len(candidates[s]))
+        for s in pool[:num_slots - demand[c]]:
+            candidates[s].append(c)
+            demand[c] += 1
+    return candidates
 
 
 def run_strict_scheduler_cp(
@@ -60,9 +97,27 @@ def run_strict_scheduler_cp(
     num_slots: int = 3,
     time_limit_sec: int = 30,
     max_slots: int | None = None,
+    pref_index: PreferenceIndex | None = None,
+    num_workers: int = 8,
+    sparse: bool = False,
+    filler_per_student: int = 3,
+    stats: dict | None = None,
+    hint_schedule: Dict[str, List[str | None]] | None = None,
+    fixed_schedule: Dict[str, List[str | None]] | None = None,
+    random_seed: int | None = None,
 ):
     """CP‑SAT による割当
 
+    sparse=True なら学生ごとに「希望企業 + 補完候補 filler_per_student 社」だけ
+    変数を作る（大規模学科向け）。解が無いとき、または Phase 1 を最適まで解いても
+    max_slots に届かない学生の候補から外した企業があるときは dense モデルでやり直す。
+    stats に dict を渡すと変数数などのモデル規模と、各段のソルバー統計
+    （phase1 / phase2: status・所要時間・目的値・上界・conflicts・branches）を書き込む。
+    hint_schedule（貪欲法などの割当 sid -> [slot0, ...]）を渡すと解ヒントとして使う。
+    Phase 2 には Phase 1 の解をヒントとして引き継ぐ。
+    fixed_schedule に入っている学生の割当はハード制約で固定する（差分再計算用）。
+    random_seed を渡すとソルバーの乱数シードに使う（時間切れにならなければ同じ解になる）。
+
     戻り値:
         schedule: Dict[str, List[str]]  # sid -> [slot0, slot1, slot2]
         company_capacity: Dict[str, List[int]]  # 更新後のキャパ残
@@ -72,95 +127,187 @@ def run_strict_scheduler_cp(
     # ---------- データ整形 ----------
     S = list(student_ids)
     T = list(range(num_slots))
-    C = df_company[df_company["department_id"] == dept_id]["company_name"].tolist()
+    if pref_index is None:
+        pref_index = build_preference_index(df_preference, df_company)
+    C = list(dict.fromkeys(pref_index.companies_for_dept(dept_id)))   # 重複行は1社扱い
 
     if not (S and C):
         raise ValueError("学生または企業が存在しません")
 
-    # cap[c][t] を dict で作成
-    company_capacity: Dict[str, List[int]] = {c: [cap] * num_slots for c in C}
+    # cap[c][t] を dict で作成（df_company のキャパ列、無ければ共通キャパ cap）
+    company_capacity: Dict[str, List[int]] = company_capacity_table(df_company, cap, num_slots, C)
 
     if max_slots is None:
-        total_capacity = len(C) * cap * num_slots
+        total_capacity = sum(sum(caps) for caps in company_capacity.values())
         max_slots = min(num_slots, total_capacity // len(S))
 
+    score_map = _build_score_map(pref_index)
+
+    # --- 変数を作る (学生, 企業) の組 ---
+    if sparse:
+        candidates = _sparse_candidates(S, C, score_map, num_slots, filler_per_student,
+                                        min(max_slots, num_slots))
+    else:
+        candidates = {s: C for s in S}
+
+    # ヒント・固定割当に出てくる組は sparse でも変数を作っておく
+    if sparse and (hint_schedule or fixed_schedule):
+        C_set = set(C)
+        for given in (hint_schedule or {}, fixed_schedule or {}):
+            for s in S:
+                for c in given.get(s, []):
+                    if c in C_set and c not in candidates[s]:
+                        candidates[s].append(c)
+
     # ---------- CP‑SAT モデル ----------
     model = cp_model.CpModel()
 
-    # --- 変数 x[s,t,c] ---
+    # --- 変数 x[s,t,c]（候補の組だけ）と、制約用の索引 ---
     x = {}
+    by_student_slot = {(s, t): [] for s in S for t in T}   # (s,t) -> [x]
+    by_student_company = {}                                 # (s,c) -> [x]
+    by_company_slot = {(c, t): [] for c in C for t in T}    # (c,t) -> [x]
     for s in S:
-        for t in T:
-            for c in C:
-                x[s, t, c] = model.NewBoolVar(f"x_{s}_{t}_{c}")
+        for c in candidates[s]:
+            for t in T:
+                var = model.NewBoolVar(f"x_{s}_{t}_{c}")
+                x[s, t, c] = var
+                by_student_slot[s, t].append(var)
+                by_student_company.setdefault((s, c), []).append(var)
+                by_company_slot[c, t].append(var)
+
+    # y[s,t] = その時間帯に何か入っているか, k[s] = 割当コマ数（線形式のまま使う）
+    y = {(s, t): sum(by_student_slot[s, t]) for s in S for t in T}
+    k = {s: sum(y[s, t] for t in T) for s in S}
 
     # ---------- 制約 ----------
 
     # 1) 1スロット1社 (学生側)
     for s in S:
         for t in T:
-            model.Add(sum(x[s, t, c] for c in C) <= 1)
+            model.Add(y[s, t] <= 1)
 
     # 2) 同一企業重複禁止 (学生側)
-    for s in S:
-        for c in C:
-            model.Add(sum(x[s, t, c] for t in T) <= 1)
+    for vars_sc in by_student_company.values():
+        model.Add(sum(vars_sc) <= 1)
 
     # 3) 企業キャパ
     for c in C:
         for t in T:
-            model.Add(sum(x[s, t, c] for s in S) <= company_capacity[c][t])
+            model.Add(sum(by_company_slot[c, t]) <= company_capacity[c][t])
 
     # 学生0訪問禁止
     for s in S:
-        model.Add(sum(x[s, t, c] for t in T for c in C) >= 1)  # 全員 1 コマ以上
+        model.Add(k[s] >= 1)  # 全員 1 コマ以上
 
     # 4) 学生 max_slots
     for s in S:
-        model.Add(sum(x[s, t, c] for t in T for c in C) <= max_slots)
-
-    # --- 割当数カウント用変数 ----------------------------
-    y = {(s, t): model.NewBoolVar(f"y_{s}_{t}") for s in S for t in T}
-    k = {s: model.NewIntVar(0, num_slots, f"k_{s}") for s in S}
-    for s in S:
-        for t in T:
-            model.Add(sum(x[s, t, c] for c in C) == y[s, t])
-        model.Add(k[s] == sum(y[s, t] for t in T))
+        model.Add(k[s] <= max_slots)
 
     # --- ① 連続枠（飛びコマ禁止） --------------------------
-    for s in S:
-        for t in range(num_slots - 2):  # num_slots=3 なら t=0 だけ
-            # y[s,t] と y[s,t+2] が両方 1 なら 真ん中 y[s,t+1] も 1 にする
-            model.Add(y[s, t] + y[s, t + 2] - y[s, t + 1] <= 1)
+    if num_slots <= 3:
+        for s in S:
+            for t in range(num_slots - 2):  # num_slots=3 なら t=0 だけ
+                # y[s,t] と y[s,t+2] が両方 1 なら 真ん中 y[s,t+1] も 1 にする
+                model.Add(y[s, t] + y[s, t + 2] - y[s, t + 1] <= 1)
+    else:
+        # 4 コマ以上は 2 コマ以上の空き（1,0,0,1 など）もあるので、
+        # 「割当の始まり（空き → 割当）は 1 回だけ」で連続を表す
+        for s in S:
+            starts = []
+            for t in T:
+                start = model.NewBoolVar(f"start_{s}_{t}")
+                model.Add(start >= y[s, t] - (y[s, t - 1] if t else 0))
+                starts.append(start)
+            model.Add(sum(starts) <= 1)
     # ------------------------------------------------------
 
     # --- ② 企業側 0人ブース禁止（ハード） -------------------
     for c in C:
         for t in T:
             if company_capacity[c][t] > 0:  # スロット営業している企業だけ
-                model.Add(sum(x[s, t, c] for s in S) >= 1)
+                model.Add(sum(by_company_slot[c, t]) >= 1)
+
+    # --- ③ 固定割当（前回の結果をそのまま残す学生） -------
+    if fixed_schedule:
+        for (s, t, c), var in x.items():
+            slots = fixed_schedule.get(s)
+            if slots is not None:
+                model.Add(var == int(t < len(slots) and slots[t] == c))
+
+    num_vars = len(x)
+    telemetry.debug("CP-SAT モデル", num_vars=num_vars,
+                    num_constraints=len(model.Proto().constraints),
+                    mode="sparse" if sparse else "dense",
+                    students=len(S), companies=len(C), slots=num_slots)
+    if stats is not None:
+        stats.update({
+            "mode": "sparse" if sparse else "dense",
+            "num_vars": num_vars,
+            "num_constraints": len(model.Proto().constraints),
+            "dense_vars": len(S) * len(C) * num_slots,
+        })
 
     # ---------- 目的関数設定 (2 段階最適化) ----------
-    score_map = _build_score_map(df_preference)
     objective_terms = []
-    for s in S:
-        for t in T:
-            for c in C:
-                points = score_map.get(s, {}).get(c, 0)
-                if points:
-                    objective_terms.append(points * x[s, t, c])
+    for (s, t, c), var in x.items():
+        points = score_map.get(s, {}).get(c, 0)
+        if points:
+            objective_terms.append(points * var)
+
+    # --- ヒント（warm start） ---
+    if hint_schedule:
+        for (s, t, c), var in x.items():
+            slots = hint_schedule.get(s)
+            model.AddHint(var, bool(slots) and t < len(slots) and slots[t] == c)
 
     # --- Phase 1 : 割当コマ数の合計を最大化 ---
     model.Maximize(sum(k[s] for s in S))
 
     solver = cp_model.CpSolver()
     solver.parameters.max_time_in_seconds = time_limit_sec
-    solver.parameters.num_search_workers = 8
+    solver.parameters.num_search_workers = num_workers
+    if random_seed is not None:
+        solver.parameters.random_seed = random_seed
 
     status = solver.Solve(model)
-
-    if status not in (cp_model.OPTIMAL, cp_model.FEASIBLE):
-        print("[CP‑SAT] FEASIBLE 解なし。status =", cp_model.CpSolver().StatusName(status))
+    _solver_stats(stats, "phase1", solver, status)
+
+    feasible = status in (cp_model.OPTIMAL, cp_model.FEASIBLE)
+    if not feasible:
+        telemetry.warning("CP-SAT: FEASIBLE 解なし", status=solver.StatusName(status))
+
+    # sparse で最適と証明しても max_slots に届かない学生（固定した学生を除く）の中に
+    # 候補から外した企業がある学生がいれば、候補の絞り込みのせいかもしれない
+    short = []
+    if sparse and status == cp_model.OPTIMAL:
+        short = [s for s in S
+                 if not (fixed_schedule and s in fixed_schedule)
+                 and solver.Value(k[s]) < min(max_slots, num_slots)
+                 and len(candidates[s]) < len(C)]
+        if short:
+            telemetry.warning("CP-SAT: sparse モデルで max_slots に届かない学生がいます",
+                              students=len(short))
+
+    if not feasible or short:
+        if sparse and num_vars < len(S) * len(C) * num_slots:
+            # 候補を絞りすぎて解けない・コマ数が足りない場合は全組合せのモデルでやり直す
+            telemetry.warning("CP-SAT: sparse モデルを dense モデルで再実行")
+            if feasible:
+                # sparse の解を dense モデルのヒントにする
+                hint_schedule = {
+                    s: [next((c for c in candidates[s] if solver.BooleanValue(x[s, t, c])), None)
+                        for t in T]
+                    for s in S
+                }
+            return run_strict_scheduler_cp(
+                df_preference, df_company, student_ids, dept_id, cap, num_slots,
+                time_limit_sec=time_limit_sec, max_slots=max_slots,
+                pref_index=pref_index, num_workers=num_workers,
+                sparse=False, stats=stats, hint_schedule=hint_schedule,
+                fixed_schedule=fixed_schedule, random_seed=random_seed,
+            )
+    if not feasible:
         schedule = {s: [None] * num_slots for s in S}
         unsat_students = list(S)
         return schedule, company_capacity, unsat_students
@@ -168,26 +315,31 @@ def run_strict_scheduler_cp(
     best_total = sum(solver.Value(k[s]) for s in S)
 
     # --- Phase 2 : 上記コマ数を固定して希望スコア最大化 ---
+    # Phase 1 の解をそのままヒントにして、探索を一からやり直さない
+    model.ClearHints()
+    for var in x.values():
+        model.AddHint(var, solver.BooleanValue(var))
     model.ClearObjective()
     model.Add(sum(k[s] for s in S) == best_total)
     model.Maximize(sum(objective_terms))
 
     solver = cp_model.CpSolver()
     solver.parameters.max_time_in_seconds = time_limit_sec
-    solver.parameters.num_search_workers = 8
+    solver.parameters.num_search_workers = num_workers
+    if random_seed is not None:
+        solver.parameters.random_seed = random_seed
 
     status = solver.Solve(model)
+    _solver_stats(stats, "phase2", solver, status)
 
     # ---------- 結果取り出し ----------
     schedule: Dict[str, List[str]] = {s: [None] * num_slots for s in S}
 
     if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
-        for s in S:
-            for t in T:
-                for c in C:
-                    if solver.Value(x[s, t, c]):
-                        schedule[s][t] = c
-                        company_capacity[c][t] -= 1
+        for (s, t, c), var in x.items():
+            if solver.Value(var):
+                schedule[s][t] = c
+                company_capacity[c][t] -= 1
 
         # 余ったキャパがあれば貪欲に再配分
         remaining = sum(sum(caps) for caps in company_capacity.values())
@@ -195,15 +347,31 @@ def run_strict_scheduler_cp(
             fill_remaining_gaps(schedule, company_capacity, max_slots)
 
         # --- 各企業の残キャパをログ出力 ----------------------
-        for cname, caps in company_capacity.items():
-            print(f"----------[残りLOG] {cname} remaining: {caps} (total={sum(caps)})---------")
+        if telemetry.enabled("debug"):
+            for cname, caps in company_capacity.items():
+                telemetry.debug("CP-SAT 残キャパ", company=cname, remaining=caps, total=sum(caps))
 
         unsat_students = [s for s, slots in schedule.items() if all(v is None for v in slots)]
         return schedule, company_capacity, unsat_students
 
     else:
-        print("[CP‑SAT] FEASIBLE 解なし。status =", cp_model.CpSolver().StatusName(status))
+        telemetry.warning("CP-SAT: FEASIBLE 解なし", status=solver.StatusName(status))
         # 全 None で返す
         schedule = {s: [None] * num_slots for s in S}
         unsat_students = list(S)
         return schedule, company_capacity, unsat_students
+
+
+def _solver_stats(stats, key, solver, status):
+    """stats[key] に CP-SAT の解き終わりの統計を書き込む（stats=None なら何もしない）"""
+    if stats is None:
+        return
+    feasible = status in (cp_model.OPTIMAL, cp_model.FEASIBLE)
+    stats[key] = {
+        "status": solver.StatusName(status),
+        "wall_time": round(solver.WallTime(), 4),
+        "objective": solver.ObjectiveValue() if feasible else None,
+        "best_bound": solver.BestObjectiveBound() if feasible else None,
+        "conflicts": solver.NumConflicts(),
+        "branches": solver.NumBranches(),
+    }
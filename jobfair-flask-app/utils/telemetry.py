@@ -0,0 +1,179 @@
+# utils/telemetry.py
+"""
+割当処理の計測（構造化ログ）。
+
+  debug / info / warning / error(msg, **fields)  … 1 件 = JSON 1 行のレコード
+  count(name, n=1)                               … カウンタ（最後にまとめて 1 レコード）
+  with phase(name, **fields): ...                … 区間の所要時間（秒）
+  record(kind, **fields)                         … CP-SAT の統計など任意のレコード
+
+レベル（LOG_LEVEL / 環境変数 JOBFAIR_LOG_LEVEL）未満のメッセージは作らずに捨てるので、
+ループ内の debug は本番では文字列整形のコストもかからない。
+phase / count / record は計測そのものなのでレベルに関係なく残す。
+
+レコードは「いまの Recorder」にたまる。collect() で囲んだ範囲だけ新しい Recorder に
+切り替わるので、学科ごとの処理（別プロセスのこともある）は collect() の records を
+結果と一緒に返し、パイプライン側でまとめて結果DBに保存する。
+collect() の外（画面側など）は標準出力に出すだけで溜めない（count も数えない）。
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+LEVELS = {"debug": 10, "info": 20, "warning": 30, "error": 40}
+LOG_LEVEL = os.environ.get("JOBFAIR_LOG_LEVEL", "info").lower()
+ECHO = True          # レベル以上のレコードを標準出力にも JSON で出す
+
+
+def _level_no(level):
+    if isinstance(level, int):
+        return level
+    try:
+        return LEVELS[str(level).lower()]
+    except KeyError:
+        raise ValueError(f"不明なログレベルです: {level}（{' / '.join(LEVELS)}）") from None
+
+
+class Recorder:
+    def __init__(self, level=None, keep=True, echo=None, **context):
+        self.level = _level_no(level or LOG_LEVEL)
+        self.keep = keep
+        self.echo = ECHO if echo is None else echo
+        self.context = context           # 全レコードに付ける項目（dept など）
+        self.records = []
+        self.counters = Counter()
+
+    def enabled(self, level):
+        return _level_no(level) >= self.level
+
+    def _emit(self, rec):
+        if self.keep:
+            self.records.append(rec)
+        if self.echo:
+            print(json.dumps(rec, ensure_ascii=False, default=str), file=sys.stdout)
+
+    def _make(self, kind, level, fields):
+        rec = {"ts": datetime.now().isoformat(timespec="milliseconds"),
+               "level": level, "kind": kind}
+        rec.update(self.context)
+        rec.update(fields)
+        return rec
+
+    def log(self, level, msg, **fields):
+        if _level_no(level) < self.level:
+            return
+        self._emit(self._make("log", level, {"msg": msg, **fields}))
+
+    def record(self, kind, level="info", **fields):
+        """計測レコード（レベルで捨てないが、表示はレベル以上のときだけ）"""
+        rec = self._make(kind, level, fields)
+        if self.keep:
+            self.records.append(rec)
+        if self.echo and _level_no(level) >= self.level:
+            print(json.dumps(rec, ensure_ascii=False, default=str), file=sys.stdout)
+
+    def count(self, name, n=1):
+        # 溜めない Recorder（collect() の外）はカウンタを出す先が無いので数えない
+        if self.keep:
+            self.counters[name] += n
+
+    @contextmanager
+    def phase(self, name, **fields):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record("phase", phase=name,
+                        sec=round(time.perf_counter() - start, 6), **fields)
+
+    def flush_counters(self):
+        """たまったカウンタを 1 レコードにして出す"""
+        if self.counters:
+            self.record("counters", counters=dict(self.counters))
+            self.counters.clear()
+
+
+# --- いまの Recorder（スレッドごと） ---------------------------
+_local = threading.local()
+_default = Recorder(keep=False)
+
+
+def current():
+    return getattr(_local, "recorder", None) or _default
+
+
+def set_level(level):
+    """既定のレベルを変える（collect() で level を渡さなかったときもこれを使う）"""
+    global LOG_LEVEL
+    _level_no(level)
+    LOG_LEVEL = str(level).lower()
+    _default.level = _level_no(level)
+
+
+def set_echo(flag):
+    """標準出力への JSON 出力を切り替える（ベンチマークなどで黙らせたいとき）"""
+    global ECHO
+    ECHO = bool(flag)
+    _default.echo = ECHO
+
+
+@contextmanager
+def collect(level=None, **context):
+    """
+    この中のレコードを新しい Recorder に集める。
+    context は外側の Recorder の context に足される（run_id, dept など）。
+    """
+    outer = current()
+    rec = Recorder(level or outer.level, keep=True, echo=outer.echo,
+                   **{**outer.context, **context})
+    _local.recorder = rec
+    try:
+        yield rec
+    finally:
+        rec.flush_counters()
+        _local.recorder = outer if outer is not _default else None
+
+
+def merge(records):
+    """別の Recorder（子プロセスなど）のレコードをいまの Recorder に足す"""
+    rec = current()
+    if rec.keep:
+        rec.records.extend(records)
+
+
+# --- モジュール関数（いまの Recorder に委譲） -------------------
+def enabled(level):
+    return current().enabled(level)
+
+
+def debug(msg, **fields):
+    current().log("debug", msg, **fields)
+
+
+def info(msg, **fields):
+    current().log("info", msg, **fields)
+
+
+def warning(msg, **fields):
+    current().log("warning", msg, **fields)
+
+
+def error(msg, **fields):
+    current().log("error", msg, **fields)
+
+
+def record(kind, level="info", **fields):
+    current().record(kind, level, **fields)
+
+
+def count(name, n=1):
+    current().count(name, n)
+
+
+def phase(name, **fields):
+    return current().phase(name, **fields)